@@ -0,0 +1,196 @@
+"""
+طابور كتابة مؤجلة (write-behind) لإضافة الصفوف إلى Google Sheets.
+
+يتم تجميع الصفوف المعلقة حسب (الجدول، ورقة العمل) وإرسالها في طلب
+values.append واحد يحتوي على عدة صفوف، عند امتلاء الدفعة أو بعد مهلة زمنية.
+كل صف (أو مجموعة صفوف مرسلة معاً) يحصل على Future يكتمل فقط بعد نجاح إرسال
+الدفعة التي يحتويها، وقيمته رقم أول صف له في ورقة العمل (أو None إذا لم يعرف).
+المجموعة لا تقسم أبداً بين طلبين.
+"""
+import asyncio
+import logging
+import re
+import time
+
+import gspread
+
+import config
+import sheets_client
+from log_config import SAMPLED
+
+logger = logging.getLogger(__name__)
+
+# رقم أول صف في نطاق مثل 'Sheet 1'!A12:D14 (بعد اسم ورقة العمل)
+_RANGE_START = re.compile(r'^[A-Za-z]*(\d+)')
+
+
+def appended_start_row(response) -> int:
+    """رقم أول صف تمت إضافته من رد values.append، أو None"""
+    try:
+        match = _RANGE_START.match(response['updates']['updatedRange'].rsplit('!', 1)[-1])
+    except (KeyError, TypeError):
+        return None
+    return int(match.group(1)) if match else None
+
+
+def target_key(sheet_config: dict) -> tuple:
+    """مفتاح تجميع الصفوف: معرف الجدول (أو اسمه) واسم ورقة العمل"""
+    return (
+        sheet_config.get('spreadsheet_id') or sheet_config['sheet_name'],
+        sheet_config['worksheet_name']
+    )
+
+
+class _PendingGroup:
+    """الصفوف المعلقة لورقة عمل واحدة"""
+
+    def __init__(self, sheet_config: dict):
+        self.sheet_config = sheet_config
+        self.items = []  # قائمة (الصفوف، Future، وقت الإضافة)
+        self.row_count = 0
+        self.timer = None
+        self.lock = asyncio.Lock()
+
+
+class AppendQueue:
+    """طابور تجميع الصفوف وإرسالها على دفعات"""
+
+    def __init__(self, batch_size: int = None, flush_interval: float = None):
+        self.batch_size = batch_size or config.APPEND_BATCH_SIZE
+        self.flush_interval = flush_interval if flush_interval is not None else config.APPEND_FLUSH_INTERVAL
+        self._groups = {}
+        self._tasks = set()
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.failed_flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.max_row_wait = 0.0
+
+    def submit(self, sheet_config: dict, row: list) -> asyncio.Future:
+        """إضافة صف إلى الطابور وإرجاع Future يكتمل بعد حفظ الصف فعلياً"""
+        return self.submit_rows(sheet_config, [row])
+
+    def submit_rows(self, sheet_config: dict, rows: list) -> asyncio.Future:
+        """إضافة عدة صفوف ترسل معاً في نفس الطلب"""
+        loop = asyncio.get_running_loop()
+        key = target_key(sheet_config)
+        group = self._groups.get(key)
+        if group is None:
+            group = _PendingGroup(sheet_config)
+            self._groups[key] = group
+        # استخدام أحدث إعدادات للجدول عند الإرسال
+        group.sheet_config = sheet_config
+
+        future = loop.create_future()
+        group.items.append((rows, future, time.perf_counter()))
+        group.row_count += len(rows)
+
+        if group.row_count >= self.batch_size:
+            self._schedule_flush(key)
+        elif group.timer is None:
+            group.timer = loop.call_later(self.flush_interval, self._schedule_flush, key)
+        return future
+
+    def _schedule_flush(self, key: tuple):
+        """إنشاء مهمة إرسال لمجموعة محددة"""
+        group = self._groups.get(key)
+        if group is None:
+            return
+        if group.timer is not None:
+            group.timer.cancel()
+            group.timer = None
+        task = asyncio.get_running_loop().create_task(self._flush(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, key: tuple):
+        """إرسال الصفوف المعلقة لمجموعة في طلب واحد"""
+        group = self._groups.get(key)
+        if group is None:
+            return
+        # طلب واحد فقط لكل ورقة عمل في نفس الوقت للحفاظ على ترتيب الصفوف
+        async with group.lock:
+            # أخذ عناصر كاملة حتى حجم الدفعة (العنصر الأكبر من الدفعة يرسل وحده)
+            count = 0
+            taken = 0
+            for rows, _, _ in group.items:
+                if taken and count + len(rows) > self.batch_size:
+                    break
+                count += len(rows)
+                taken += 1
+            batch = group.items[:taken]
+            del group.items[:taken]
+            group.row_count -= count
+            if not batch:
+                return
+            if group.items:
+                self._schedule_flush(key)
+
+            rows = [row for item_rows, _, _ in batch for row in item_rows]
+            started = time.perf_counter()
+            try:
+                start_row = await self._write(group.sheet_config, rows)
+            except Exception as e:
+                self.failed_flushes += 1
+                logger.error(f"فشل إرسال دفعة من {len(rows)} صف إلى {key}: {str(e)}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            finally:
+                if not group.items and group.timer is None and self._groups.get(key) is group:
+                    del self._groups[key]
+
+            finished = time.perf_counter()
+            latency = finished - started
+            self.flushes += 1
+            self.rows_flushed += len(rows)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            for item_rows, future, queued_at in batch:
+                self.max_row_wait = max(self.max_row_wait, finished - queued_at)
+                if not future.done():
+                    future.set_result(start_row)
+                if start_row is not None:
+                    start_row += len(item_rows)
+            logger.info(
+                "تم إرسال دفعة من %d صف إلى %s خلال %.3f ثانية", len(rows), key, latency,
+                extra={**SAMPLED, 'rows': len(rows), 'latency': round(latency, 3)}
+            )
+
+    async def _write(self, sheet_config: dict, rows: list) -> int:
+        """تنفيذ طلب values.append واحد لجميع الصفوف. يرجع رقم أول صف تمت إضافته"""
+        response = await sheets_client.run_on_worksheet(sheet_config, gspread.Worksheet.append_rows, rows)
+        return appended_start_row(response)
+
+    async def flush_all(self):
+        """إرسال جميع الصفوف المعلقة فوراً (عند الإيقاف)"""
+        for key in list(self._groups):
+            self._schedule_flush(key)
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def depth(self) -> int:
+        """عدد الصفوف المنتظرة في الطابور"""
+        return sum(group.row_count for group in self._groups.values())
+
+    def stats(self) -> dict:
+        """إحصائيات الطابور: العمق وزمن الإرسال"""
+        avg = self.total_flush_latency / self.flushes if self.flushes else 0.0
+        return {
+            'queue_depth': self.depth(),
+            'queue_groups': len(self._groups),
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'rows_flushed': self.rows_flushed,
+            'flush_latency_last_ms': round(self.last_flush_latency * 1000, 2),
+            'flush_latency_avg_ms': round(avg * 1000, 2),
+            'flush_latency_max_ms': round(self.max_flush_latency * 1000, 2),
+            'row_wait_max_ms': round(self.max_row_wait * 1000, 2)
+        }
+
+
+append_queue = AppendQueue()
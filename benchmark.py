@@ -0,0 +1,535 @@
+"""
+اختبار أداء البوت تحت الحمل باستخدام المعالجات الحقيقية في main.py.
+
+يتم إنشاء التطبيق الحقيقي عبر main.build_application (نفس ConversationHandler ونفس
+طابور الرسائل ومعالج التحديثات والصندوق الصادر)، مع استبدال طرفي الشبكة فقط:
+- FakeTelegram: اتصال Bot API داخل العملية يرد على sendMessage/editMessageText بتأخير محدد.
+- FakeSheetsSession: جلسة HTTP لـ gspread ترد على طلبات Google Sheets بتأخير ونسبة أخطاء
+  محددة، فتمر الطلبات عبر محدد المعدل ومجمع الحسابات وطابور الكتابة الحقيقي.
+
+كل مستخدم وهمي يرسل /start ثم يختار الجدول ثم يدخل القيم، وينتظر رد البوت قبل كل خطوة.
+يتم تشغيل كل سيناريو في عملية منفصلة حتى تكون قراءة الذاكرة القصوى خاصة به.
+
+الاستخدام:
+    python benchmark.py                      # جميع السيناريوهات
+    python benchmark.py baseline structured  # سيناريوهات محددة
+    python benchmark.py baseline --users 5000 --sheets-latency 0.2 --json results.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # غير متوفر على Windows
+    resource = None
+
+SHEET_KEY = "جدول اختبار الأداء"
+SPREADSHEET_ID = "benchmark-spreadsheet"
+WORKSHEET_NAME = "الورقة1"
+BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+FIRST_USER_ID = 5000000
+SAVED_MARKER = "تم حفظ البيانات بنجاح"
+
+DEFAULTS = {
+    'users': 1000,  # عدد المستخدمين الوهميين
+    'ramp': 0.0,  # توزيع بدء المستخدمين على هذه المدة بالثواني
+    'input': 'columns',  # columns: رسالة لكل عمود، structured: جميع القيم في رسالة واحدة
+    'telegram_latency': 0.02,  # تأخير كل طلب Bot API بالثواني
+    'telegram_limits': False,  # تطبيق حدود إرسال Telegram الحقيقية في طابور الرسائل
+    'sheets_latency': 0.05,  # تأخير كل طلب Google Sheets بالثواني
+    'sheets_error_rate': 0.0,  # نسبة طلبات Sheets التي ترجع خطأ 503
+    'sheets_quota_rate': 0.0,  # نسبة طلبات Sheets التي ترجع خطأ 429 (تجاوز الحصة)
+    'timeout': 120.0,  # أقصى انتظار لرد البوت في كل خطوة، ولإرسال جميع الصفوف إلى Sheets
+    'seed': 1,
+    'tracemalloc': False  # قياس ذروة ذاكرة Python عبر tracemalloc (يبطئ التنفيذ)
+}
+
+SCENARIOS = {
+    'baseline': {},
+    'structured': {'input': 'structured'},
+    'slow_sheets': {'sheets_latency': 0.5},
+    'flaky_sheets': {'sheets_error_rate': 0.05, 'sheets_quota_rate': 0.02},
+    'telegram_limits': {'users': 200, 'telegram_limits': True}
+}
+
+BENCH_SHEET = {
+    "sheet_name": SHEET_KEY,
+    "spreadsheet_id": SPREADSHEET_ID,
+    "worksheet_name": WORKSHEET_NAME,
+    "column_types": {"التاريخ": "date", "تسمية": "text", "المبلغ": "number", "ملاحظات": "text"},
+    "column_order": ["التاريخ", "تسمية", "المبلغ", "ملاحظات"],
+    "date_options": {"التاريخ": {"auto": True, "include_time": False}},
+    "required_columns": ["تسمية", "المبلغ"],
+    "optional_columns": ["التاريخ", "ملاحظات"]
+}
+
+
+def percentile(values: list, p: float):
+    """المئين p بطريقة أقرب رتبة من قائمة مرتبة"""
+    if not values:
+        return None
+    return values[max(min(math.ceil(p / 100 * len(values)) - 1, len(values) - 1), 0)]
+
+
+def peak_rss_mb():
+    """أقصى استهلاك للذاكرة الفعلية للعملية بالميجابايت"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux بالكيلوبايت و macOS بالبايت
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+# ---------------------------------------------------------------------------
+# Google Sheets وهمي
+# ---------------------------------------------------------------------------
+
+class FakeSheetsSession:
+    """جلسة HTTP بديلة لـ gspread تحاكي Google Sheets API داخل العملية"""
+
+    def __init__(self, latency: float, error_rate: float, quota_rate: float, seed: int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.rows = 0
+        self.requests = 0
+        self.errors = 0
+
+    def _response(self, status: int, payload: dict):
+        import requests
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(payload).encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+    def _error(self, status: int, reason: str):
+        self.errors += 1
+        return self._response(status, {
+            'error': {'code': status, 'message': reason, 'status': reason, 'errors': [{'reason': reason}]}
+        })
+
+    def _handle(self, method: str, url: str, json=None, **kwargs):
+        if self.latency:
+            # تذبذب ±50% حول التأخير المحدد
+            time.sleep(self.latency * (0.5 + self._random.random()))
+        with self._lock:
+            self.requests += 1
+            roll = self._random.random()
+            if roll < self.quota_rate:
+                return self._error(429, 'rateLimitExceeded')
+            if roll < self.quota_rate + self.error_rate:
+                return self._error(503, 'backendError')
+
+            path = url.split('/v4/spreadsheets/', 1)[-1]
+            if method == 'post' and ':append' in path:
+                count = len((json or {}).get('values', []))
+                start = self.rows + 2
+                self.rows += count
+                return self._response(200, {
+                    'spreadsheetId': SPREADSHEET_ID,
+                    'updates': {
+                        'updatedRange': f"'{WORKSHEET_NAME}'!A{start}:D{start + count - 1}",
+                        'updatedRows': count
+                    }
+                })
+            if method == 'get' and '/values/' in path:
+                return self._response(200, {'range': f"'{WORKSHEET_NAME}'!A1:D1", 'values': []})
+            if method == 'get':
+                return self._response(200, {
+                    'spreadsheetId': SPREADSHEET_ID,
+                    'properties': {'title': SHEET_KEY},
+                    'sheets': [{'properties': {
+                        'sheetId': 0, 'title': WORKSHEET_NAME, 'index': 0,
+                        'gridProperties': {'rowCount': 1000000, 'columnCount': 4}
+                    }}]
+                })
+            return self._error(404, 'notFound')
+
+    def get(self, url, **kwargs):
+        return self._handle('get', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._handle('post', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self._handle('put', url, **kwargs)
+
+
+def install_fake_sheets(session: FakeSheetsSession):
+    """استبدال عملاء حسابات الخدمة المشتركة بعملاء يستخدمون الجلسة الوهمية"""
+    import config
+    import sheets_client
+    from google.auth.credentials import AnonymousCredentials
+    from rate_limiter import RateLimitedClient
+
+    class FakeSheetsClient(sheets_client.SheetsClient):
+        def __init__(self, credentials_file: str, max_retries: int = None):
+            self.credentials_file = credentials_file
+            self._lock = threading.Lock()
+            self.token_refreshes = 0
+            self.worksheets = sheets_client.WorksheetCache()
+            self.client = RateLimitedClient(auth=AnonymousCredentials(), session=session)
+            self.client.account = credentials_file
+            self.client.max_retries = max_retries
+
+        def ensure_fresh_token(self):
+            pass
+
+        def connection_stats(self) -> dict:
+            return {'connections_opened': 0, 'requests_sent': 0, 'connections_reused': 0}
+
+    for credentials_file in config.GOOGLE_SHEETS_CREDENTIALS_FILES:
+        sheets_client._clients[credentials_file] = FakeSheetsClient(credentials_file, sheets_client.pool.max_retries)
+
+
+# ---------------------------------------------------------------------------
+# Telegram وهمي
+# ---------------------------------------------------------------------------
+
+def make_fake_telegram(latency: float):
+    """إنشاء اتصال Bot API وهمي (BaseRequest) يسجل رسائل البوت لكل محادثة"""
+    from telegram.request import BaseRequest
+
+    class FakeTelegram(BaseRequest):
+        def __init__(self):
+            self.latency = latency
+            self._message_ids = itertools.count(1)
+            self._replies = {}  # chat_id -> asyncio.Queue لرسائل البوت وتعديلاته
+            self.calls = {}
+
+        def replies(self, chat_id: int) -> asyncio.Queue:
+            queue = self._replies.get(chat_id)
+            if queue is None:
+                queue = self._replies[chat_id] = asyncio.Queue()
+            return queue
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            api_method = url.rsplit('/', 1)[-1]
+            params = request_data.parameters if request_data is not None else {}
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if api_method == 'getMe':
+                result = BOT_USER
+            elif api_method in ('sendMessage', 'editMessageText'):
+                chat_id = int(params['chat_id'])
+                result = {
+                    'message_id': int(params.get('message_id') or next(self._message_ids)),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': BOT_USER,
+                    'text': params.get('text', '')
+                }
+                self.replies(chat_id).put_nowait(result)
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+    return FakeTelegram()
+
+
+# ---------------------------------------------------------------------------
+# المستخدمون الوهميون
+# ---------------------------------------------------------------------------
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+
+def message_update(bot, user_id: int, text: str):
+    """تحديث رسالة نصية (أو أمر) من المستخدم"""
+    from telegram import Update
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id),
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return Update.de_json({'update_id': next(_update_ids), 'message': message}, bot)
+
+
+def callback_update(bot, user_id: int, message: dict, data: str):
+    """تحديث ضغط زر على رسالة من البوت"""
+    from telegram import Update
+    query = {
+        'id': str(next(_update_ids)),
+        'from': _user(user_id),
+        'chat_instance': str(user_id),
+        'message': message,
+        'data': data
+    }
+    return Update.de_json({'update_id': next(_update_ids), 'callback_query': query}, bot)
+
+
+def input_values(schema, user_id: int) -> dict:
+    """قيم صحيحة لأعمدة الإدخال حسب نوع كل عمود"""
+    values = {}
+    for column in schema.prompt_order:
+        column_type = schema.columns[column].type
+        if column_type == 'number':
+            values[column] = str(user_id % 1000 + 0.5)
+        elif column_type == 'date':
+            values[column] = time.strftime('%Y-%m-%d')
+        else:
+            values[column] = f"عنصر {user_id}"
+    return values
+
+
+async def run_user(application, telegram, schema, user_id: int, scenario: dict, delay: float):
+    """محادثة مستخدم واحد كاملة. يرجع مدة المحادثة بالثواني أو None عند الفشل"""
+    await asyncio.sleep(delay)
+    replies = telegram.replies(user_id)
+    timeout = scenario['timeout']
+
+    async def send(update) -> dict:
+        await application.update_queue.put(update)
+        return await asyncio.wait_for(replies.get(), timeout)
+
+    values = input_values(schema, user_id)
+    if scenario['input'] == 'structured':
+        texts = [" | ".join(values[column] for column in schema.prompt_order)]
+    else:
+        texts = [values[column] for column in schema.prompt_order]
+
+    started = time.perf_counter()
+    try:
+        menu = await send(message_update(application.bot, user_id, '/start'))
+        reply = await send(callback_update(application.bot, user_id, menu, f"sheet_{SHEET_KEY}"))
+        for text in texts:
+            reply = await send(message_update(application.bot, user_id, text))
+    except asyncio.TimeoutError:
+        return None
+    if SAVED_MARKER not in reply['text']:
+        return None
+    return time.perf_counter() - started
+
+
+# ---------------------------------------------------------------------------
+# تشغيل سيناريو واحد (داخل العملية الفرعية)
+# ---------------------------------------------------------------------------
+
+def prepare_environment(scenario: dict, workdir: str):
+    """ضبط الإعدادات قبل استيراد وحدات البوت (تقرأ config عند الاستيراد)"""
+    os.environ['OUTBOX_DB_PATH'] = os.path.join(workdir, 'outbox.db')
+    os.environ['MIRROR_DB_PATH'] = os.path.join(workdir, 'mirror.db')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('LOG_FILE', '')
+    os.environ.setdefault('LOG_FORMAT', 'text')
+    os.environ['METRICS_PORT'] = '0'
+    if not scenario['telegram_limits']:
+        # بدون حدود Telegram يقيس الاختبار قدرة المعالجات نفسها
+        for name in ('TELEGRAM_GLOBAL_RATE', 'TELEGRAM_GLOBAL_BURST', 'TELEGRAM_CHAT_RATE', 'TELEGRAM_CHAT_BURST'):
+            os.environ.setdefault(name, '1000000000')
+
+    config_file = os.path.join(workdir, 'sheets_config.json')
+    sheet = dict(BENCH_SHEET)
+    sheet['authorized_user_ids'] = [str(FIRST_USER_ID + index) for index in range(scenario['users'])]
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump({SHEET_KEY: sheet}, f, ensure_ascii=False)
+
+    import config
+    config.SHEETS_CONFIG_FILE = config_file
+
+
+async def run_scenario(scenario: dict) -> dict:
+    """تشغيل سيناريو واحد وإرجاع نتائجه"""
+    import main
+    import sheets_client
+    from append_queue import append_queue
+    from config_store import config_store
+    from log_config import setup_logging, stop_logging
+    from message_scheduler import scheduler
+    from metrics import loop_lag
+    from outbox import drainer, outbox
+    from sheet_mirror import mirror
+
+    setup_logging()
+    sheets = FakeSheetsSession(
+        scenario['sheets_latency'], scenario['sheets_error_rate'], scenario['sheets_quota_rate'], scenario['seed']
+    )
+    install_fake_sheets(sheets)
+    telegram = make_fake_telegram(scenario['telegram_latency'])
+    application = main.build_application(token='100000:benchmark', request=telegram)
+    schema = config_store.get().get_schema(SHEET_KEY)
+
+    await application.initialize()
+    await application.start()
+    await drainer.start()
+    loop_lag.start()
+    if scenario['tracemalloc']:
+        tracemalloc.start()
+
+    users = scenario['users']
+    ramp = scenario['ramp']
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(
+        run_user(application, telegram, schema, FIRST_USER_ID + index, scenario, ramp * index / users)
+        for index in range(users)
+    ))
+    elapsed = time.perf_counter() - started
+    completed = sorted(latency for latency in latencies if latency is not None)
+
+    # انتظار وصول جميع الصفوف المحفوظة إلى Google Sheets الوهمي
+    deadline = time.perf_counter() + scenario['timeout']
+    while sheets.rows < len(completed) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    drain = time.perf_counter() - started - elapsed if sheets.rows >= len(completed) else None
+
+    heap_peak = None
+    if scenario['tracemalloc']:
+        heap_peak = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.stop()
+    lag = loop_lag.stats()
+
+    await loop_lag.stop()
+    await application.stop()
+    await scheduler.stop()
+    await drainer.stop()
+    await append_queue.flush_all()
+    await outbox.close()
+    await mirror.close()
+    await application.shutdown()
+    sheets_client.shutdown()
+    stop_logging()
+
+    return {
+        'users': users,
+        'completed': len(completed),
+        'failed': users - len(completed),
+        'seconds': round(elapsed, 2),
+        'throughput': round(len(completed) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(completed, 50) * 1000, 1) if completed else None,
+        'p95_ms': round(percentile(completed, 95) * 1000, 1) if completed else None,
+        'p99_ms': round(percentile(completed, 99) * 1000, 1) if completed else None,
+        'drain_seconds': round(drain, 2) if drain is not None else None,
+        'sheets_rows': sheets.rows,
+        'sheets_requests': sheets.requests,
+        'sheets_errors': sheets.errors,
+        'telegram_calls': sum(telegram.calls.values()),
+        'loop_lag_max_ms': lag['loop_lag_max_ms'],
+        'peak_rss_mb': peak_rss_mb(),
+        'heap_peak_mb': heap_peak
+    }
+
+
+def run_child(scenario: dict):
+    """نقطة الدخول في العملية الفرعية: النتيجة تطبع كسطر JSON على stdout"""
+    with tempfile.TemporaryDirectory(prefix='bot-benchmark-') as workdir:
+        prepare_environment(scenario, workdir)
+        if sys.platform == 'win32':
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        result = asyncio.run(run_scenario(scenario))
+    print(json.dumps(result))
+
+
+# ---------------------------------------------------------------------------
+# العملية الرئيسية: تشغيل السيناريوهات وعرض النتائج
+# ---------------------------------------------------------------------------
+
+COLUMNS = (
+    ('scenario', 'scenario', 16), ('users', 'users', 6), ('completed', 'done', 6), ('failed', 'failed', 6),
+    ('throughput', 'conv/s', 8), ('p50_ms', 'p50 ms', 9), ('p95_ms', 'p95 ms', 9), ('p99_ms', 'p99 ms', 9),
+    ('drain_seconds', 'drain s', 8), ('sheets_errors', 'sh.err', 7), ('loop_lag_max_ms', 'lag ms', 8),
+    ('peak_rss_mb', 'rss MB', 8), ('heap_peak_mb', 'heap MB', 8)
+)
+
+
+def format_table(results: list) -> str:
+    lines = [" ".join(title.rjust(width) for _, title, width in COLUMNS)]
+    for result in results:
+        lines.append(" ".join(
+            str('-' if result.get(key) is None else result[key]).rjust(width) for key, _, width in COLUMNS
+        ))
+    return "\n".join(lines)
+
+
+def run_in_subprocess(name: str, scenario: dict) -> dict:
+    """تشغيل السيناريو في عملية منفصلة وقراءة نتيجته"""
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', json.dumps(scenario)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        text=True
+    )
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        return {'scenario': name, 'users': scenario['users'], 'error': f"exit code {process.returncode}"}
+    result = json.loads(lines[-1])
+    result['scenario'] = name
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="اختبار أداء البوت تحت الحمل")
+    parser.add_argument('scenarios', nargs='*', help=f"السيناريوهات: {', '.join(SCENARIOS)} (الافتراضي: الكل)")
+    parser.add_argument('--users', type=int, help="عدد المستخدمين الوهميين")
+    parser.add_argument('--ramp', type=float, help="توزيع بدء المستخدمين على هذه المدة بالثواني")
+    parser.add_argument('--input', choices=('columns', 'structured'), help="طريقة إدخال القيم")
+    parser.add_argument('--telegram-latency', type=float, help="تأخير طلبات Bot API بالثواني")
+    parser.add_argument('--sheets-latency', type=float, help="تأخير طلبات Google Sheets بالثواني")
+    parser.add_argument('--sheets-error-rate', type=float, help="نسبة أخطاء 503 من Google Sheets")
+    parser.add_argument('--sheets-quota-rate', type=float, help="نسبة أخطاء 429 من Google Sheets")
+    parser.add_argument('--timeout', type=float, help="أقصى انتظار لكل خطوة ولإرسال الصفوف بالثواني")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--tracemalloc', action='store_true', default=None, help="قياس ذروة ذاكرة Python")
+    parser.add_argument('--json', dest='json_path', help="حفظ النتائج في ملف JSON")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(json.loads(args.child))
+        return
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"سيناريو غير معروف: {', '.join(unknown)}")
+    overrides = {
+        key: value for key, value in vars(args).items()
+        if key in DEFAULTS and value is not None
+    }
+
+    results = []
+    for name in names:
+        scenario = {**DEFAULTS, **SCENARIOS[name], **overrides}
+        print(f"تشغيل {name} ({scenario['users']} مستخدم)...", file=sys.stderr)
+        results.append(run_in_subprocess(name, scenario))
+
+    print(format_table(results))
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,126 @@ load_dotenv()
 
 # معلومات Google Sheets
 GOOGLE_SHEETS_CREDENTIALS_FILE = 'credentials.json'
+# ملفات حسابات الخدمة مفصولة بفاصلة، يتم توزيع الطلبات عليها لتجاوز حصة الحساب الواحد
+GOOGLE_SHEETS_CREDENTIALS_FILES = [
+    path.strip() for path in os.getenv('GOOGLE_SHEETS_CREDENTIALS_FILES', GOOGLE_SHEETS_CREDENTIALS_FILE).split(',')
+    if path.strip()
+]
+SHEETS_ACCESS_RECHECK = int(os.getenv('SHEETS_ACCESS_RECHECK', '600'))  # إعادة تجربة الحساب الذي لا يملك صلاحية على جدول بعد هذا العدد من الثواني
+SHEETS_TOKEN_REFRESH_MARGIN = int(os.getenv('SHEETS_TOKEN_REFRESH_MARGIN', '300'))  # تجديد الرمز قبل انتهائه بهذا العدد من الثواني
+SHEETS_HTTP_POOL_SIZE = int(os.getenv('SHEETS_HTTP_POOL_SIZE', '10'))  # عدد اتصالات HTTP المحتفظ بها مفتوحة
+SHEETS_MAX_CONCURRENCY = int(os.getenv('SHEETS_MAX_CONCURRENCY', '8'))  # الحد الأقصى لاستدعاءات Sheets المتزامنة
+SHEETS_HTTP_TIMEOUT = float(os.getenv('SHEETS_HTTP_TIMEOUT', '30'))  # مهلة طلبات Google Sheets بالثواني
+
+# حدود معدل طلبات Google Sheets (حصص Google الافتراضية 60 طلب في الدقيقة)
+SHEETS_READ_PER_MINUTE = float(os.getenv('SHEETS_READ_PER_MINUTE', '60'))  # طلبات القراءة في الدقيقة لكل حساب خدمة
+SHEETS_WRITE_PER_MINUTE = float(os.getenv('SHEETS_WRITE_PER_MINUTE', '60'))  # طلبات الكتابة في الدقيقة لكل حساب خدمة
+SHEETS_SPREADSHEET_READ_PER_MINUTE = float(os.getenv('SHEETS_SPREADSHEET_READ_PER_MINUTE', '60'))  # طلبات القراءة في الدقيقة لكل جدول
+SHEETS_SPREADSHEET_WRITE_PER_MINUTE = float(os.getenv('SHEETS_SPREADSHEET_WRITE_PER_MINUTE', '60'))  # طلبات الكتابة في الدقيقة لكل جدول
+SHEETS_RATE_BURST = float(os.getenv('SHEETS_RATE_BURST', '10'))  # عدد الطلبات المسموح بها دفعة واحدة قبل بدء الانتظار
+RATE_LIMIT_BACKOFF_BASE = float(os.getenv('RATE_LIMIT_BACKOFF_BASE', '1'))  # التأخير الأولي بعد رد 429 بدون Retry-After بالثواني
+RATE_LIMIT_BACKOFF_MAX = float(os.getenv('RATE_LIMIT_BACKOFF_MAX', '64'))  # الحد الأقصى للتأخير بعد رد 429 بالثواني
+RATE_LIMIT_DEADLINE = float(os.getenv('RATE_LIMIT_DEADLINE', '300'))  # مدة إعادة المحاولة بعد تجاوز الحصة قبل إرجاع الخطأ بالثواني
+RATE_LIMIT_MIN_FACTOR = float(os.getenv('RATE_LIMIT_MIN_FACTOR', '0.25'))  # أدنى نسبة من المعدل بعد التخفيض بسبب 429
+RATE_LIMIT_RECOVERY_STEP = float(os.getenv('RATE_LIMIT_RECOVERY_STEP', '0.05'))  # نسبة استعادة المعدل بعد كل طلب ناجح
+
+# طابور الكتابة المؤجلة
+APPEND_BATCH_SIZE = int(os.getenv('APPEND_BATCH_SIZE', '50'))  # إرسال الدفعة فور وصولها لهذا العدد من الصفوف
+APPEND_FLUSH_INTERVAL = float(os.getenv('APPEND_FLUSH_INTERVAL', '1.0'))  # أقصى مدة انتظار قبل إرسال الدفعة بالثواني
+
+# الإدخال الجماعي (/bulk)
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', '500'))  # أقصى عدد أسطر في رسالة إدخال جماعي واحدة
+BULK_MAX_ERRORS_SHOWN = int(os.getenv('BULK_MAX_ERRORS_SHOWN', '20'))  # عدد أخطاء الأسطر المعروضة في الرد
+
+# استيراد ملفات CSV/XLSX
+IMPORT_MAX_FILE_SIZE = int(os.getenv('IMPORT_MAX_FILE_SIZE', str(20 * 1024 * 1024)))  # أقصى حجم للملف (حد تحميل Bot API)
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', '100000'))  # أقصى عدد صفوف في ملف واحد
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '500'))  # عدد الصفوف في كل طلب إضافة إلى الجدول
+IMPORT_PROGRESS_INTERVAL = float(os.getenv('IMPORT_PROGRESS_INTERVAL', '3'))  # أقل فاصل بين تحديثات رسالة التقدم بالثواني
+IMPORT_SEND_TIMEOUT = float(os.getenv('IMPORT_SEND_TIMEOUT', '900'))  # مدة متابعة الإرسال قبل تركه يكمل في الخلفية
+IMPORT_TMP_DIR = os.getenv('IMPORT_TMP_DIR') or None  # مجلد الملفات المؤقتة (الافتراضي مجلد النظام)
+
+# الصندوق الصادر المحلي (SQLite)
+OUTBOX_DB_PATH = os.getenv('OUTBOX_DB_PATH', 'outbox.db')  # مسار قاعدة بيانات الصندوق الصادر
+OUTBOX_SYNCHRONOUS = os.getenv('OUTBOX_SYNCHRONOUS', 'FULL')  # مستوى مزامنة SQLite مع القرص (FULL أو NORMAL)
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1.0'))  # فحص الصفوف المستحقة كل هذه المدة بالثواني
+OUTBOX_CLAIM_LIMIT = int(os.getenv('OUTBOX_CLAIM_LIMIT', '500'))  # أقصى عدد صفوف يتم حجزها في كل دورة
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', '2'))  # التأخير الأولي لإعادة المحاولة بالثواني
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '300'))  # الحد الأقصى للتأخير بين المحاولات بالثواني
+OUTBOX_VERIFY_WINDOW = int(os.getenv('OUTBOX_VERIFY_WINDOW', '50'))  # صفوف إضافية يتم فحصها عند التحقق من الصفوف غير المؤكدة
+OUTBOX_RETENTION = float(os.getenv('OUTBOX_RETENTION', str(7 * 24 * 3600)))  # مدة الاحتفاظ بالصفوف المرسلة بالثواني
+OUTBOX_PURGE_INTERVAL = float(os.getenv('OUTBOX_PURGE_INTERVAL', '3600'))  # الفاصل بين عمليات تنظيف الصفوف القديمة
+
+# النسخة المحلية من الجداول (SQLite)
+MIRROR_DB_PATH = os.getenv('MIRROR_DB_PATH', 'mirror.db')  # مسار قاعدة بيانات النسخة المحلية
+MIRROR_SYNC_INTERVAL = float(os.getenv('MIRROR_SYNC_INTERVAL', '300'))  # الفاصل بين المزامنات الدورية بالثواني (0 للتعطيل)
+MIRROR_FULL_SYNC_INTERVAL = float(os.getenv('MIRROR_FULL_SYNC_INTERVAL', str(6 * 3600)))  # الفاصل بين المزامنات الكاملة بالثواني
+MIRROR_PAGE_SIZE = int(os.getenv('MIRROR_PAGE_SIZE', '5000'))  # عدد الصفوف في كل طلب قراءة
+MIRROR_MAX_AGE = float(os.getenv('MIRROR_MAX_AGE', '60'))  # أقصى عمر للنسخة المحلية قبل مزامنتها عند الاستعلام
+MIRROR_FRESH_WAIT = float(os.getenv('MIRROR_FRESH_WAIT', '2'))  # أقصى انتظار لمزامنة النسخة المحلية عند الاستعلام بالثواني، ثم تكمل في الخلفية
+
+# التقارير (/report)
+REPORT_MAX_GROUPS = int(os.getenv('REPORT_MAX_GROUPS', '31'))  # أقصى عدد مجموعات معروضة في التقرير
+REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', '32'))  # عدد التقارير المحفوظة مؤقتاً
+
+# البحث (/find)
+FIND_PAGE_SIZE = int(os.getenv('FIND_PAGE_SIZE', '10'))  # عدد النتائج في كل صفحة
+FIND_MAX_RESULTS = int(os.getenv('FIND_MAX_RESULTS', '500'))  # أقصى عدد نتائج يتم حفظها للتصفح
+FIND_CACHE_SIZE = int(os.getenv('FIND_CACHE_SIZE', '1000'))  # عدد عمليات البحث المحفوظة نتائجها للتصفح لجميع المستخدمين
+
+# حدود إرسال رسائل Telegram
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))  # أقصى عدد رسائل في الثانية لجميع المحادثات
+TELEGRAM_GLOBAL_BURST = float(os.getenv('TELEGRAM_GLOBAL_BURST', '30'))  # عدد الرسائل المسموح بها دفعة واحدة لجميع المحادثات
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))  # أقصى عدد رسائل في الثانية لكل محادثة خاصة
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', str(20 / 60)))  # أقصى عدد رسائل في الثانية لكل مجموعة
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))  # عدد الرسائل المسموح بها دفعة واحدة لكل محادثة
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))  # عدد إعادة المحاولات بعد RetryAfter
+TELEGRAM_DRAIN_TIMEOUT = float(os.getenv('TELEGRAM_DRAIN_TIMEOUT', '10'))  # مهلة إرسال الرسائل المتبقية عند الإيقاف بالثواني
+
+# معالجة التحديثات بالتوازي
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))  # أقصى عدد تحديثات تعالج في نفس الوقت (لمحادثات مختلفة)
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '256'))  # أقصى عدد تحديثات قيد المعالجة أو الانتظار
+
+# مسار المقاييس /metrics
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # عنوان الاستماع لخادم المقاييس
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))  # منفذ خادم المقاييس (0 للتعطيل)
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv('METRICS_SNAPSHOT_INTERVAL', '5'))  # الفاصل بين لقطات إحصائيات مكونات حلقة الأحداث بالثواني
+
+# السجلات
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()  # مستوى السجلات (DEBUG يسجل حالة المحادثة والبيانات المدخلة)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # صيغة السجلات: json أو text
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')  # ملف السجلات (فارغ لتعطيل الكتابة إلى ملف)
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))  # الحجم الذي يتم عنده تدوير ملف السجلات
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))  # عدد ملفات السجلات القديمة المحفوظة
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '10'))  # تسجيل حدث واحد من كل هذا العدد للأحداث المتكررة بكثرة
+
+# مراقبة حلقة الأحداث
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))  # الفاصل الزمني لقياس تأخر الحلقة بالثواني
+LOOP_LAG_WARN_THRESHOLD = float(os.getenv('LOOP_LAG_WARN_THRESHOLD', '0.2'))  # تسجيل تحذير عند تجاوز هذا التأخر
+
+# أدوات التشخيص للمسؤول (/profile و /memsnap)
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))  # الفاصل بين عينات محلل الأداء بالثواني
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '600'))  # إيقاف محلل الأداء تلقائياً بعد هذه المدة
+TRACEMALLOC_FRAMES = int(os.getenv('TRACEMALLOC_FRAMES', '10'))  # عدد الإطارات المحفوظة لكل تخصيص ذاكرة
+MEMSNAP_TOP = int(os.getenv('MEMSNAP_TOP', '30'))  # عدد الأسطر في كل قسم من تقرير الذاكرة
+
+# ملف إعدادات الجداول
+SHEETS_CONFIG_FILE = 'sheets_config.json'
+CONFIG_MTIME_CHECK_INTERVAL = float(os.getenv('CONFIG_MTIME_CHECK_INTERVAL', '2'))  # فحص وقت تعديل الملف كاحتياط كل هذه المدة بالثواني
 
 # معلومات Telegram
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+TELEGRAM_UPDATE_MODE = os.getenv('TELEGRAM_UPDATE_MODE', 'polling')  # طريقة استقبال التحديثات: polling أو webhook
+
+# وضع webhook (TELEGRAM_UPDATE_MODE=webhook)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # الرابط العام الذي يرسل إليه Telegram التحديثات، مثل https://example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')  # مسار استقبال التحديثات في الخادم المحلي
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')  # عنوان الاستماع للخادم المحلي
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))  # منفذ الخادم المحلي
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')  # الرمز السري للتحقق من الطلبات (يتم توليده عشوائياً إذا ترك فارغاً)
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT', '')  # ملف شهادة TLS إذا لم يكن هناك خادم وسيط يتولى HTTPS
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY', '')  # ملف المفتاح الخاص لشهادة TLS
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # أقصى عدد اتصالات متزامنة من Telegram
 
 # معرفات جداول Google
 SPREADSHEET_NAME = "المشتريات"  # اسم جدول المشتريات
@@ -0,0 +1,244 @@
+"""
+نسخة ثابتة في الذاكرة من إعدادات الجداول (sheets_config.json) مع إعادة تحميل تلقائية.
+
+يتم تحليل الملف مرة واحدة إلى ConfigSnapshot غير قابلة للتعديل، ويقوم مراقب watchdog
+باستبدالها بنسخة جديدة عند تعديل الملف من web_gui.py أو sheets_gui.py أو sheets_setup.py.
+كاحتياط (إذا لم تتوفر watchdog أو فاتها حدث) يتم فحص وقت تعديل الملف دورياً.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+
+import config
+from sheet_schema import compile_schemas
+
+logger = logging.getLogger(__name__)
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+def freeze(value):
+    """تحويل القواميس والقوائم إلى نسخ غير قابلة للتعديل"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def sheet_users(sheet_config: dict) -> frozenset:
+    """جميع المستخدمين المصرح لهم بجدول: المستخدم الرئيسي وقائمة authorized_user_ids"""
+    users = {str(user_id) for user_id in sheet_config.get('authorized_user_ids', []) or []}
+    primary = str(sheet_config.get('authorized_user_id', '') or '')
+    if primary:
+        users.add(primary)
+    users.discard('')
+    return frozenset(users)
+
+
+def build_user_index(sheets: dict, previous=None) -> tuple:
+    """بناء فهرس المستخدم -> الجداول المتاحة له.
+
+    إذا توفرت نسخة سابقة يتم تحديث الجداول التي تغيرت صلاحياتها فقط.
+    يرجع (الفهرس، مستخدمو كل جدول).
+    """
+    users_by_sheet = {key: sheet_users(sheet_config) for key, sheet_config in sheets.items()}
+    if previous is None:
+        index = {}
+        for key, users in users_by_sheet.items():
+            for user_id in users:
+                index.setdefault(user_id, set()).add(key)
+        return {user_id: frozenset(keys) for user_id, keys in index.items()}, users_by_sheet
+
+    index = dict(previous.user_index)
+    old_users = previous.sheet_users
+    changed = {}
+    for key in set(old_users) | set(users_by_sheet):
+        before = old_users.get(key, frozenset())
+        after = users_by_sheet.get(key, frozenset())
+        if before == after:
+            continue
+        for user_id in before - after:
+            changed.setdefault(user_id, set(index.get(user_id, ()))).discard(key)
+        for user_id in after - before:
+            changed.setdefault(user_id, set(index.get(user_id, ()))).add(key)
+    for user_id, keys in changed.items():
+        if keys:
+            index[user_id] = frozenset(keys)
+        else:
+            index.pop(user_id, None)
+    return index, users_by_sheet
+
+
+class ConfigSnapshot:
+    """نسخة ثابتة من الإعدادات مع رقم إصدار وفهرس صلاحيات المستخدمين"""
+
+    __slots__ = ('version', 'sheets', 'digest', 'loaded_at', 'user_index', 'sheet_users', 'positions',
+                 'sheet_versions', 'schemas')
+
+    def __init__(self, version: int, sheets: dict, digest: str, previous=None):
+        self.version = version
+        self.sheets = freeze(sheets)
+        self.digest = digest
+        self.loaded_at = time.time()
+        index, users_by_sheet = build_user_index(sheets, previous)
+        self.user_index = MappingProxyType(index)
+        self.sheet_users = MappingProxyType(users_by_sheet)
+        # ترتيب الجداول كما في الملف لعرض الأزرار بنفس الترتيب
+        self.positions = MappingProxyType({key: position for position, key in enumerate(sheets)})
+        # إصدار كل جدول على حدة: يتغير فقط عند تعديل إعدادات ذلك الجدول
+        sheet_versions = {}
+        for key, sheet_config in self.sheets.items():
+            if previous is not None and previous.sheets.get(key) == sheet_config:
+                sheet_versions[key] = previous.sheet_versions[key]
+            else:
+                sheet_versions[key] = version
+        self.sheet_versions = MappingProxyType(sheet_versions)
+        self.schemas = MappingProxyType(compile_schemas(self.sheets, previous))
+
+    def get_schema(self, sheet_key: str, sheet_version: int = None):
+        """المخطط المترجم لجدول محدد، أو None إذا حذف أو تغير منذ الإصدار المعطى"""
+        schema = self.schemas.get(sheet_key)
+        if schema is None:
+            return None
+        if sheet_version is not None and self.sheet_versions[sheet_key] != sheet_version:
+            return None
+        return schema
+
+    def sheets_for_user(self, user_id) -> frozenset:
+        """مفاتيح الجداول المتاحة للمستخدم"""
+        return self.user_index.get(str(user_id), frozenset())
+
+    def accessible_sheets(self, user_id) -> dict:
+        """الجداول المتاحة للمستخدم بنفس ترتيب ملف الإعدادات"""
+        keys = sorted(self.sheets_for_user(user_id), key=self.positions.__getitem__)
+        return {key: self.sheets[key] for key in keys}
+
+
+def read_config_file(path: str) -> tuple:
+    """قراءة ملف الإعدادات والتحقق منه، وإرجاع (الإعدادات، بصمة المحتوى)"""
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        sheets = json.loads(raw.decode('utf-8'))
+    except FileNotFoundError:
+        logger.error("خطأ: ملف sheets_config.json غير موجود")
+        raise FileNotFoundError("لم يتم العثور على ملف التكوين. الرجاء التأكد من وجود ملف sheets_config.json")
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        logger.error(f"خطأ في تنسيق JSON: {str(e)}")
+        raise ValueError("خطأ في تنسيق ملف التكوين. الرجاء التأكد من صحة تنسيق JSON")
+    if not isinstance(sheets, dict):
+        logger.error("خطأ: ملف التكوين ليس بالتنسيق الصحيح")
+        raise ValueError("ملف التكوين غير صالح: يجب أن يكون عبارة عن كائن JSON")
+    return sheets, hashlib.sha1(raw).hexdigest()
+
+
+class _ConfigFileHandler(FileSystemEventHandler):
+    """إعادة تحميل الإعدادات عند تعديل الملف أو استبداله"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def _matches(self, path) -> bool:
+        return bool(path) and os.path.abspath(path) == self.store.path
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        if self._matches(event.src_path) or self._matches(getattr(event, 'dest_path', None)):
+            self.store.reload()
+
+
+class ConfigStore:
+    """مخزن الإعدادات المشترك بين جميع المعالجات"""
+
+    def __init__(self, path: str = None):
+        self.path = os.path.abspath(path or config.SHEETS_CONFIG_FILE)
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._observer = None
+        self._mtime = None
+        self._last_check = 0.0
+        self.reloads = 0
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def reload(self) -> bool:
+        """قراءة الملف واستبدال النسخة الحالية إذا تغير المحتوى"""
+        with self._lock:
+            mtime = self._stat()
+            try:
+                sheets, digest = read_config_file(self.path)
+            except (FileNotFoundError, ValueError):
+                if self._snapshot is None:
+                    raise
+                # قد يكون الملف في منتصف الكتابة؛ نحتفظ بالنسخة السابقة حتى الحدث التالي
+                logger.warning("تعذر إعادة تحميل الإعدادات، سيتم الاحتفاظ بالنسخة السابقة")
+                return False
+            self._mtime = mtime
+            current = self._snapshot
+            if current is not None and current.digest == digest:
+                return False
+            version = current.version + 1 if current is not None else 1
+            self._snapshot = ConfigSnapshot(version, sheets, digest, current)
+            self.reloads += 1
+            logger.info(f"تم تحميل إعدادات الجداول (الإصدار {version}، {len(sheets)} جدول)")
+            return True
+
+    def _check_mtime(self):
+        """الاحتياط: إعادة التحميل إذا تغير وقت تعديل الملف"""
+        now = time.monotonic()
+        if now - self._last_check < config.CONFIG_MTIME_CHECK_INTERVAL:
+            return
+        self._last_check = now
+        if self._stat() != self._mtime:
+            self.reload()
+
+    def get(self) -> ConfigSnapshot:
+        """النسخة الحالية من الإعدادات"""
+        if self._snapshot is None:
+            self.reload()
+        else:
+            self._check_mtime()
+        return self._snapshot
+
+    def start(self):
+        """تحميل الإعدادات وبدء مراقبة الملف"""
+        self.get()
+        if Observer is None or self._observer is not None:
+            if Observer is None:
+                logger.warning("مكتبة watchdog غير متوفرة، سيتم الاعتماد على فحص وقت التعديل")
+            return
+        try:
+            observer = Observer()
+            observer.schedule(_ConfigFileHandler(self), os.path.dirname(self.path), recursive=False)
+            observer.daemon = True
+            observer.start()
+            self._observer = observer
+            logger.info(f"بدء مراقبة ملف الإعدادات: {self.path}")
+        except Exception as e:
+            logger.warning(f"تعذر بدء مراقبة ملف الإعدادات، سيتم الاعتماد على فحص وقت التعديل: {str(e)}")
+
+    def stop(self):
+        """إيقاف مراقبة الملف"""
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+
+config_store = ConfigStore()
@@ -0,0 +1,350 @@
+"""
+استيراد ملفات CSV و XLSX إلى الجدول المختار.
+
+يتم تحميل الملف من Telegram إلى ملف مؤقت على القرص عبر File.download_to_drive (نفس اتصال
+البوت وإعداداته، ويعمل مع خادم Bot API المحلي)، ثم قراءة صفوفه تدريجياً (openpyxl بوضع read_only لملفات XLSX) وتحويلها حسب column_order،
+وحفظها في الصندوق الصادر على دفعات ثابتة الحجم ترسل كل منها في طلب values.append واحد.
+يتم تعديل رسالة تقدم واحدة طوال العملية بدلاً من إرسال رسالة لكل دفعة.
+مفاتيح الصفوف مشتقة من معرف الملف ورقم السطر، لذلك إعادة رفع نفس الملف لا تكرر الصفوف.
+"""
+import asyncio
+import csv
+import logging
+import os
+import tempfile
+import time
+from datetime import date, datetime
+
+import config
+from message_scheduler import BACKGROUND, NOTIFICATION, edit
+from outbox import outbox, DONE
+
+logger = logging.getLogger(__name__)
+
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
+
+SUPPORTED_EXTENSIONS = ('.csv', '.tsv', '.xlsx')
+CSV_SAMPLE_SIZE = 64 * 1024
+
+# يتم تعيينه عند إيقاف البوت لإنهاء عمليات الاستيراد الجارية
+_stopping = False
+
+
+def file_extension(file_name: str) -> str:
+    """امتداد الملف بأحرف صغيرة"""
+    return os.path.splitext(file_name or '')[1].lower()
+
+
+def check_document(document) -> str:
+    """التحقق من نوع الملف وحجمه. يرجع رسالة خطأ أو None"""
+    if file_extension(document.file_name) not in SUPPORTED_EXTENSIONS:
+        return "❌ نوع الملف غير مدعوم. الرجاء إرسال ملف CSV أو XLSX"
+    if file_extension(document.file_name) == '.xlsx' and load_workbook is None:
+        return "❌ استيراد ملفات XLSX غير متاح حالياً (مكتبة openpyxl غير مثبتة). الرجاء إرسال ملف CSV"
+    if document.file_size and document.file_size > config.IMPORT_MAX_FILE_SIZE:
+        return f"❌ حجم الملف أكبر من الحد المسموح ({config.IMPORT_MAX_FILE_SIZE // (1024 * 1024)} ميجابايت)"
+    return None
+
+
+def cell_text(value) -> str:
+    """تحويل قيمة خلية إلى نص بالصيغة التي تقبلها دوال التحليل"""
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        if value.hour == 0 and value.minute == 0:
+            return value.strftime('%Y-%m-%d')
+        return value.strftime('%Y-%m-%d %H:%M')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def iter_csv_rows(path: str):
+    """قراءة صفوف ملف CSV تدريجياً مع تحديد الترميز والفاصل تلقائياً"""
+    with open(path, 'rb') as f:
+        sample = f.read(CSV_SAMPLE_SIZE)
+    try:
+        sample.decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # العينة قد تنتهي في منتصف حرف؛ غير ذلك فالملف غالباً بترميز Windows العربي
+        encoding = 'utf-8-sig' if e.start >= len(sample) - 3 else 'cp1256'
+    with open(path, newline='', encoding=encoding, errors='replace') as f:
+        try:
+            dialect = csv.Sniffer().sniff(f.read(CSV_SAMPLE_SIZE), delimiters=',;\t|')
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        for row in csv.reader(f, dialect):
+            yield [cell.strip() for cell in row]
+
+
+def iter_xlsx_rows(path: str):
+    """قراءة صفوف أول ورقة في ملف XLSX تدريجياً دون تحميل الملف كاملاً"""
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield [cell_text(value) for value in row]
+    finally:
+        workbook.close()
+
+
+def iter_rows(path: str, extension: str):
+    """صفوف الملف حسب نوعه"""
+    if extension == '.xlsx':
+        return iter_xlsx_rows(path)
+    return iter_csv_rows(path)
+
+
+class RowMapper:
+    """تحويل صفوف الملف إلى صفوف الجدول: حسب سطر العناوين إن وجد، وإلا حسب ترتيب الأعمدة"""
+
+    def __init__(self, schema, first_row: list):
+        self.schema = schema
+        names = [value.strip() for value in first_row]
+        if any(name in schema.columns for name in names):
+            self.header = names
+            self.ignored = [name for name in names if name and name not in schema.columns]
+            missing = [
+                column for column in schema.required_columns
+                if column not in names and column not in schema.auto_columns
+            ]
+            if missing:
+                raise ValueError("❌ أعمدة إلزامية غير موجودة في الملف: " + "، ".join(missing))
+        else:
+            self.header = None
+            self.ignored = []
+
+    def map(self, values: list) -> tuple:
+        """تحويل صف من الملف. يرجع (الصف، قائمة الأخطاء)"""
+        if self.header is None:
+            values = list(values)
+            while values and not values[-1]:
+                values.pop()
+            return self.schema.parse_line(values)
+        raw = {
+            name: value for name, value in zip(self.header, values)
+            if name in self.schema.columns
+        }
+        return self.schema.parse_record(raw)
+
+
+class ProgressMessage:
+    """رسالة تقدم واحدة يتم تعديلها، مع حد أدنى للفاصل بين التعديلات"""
+
+    def __init__(self, message, interval: float = None):
+        self.message = message
+        self.interval = interval if interval is not None else config.IMPORT_PROGRESS_INTERVAL
+        self._last_text = None
+        self._last_edit = 0.0
+
+    def due(self) -> bool:
+        """هل مضى وقت كاف منذ آخر تعديل"""
+        return time.monotonic() - self._last_edit >= self.interval
+
+    async def update(self, text: str, force: bool = False):
+        """تعديل نص الرسالة إذا تغير ومضى الفاصل الزمني (أو إذا كان force)"""
+        if text == self._last_text or not (force or self.due()):
+            return
+        self._last_text = text
+        self._last_edit = time.monotonic()
+        try:
+            # التحديثات الدورية لا تنتظر الإرسال وتأتي بعد ردود المحادثات، والنهائية تنتظر
+            await edit(self.message, text, NOTIFICATION if force else BACKGROUND, wait=force)
+        except Exception as e:
+            logger.warning(f"تعذر تحديث رسالة التقدم: {str(e)}")
+
+
+async def download_to_disk(telegram_file, path: str, max_size: int = None) -> int:
+    """تحميل ملف Telegram إلى مسار على القرص عبر طلبات البوت. يرجع حجم الملف"""
+    max_size = max_size or config.IMPORT_MAX_FILE_SIZE
+    # حجم المستند المعلن تم التحقق منه في check_document، وهذا للملفات بدون حجم معلن
+    if telegram_file.file_size and telegram_file.file_size > max_size:
+        raise ValueError("❌ حجم الملف أكبر من الحد المسموح")
+    await telegram_file.download_to_drive(path, read_timeout=60.0)
+    size = os.path.getsize(path)
+    if size > max_size:
+        raise ValueError("❌ حجم الملف أكبر من الحد المسموح")
+    return size
+
+
+class DocumentImport:
+    """استيراد ملف واحد إلى جدول"""
+
+    def __init__(self, bot, document, schema, user_id: str, chat_id: str, progress_message):
+        self.bot = bot
+        self.document = document
+        self.schema = schema
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.progress = ProgressMessage(progress_message)
+        self.extension = file_extension(document.file_name)
+        # بادئة مفاتيح الصفوف والدفعات لهذا الملف في هذا الجدول
+        self.prefix = f"import:{document.file_unique_id}:{schema.sheet_key}:"
+        self.mapper = None
+        self.read = 0
+        self.queued = 0
+        self.duplicates = 0
+        self.error_count = 0
+        self.errors = []
+        self.chunks = 0
+        self.sent = 0
+        self.finished = False
+        self.truncated = False
+
+    def _add_error(self, line_no: int, messages: list):
+        self.error_count += 1
+        if len(self.errors) < config.BULK_MAX_ERRORS_SHOWN:
+            self.errors.append((line_no, "، ".join(messages)))
+
+    def _read_chunk(self, rows) -> list:
+        """قراءة وتحليل الدفعة التالية من الصفوف (يعمل في خيط منفصل)"""
+        chunk = []
+        for line_no, values in rows:
+            if not any(values):
+                continue
+            if self.mapper is None:
+                self.mapper = RowMapper(self.schema, values)
+                if self.mapper.header is not None:
+                    continue
+            if self.read >= config.IMPORT_MAX_ROWS:
+                self.truncated = True
+                self.finished = True
+                return chunk
+            self.read += 1
+            row, messages = self.mapper.map(values)
+            if messages:
+                self._add_error(line_no, messages)
+                continue
+            chunk.append((line_no, row))
+            if len(chunk) >= config.IMPORT_CHUNK_SIZE:
+                return chunk
+        self.finished = True
+        return chunk
+
+    async def _queue_rows(self, path: str):
+        """قراءة الملف دفعة بعد دفعة وحفظ كل دفعة في الصندوق الصادر"""
+        source = iter_rows(path, self.extension)
+        rows = enumerate(source, 1)
+        try:
+            await self._queue_chunks(rows)
+        finally:
+            source.close()
+
+    async def _queue_chunks(self, rows):
+        while not self.finished and not _stopping:
+            chunk = await asyncio.to_thread(self._read_chunk, rows)
+            if chunk:
+                # صفوف الدفعة تشترك في batch_key فترسل في طلب values.append واحد
+                batch_key = f"{self.prefix}chunk{self.chunks}"
+                inserted = await outbox.add_many([
+                    (f"{self.prefix}{line_no}", self.schema.sheet_key, self.schema.sheet_config,
+                     row, self.user_id, self.chat_id, batch_key)
+                    for line_no, row in chunk
+                ])
+                self.chunks += 1
+                self.queued += len(chunk)
+                self.duplicates += len(chunk) - inserted
+            if self.progress.due():
+                await self._refresh_sent()
+                await self.progress.update(self._progress_text())
+
+    async def _refresh_sent(self):
+        counts = await outbox.batch_counts(self.prefix)
+        self.sent = counts.get(DONE, 0)
+
+    async def _wait_sent(self) -> bool:
+        """متابعة إرسال الصفوف إلى الجدول. يرجع False إذا انتهت المهلة قبل إرسالها كلها"""
+        deadline = time.monotonic() + config.IMPORT_SEND_TIMEOUT
+        while not _stopping:
+            await self._refresh_sent()
+            if self.sent >= self.queued:
+                return True
+            if time.monotonic() > deadline:
+                return False
+            await self.progress.update(self._progress_text())
+            await asyncio.sleep(min(config.IMPORT_PROGRESS_INTERVAL, 1.0))
+        return False
+
+    def _progress_text(self) -> str:
+        return (
+            f"📤 جاري استيراد {self.document.file_name} إلى جدول {self.schema.sheet_key}...\n"
+            f"تمت قراءة {self.read} صف، منها {self.error_count} غير صالح\n"
+            f"تم إرسال {min(self.sent, self.queued)} من {self.queued} صف إلى الجدول"
+        )
+
+    def _summary(self, complete: bool) -> str:
+        lines = []
+        if complete:
+            lines.append(f"✅ تم استيراد {self.queued} صف إلى جدول {self.schema.sheet_key}.")
+        else:
+            lines.append(
+                f"⏳ تم حفظ {self.queued} صف وإرسال {min(self.sent, self.queued)} منها حتى الآن، "
+                f"وسيكتمل إرسال الباقي تلقائياً."
+            )
+        if self.duplicates:
+            lines.append(f"ℹ️ {self.duplicates} صف تم استيرادها مسبقاً من نفس الملف ولم تتكرر.")
+        if self.mapper is not None and self.mapper.ignored:
+            lines.append("ℹ️ أعمدة تم تجاهلها: " + "، ".join(self.mapper.ignored))
+        if self.truncated:
+            lines.append(f"⚠️ تم استيراد أول {config.IMPORT_MAX_ROWS} صف فقط.")
+        if self.error_count:
+            lines.append(f"❌ {self.error_count} سطر لم يتم استيراده:")
+            lines.extend(f"السطر {line_no}: {message}" for line_no, message in self.errors)
+            if self.error_count > len(self.errors):
+                lines.append(f"... و {self.error_count - len(self.errors)} أخطاء أخرى")
+        return "\n".join(lines)
+
+    async def run(self):
+        """تنفيذ الاستيراد كاملاً: التحميل ثم القراءة والحفظ ثم متابعة الإرسال"""
+        fd, path = tempfile.mkstemp(suffix=self.extension, dir=config.IMPORT_TMP_DIR)
+        os.close(fd)
+        started = time.perf_counter()
+        try:
+            await self.progress.update("📥 جاري تحميل الملف...", force=True)
+            telegram_file = await self.bot.get_file(self.document.file_id)
+            size = await download_to_disk(telegram_file, path)
+            logger.info(f"تم تحميل الملف {self.document.file_name} ({size} بايت) للاستيراد إلى {self.schema.sheet_key}")
+
+            await self.progress.update(self._progress_text(), force=True)
+            await self._queue_rows(path)
+            if _stopping and not self.finished:
+                await self.progress.update(
+                    f"⚠️ تم إيقاف الاستيراد بعد حفظ {self.queued} صف بسبب إيقاف البوت.\n"
+                    f"أعد إرسال نفس الملف لإكمال الاستيراد دون تكرار الصفوف المحفوظة.",
+                    force=True
+                )
+                return
+
+            complete = await self._wait_sent()
+            await self.progress.update(self._summary(complete), force=True)
+            logger.info(
+                f"استيراد {self.document.file_name}: {self.queued} صف في {self.chunks} دفعة، "
+                f"{self.error_count} خطأ، خلال {time.perf_counter() - started:.1f} ثانية"
+            )
+        except ValueError as e:
+            logger.warning(f"تعذر استيراد الملف {self.document.file_name}: {str(e)}")
+            await self.progress.update(str(e), force=True)
+        except Exception as e:
+            logger.error(f"خطأ في استيراد الملف {self.document.file_name}: {str(e)}", exc_info=True)
+            await self.progress.update(
+                "❌ حدث خطأ أثناء استيراد الملف.\n"
+                f"تم حفظ {self.queued} صف قبل الخطأ. أعد إرسال نفس الملف للمتابعة دون تكرارها.",
+                force=True
+            )
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def stop_imports():
+    """إنهاء عمليات الاستيراد الجارية عند إيقاف البوت (الصفوف المحفوظة تبقى في الصندوق الصادر)"""
+    global _stopping
+    _stopping = True
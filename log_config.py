@@ -0,0 +1,131 @@
+"""
+إعداد السجلات: JSON منظم، كتابة غير متزامنة، أخذ عينات، وتدوير الملفات.
+
+المعالجات تضيف السجلات إلى طابور عبر QueueHandler فقط، بينما يتولى QueueListener
+في خيط منفصل تنسيقها بصيغة JSON وكتابتها إلى الشاشة وإلى ملف يتم تدويره حسب الحجم،
+فلا تتم عمليات الكتابة في حلقة الأحداث.
+الأحداث المتكررة بكثرة تسجل مع extra=SAMPLED، ويمر منها سجل واحد فقط من كل
+LOG_SAMPLE_EVERY سجل لنفس السطر في الكود.
+البيانات الكبيرة (حالة المحادثة، القيم المدخلة) تسجل في مستوى DEBUG فقط وبمعاملات %s
+حتى لا يتم تنسيقها إلا إذا كان هذا المستوى مفعلاً.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from datetime import datetime, timezone
+
+import config
+
+# تمرر إلى logger.info(..., extra=SAMPLED) للأحداث المتكررة بكثرة
+SAMPLED = {'sample': True}
+
+# خصائص LogRecord القياسية التي لا تضاف كحقول إضافية في JSON
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """تنسيق السجل كسطر JSON واحد مع أي حقول إضافية مررت عبر extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key != 'sample':
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """تمرير سجل واحد من كل every سجل للأحداث المعلمة بـ SAMPLED (لكل سطر في الكود)"""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(every, 1)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'sample', False) or self.every == 1:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        if count % self.every:
+            return False
+        record.sampled_every = self.every
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler لا ينسق السجل في خيط المتصل، بل يدمج المعاملات في النص فقط"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # دمج المعاملات الآن لأن الكائنات المشار إليها قد تتغير قبل أن يكتبها خيط السجلات
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """تهيئة السجلات للعملية (مرة واحدة)"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    if config.LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if config.LOG_FILE:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            config.LOG_FILE,
+            maxBytes=config.LOG_MAX_BYTES,
+            backupCount=config.LOG_BACKUP_COUNT,
+            encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(config.LOG_SAMPLE_EVERY))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(config.LOG_LEVEL)
+    # سجلات مكتبة HTTP لكل طلب كثيرة جداً في مستوى INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """كتابة السجلات المتبقية في الطابور وإيقاف خيط السجلات"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
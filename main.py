@@ -1,107 +1,92 @@
-import json
 import logging
 import os
 import sys
 import asyncio
-from datetime import datetime
+import secrets
+import uuid
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler, ContextTypes
 import config
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import sheets_client
+from append_queue import append_queue
+from config_store import config_store
+from outbox import outbox, drainer
+from sheet_mirror import mirror
+import metrics
+from metrics import loop_lag, track_handler
+from message_scheduler import edit, edit_by_id, reply_document, respond, scheduler
+from update_processor import update_processor
+import document_import
+from report import reports, group_options
+from search_index import search_index
+from rate_limiter import limiter
+from log_config import SAMPLED, setup_logging, stop_logging
+from profiler import deep_size, memory_tracker, profiler
 
-# إعداد السجلات
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 # حالات المحادثة
-CHOOSING_SHEET, ENTERING_DATA = range(2)
+CHOOSING_SHEET, ENTERING_DATA, BULK_ENTRY = range(3)
 
-async def load_sheets_config() -> dict:
-    """تحميل إعدادات الجداول من الملف"""
-    try:
-        with open('sheets_config.json', 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            if not isinstance(config, dict):
-                logger.error("خطأ: ملف التكوين ليس بالتنسيق الصحيح")
-                raise ValueError("ملف التكوين غير صالح: يجب أن يكون عبارة عن كائن JSON")
-            return config
-    except FileNotFoundError:
-        logger.error("خطأ: ملف sheets_config.json غير موجود")
-        raise FileNotFoundError("لم يتم العثور على ملف التكوين. الرجاء التأكد من وجود ملف sheets_config.json")
-    except json.JSONDecodeError as e:
-        logger.error(f"خطأ في تنسيق JSON: {str(e)}")
-        raise ValueError("خطأ في تنسيق ملف التكوين. الرجاء التأكد من صحة تنسيق JSON")
-    except Exception as e:
-        logger.error(f"خطأ غير متوقع في تحميل الإعدادات: {str(e)}")
-        raise Exception("حدث خطأ غير متوقع أثناء تحميل ملف التكوين")
+STALE_SHEET_MSG = (
+    "⚠️ تم تعديل إعدادات هذا الجدول أثناء إدخال البيانات.\n"
+    "الرجاء استخدام /start للبدء من جديد."
+)
 
-async def get_sheets_client():
-    """إنشاء اتصال Google Sheets"""
-    try:
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
-        return gspread.authorize(creds)
-    except FileNotFoundError:
-        logger.error("خطأ: ملف credentials.json غير موجود")
-        raise FileNotFoundError("لم يتم العثور على ملف التوثيق. الرجاء التأكد من وجود ملف credentials.json")
-    except Exception as e:
-        logger.error(f"خطأ في الاتصال بـ Google Sheets: {str(e)}")
-        raise Exception("فشل الاتصال بخدمة Google Sheets. تأكد من صحة ملف التوثيق وصلاحيته")
-
-def get_user_accessible_sheets(user_id: str, sheets_config: dict) -> dict:
-    """الحصول على الجداول المتاحة للمستخدم"""
-    accessible_sheets = {}
-    for sheet_name, sheet_data in sheets_config.items():
-        # التحقق من authorized_user_id الرئيسي
-        if str(user_id) == str(sheet_data.get('authorized_user_id', '')):
-            accessible_sheets[sheet_name] = sheet_data
-            continue
-            
-        # التحقق من قائمة authorized_user_ids
-        if str(user_id) in map(str, sheet_data.get('authorized_user_ids', [])):
-            accessible_sheets[sheet_name] = sheet_data
-    return accessible_sheets
+def get_user_accessible_sheets(user_id: str, snapshot=None) -> dict:
+    """الحصول على الجداول المتاحة للمستخدم من فهرس الصلاحيات"""
+    snapshot = snapshot or config_store.get()
+    return snapshot.accessible_sheets(user_id)
+
+def get_current_schema(context: ContextTypes.DEFAULT_TYPE) -> tuple:
+    """مخطط الجدول الحالي من النسخة المشتركة، مع التحقق من أن إعداداته لم تتغير منذ اختياره.
+
+    يرجع (schema, stale): إذا كانت stale صحيحة فقد عدلت إعدادات الجدول أو حذف.
+    """
+    sheet_key = context.user_data.get('current_sheet_key')
+    if not sheet_key:
+        return None, False
+    schema = config_store.get().get_schema(sheet_key, context.user_data.get('sheet_version'))
+    if schema is None:
+        logger.warning(f"إعدادات الجدول {sheet_key} تغيرت منذ بدء الإدخال")
+        return None, True
+    return schema, False
 
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """بداية المحادثة وعرض الجداول المتاحة"""
     try:
         # تسجيل معلومات المستخدم
         user_id = str(update.effective_user.id)
-        logger.info(f"بدء محادثة جديدة من المستخدم: {user_id}")
+        logger.info("بدء محادثة جديدة من المستخدم: %s", user_id, extra=SAMPLED)
         
         # تحميل الإعدادات
-        logger.info("جاري تحميل ملف الإعدادات...")
-        sheets_config = await load_sheets_config()
-        logger.info(f"تم تحميل الإعدادات: {sheets_config}")
+        logger.debug("جاري تحميل ملف الإعدادات...")
+        snapshot = config_store.get()
+        logger.debug("تم تحميل الإعدادات: الإصدار %s", snapshot.version)
         
         # الحصول على الجداول المتاحة للمستخدم
-        logger.info(f"التحقق من صلاحيات المستخدم {user_id}")
-        accessible_sheets = get_user_accessible_sheets(user_id, sheets_config)
-        logger.info(f"الجداول المتاحة: {accessible_sheets}")
+        logger.debug("التحقق من صلاحيات المستخدم %s", user_id)
+        accessible_sheets = get_user_accessible_sheets(user_id, snapshot)
+        logger.debug("الجداول المتاحة: %s", list(accessible_sheets))
         
         if not accessible_sheets:
             logger.warning(f"المستخدم {user_id} ليس لديه صلاحية الوصول لأي جدول")
-            await update.message.reply_text(
+            await respond(
+                update,
                 "⚠️ عذراً، ليس لديك صلاحية الوصول لأي جدول.\n"
                 "الرجاء التواصل مع المسؤول للحصول على الصلاحيات اللازمة."
             )
             return ConversationHandler.END
         
-        # حفظ معلومات الجداول في سياق المحادثة
-        context.user_data['sheets_config'] = sheets_config
-        context.user_data['accessible_sheets'] = accessible_sheets
-        
         # إنشاء أزرار للجداول المتاحة
         keyboard = []
         for sheet_name in accessible_sheets:
             keyboard.append([InlineKeyboardButton(sheet_name, callback_data=f"sheet_{sheet_name}")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(
+        await respond(
+            update,
             "👋 مرحباً! الرجاء اختيار الجدول:",
             reply_markup=reply_markup
         )
@@ -109,21 +94,24 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         logger.error(f"خطأ في start: {str(e)}", exc_info=True)
-        await update.message.reply_text(
+        await respond(
+            update,
             "❌ عذراً، حدث خطأ غير متوقع.\n"
             "الرجاء المحاولة مرة أخرى لاحقاً."
         )
         return ConversationHandler.END
 
+@track_handler
 async def show_all_sheets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """عرض كافة الجداول المتاحة"""
     try:
         query = update.callback_query
         await query.answer()
         
-        accessible_sheets = context.user_data.get('accessible_sheets', {})
+        accessible_sheets = get_user_accessible_sheets(str(update.effective_user.id))
         if not accessible_sheets:
-            await query.edit_message_text(
+            await respond(
+                query,
                 "❌ عذراً، لم يتم العثور على معلومات الجداول.\n"
                 "الرجاء استخدام /start مرة أخرى."
             )
@@ -133,7 +121,8 @@ async def show_all_sheets(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     for sheet_name in accessible_sheets.keys()]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(
+        await respond(
+            query,
             "🔍 الجداول المتاحة لك:\n"
             "اختر الجدول الذي تريد إدخال البيانات فيه:",
             reply_markup=reply_markup
@@ -143,61 +132,48 @@ async def show_all_sheets(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         logger.error(f"خطأ في عرض كافة الجداول: {str(e)}", exc_info=True)
-        await query.edit_message_text(
+        await respond(
+            query,
             "❌ عذراً، حدث خطأ أثناء عرض الجداول.\n"
             "الرجاء المحاولة مرة أخرى."
         )
         return ConversationHandler.END
 
+@track_handler
 async def handle_sheet_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة اختيار الجدول وبدء إدخال البيانات"""
     try:
         query = update.callback_query
         await query.answer()
         
-        logger.info(f"معالجة اختيار الجدول. البيانات المستلمة: {query.data}")
+        logger.debug("معالجة اختيار الجدول. البيانات المستلمة: %s", query.data)
         
         sheet_name = query.data.replace("sheet_", "")
-        logger.info(f"اسم الجدول المختار: {sheet_name}")
+        logger.info("اسم الجدول المختار: %s", sheet_name, extra=SAMPLED)
         
-        if 'accessible_sheets' not in context.user_data:
-            error_msg = "❌ لم يتم العثور على معلومات الجداول. الرجاء استخدام /start للبدء من جديد."
-            logger.error(f"لم يتم العثور على accessible_sheets في user_data")
-            await query.edit_message_text(error_msg)
-            return ConversationHandler.END
-            
-        sheet_config = context.user_data['accessible_sheets'].get(sheet_name)
-        logger.info(f"تكوين الجدول: {sheet_config}")
+        snapshot = config_store.get()
+        schema = None
+        if sheet_name in snapshot.sheets_for_user(update.effective_user.id):
+            schema = snapshot.get_schema(sheet_name)
         
-        if not sheet_config:
+        if not schema:
             error_msg = "❌ حدث خطأ في اختيار الجدول. الرجاء المحاولة مرة أخرى."
             logger.error(f"لم يتم العثور على تكوين الجدول: {sheet_name}")
-            await query.edit_message_text(error_msg)
+            await respond(query, error_msg)
             return ConversationHandler.END
         
-        # حفظ معلومات الجدول المختار
-        context.user_data['current_sheet'] = sheet_config
-        context.user_data['current_data'] = {}
+        # حفظ مفتاح الجدول المختار وإصداره فقط
+        context.user_data['current_sheet_key'] = sheet_name
+        context.user_data['sheet_version'] = snapshot.sheet_versions[sheet_name]
+        context.user_data['entry_id'] = uuid.uuid4().hex  # مفتاح فريد يمنع تكرار الصف عند إعادة الإرسال
         context.user_data['last_used_sheet'] = sheet_name  # حفظ آخر جدول تم استخدامه
         
-        # إضافة التاريخ تلقائياً إذا كان مطلوباً
-        if ('التاريخ' in sheet_config['column_types'] and 
-            'date_options' in sheet_config and 
-            'التاريخ' in sheet_config['date_options'] and 
-            sheet_config['date_options']['التاريخ'].get('auto', False)):
-            current_date = datetime.now().strftime('%Y-%m-%d')
-            context.user_data['current_data']['التاريخ'] = current_date
-            logger.info(f"تم إضافة التاريخ تلقائياً: {current_date}")
-        
-        # تحضير قائمة الأعمدة المتبقية مع تجاهل التاريخ التلقائي
-        remaining_columns = []
-        for col in sheet_config['column_order']:
-            if col == 'التاريخ' and context.user_data['current_data'].get('التاريخ'):
-                continue
-            remaining_columns.append(col)
-        
-        context.user_data['remaining_columns'] = remaining_columns
-        logger.info(f"الأعمدة المتبقية: {remaining_columns}")
+        # إضافة قيم الأعمدة التلقائية (مثل التاريخ) واستبعادها من الأعمدة المطلوب إدخالها
+        context.user_data['current_data'] = schema.initial_data()
+        if context.user_data['current_data']:
+            logger.debug("تمت إضافة القيم التلقائية: %s", context.user_data['current_data'])
+        context.user_data['remaining_columns'] = list(schema.prompt_order)
+        logger.debug("الأعمدة المتبقية: %s", context.user_data['remaining_columns'])
         
         # بدء عملية إدخال البيانات
         return await request_next_column(query, context)
@@ -207,44 +183,75 @@ async def handle_sheet_choice(update: Update, context: ContextTypes.DEFAULT_TYPE
         try:
             error_msg = "❌ حدث خطأ غير متوقع. الرجاء المحاولة مرة أخرى."
             if query:
-                await query.edit_message_text(error_msg)
+                await respond(query, error_msg)
             else:
-                await update.message.reply_text(error_msg)
+                await respond(update, error_msg)
         except Exception as e2:
             logger.error(f"خطأ في إرسال رسالة الخطأ: {e2}")
         return ConversationHandler.END
 
-async def request_next_column(update_or_query, context: ContextTypes.DEFAULT_TYPE):
+def entry_card_text(schema, context: ContextTypes.DEFAULT_TYPE, prompt: str = None, error: str = None) -> str:
+    """نص بطاقة الإدخال: القيم المدخلة حتى الآن والعمود الحالي والمطلوب من المستخدم"""
+    data = context.user_data.get('current_data', {})
+    remaining = context.user_data.get('remaining_columns', [])
+    current = remaining[0] if remaining else None
+    lines = [f"📝 {schema.sheet_key}", ""]
+    for column in schema.column_order:
+        if column in data:
+            lines.append(f"✅ {column}: {data[column]}")
+        elif column == current:
+            lines.append(f"👉 {column}")
+        elif column in remaining:
+            lines.append(f"▫️ {column}" + (" (اختياري)" if schema.is_optional(column) else ""))
+        else:
+            lines.append(f"⏭️ {column}")
+    if error:
+        lines.extend(["", error])
+    if prompt:
+        lines.extend(["", prompt])
+    return "\n".join(lines)
+
+async def show_entry_card(update_or_query, context: ContextTypes.DEFAULT_TYPE, text: str, reply_markup=None):
+    """تعديل بطاقة الإدخال الحالية في مكانها، أو إرسال بطاقة جديدة إذا تعذر تعديلها"""
+    if isinstance(update_or_query, CallbackQuery) and update_or_query.message is not None:
+        # الرسالة التي ضغط المستخدم على زرها تصبح البطاقة
+        context.user_data['entry_card'] = (update_or_query.message.chat_id, update_or_query.message.message_id)
+    card = context.user_data.get('entry_card')
+    if card is not None:
+        try:
+            await edit_by_id(context.bot, card[0], card[1], text, reply_markup=reply_markup)
+            return
+        except Exception as e:
+            logger.warning(f"تعذر تعديل بطاقة الإدخال، سيتم إرسال بطاقة جديدة: {str(e)}")
+    message = update_or_query.message if isinstance(update_or_query, CallbackQuery) else update_or_query.effective_message
+    card_message = await respond(message, text, reply_markup=reply_markup)
+    context.user_data['entry_card'] = (card_message.chat_id, card_message.message_id)
+
+async def request_next_column(update_or_query, context: ContextTypes.DEFAULT_TYPE, error: str = None):
     """طلب إدخال العمود التالي"""
     try:
-        logger.info("بدء طلب العمود التالي...")
-        logger.info(f"حالة المحادثة: {context.user_data}")
+        logger.debug("بدء طلب العمود التالي...")
+        # حالة المحادثة كاملة تنسق فقط عند تفعيل مستوى DEBUG
+        logger.debug("حالة المحادثة: %s", context.user_data)
         
         if 'remaining_columns' not in context.user_data or not context.user_data['remaining_columns']:
             logger.error("لم يتم العثور على remaining_columns")
             error_msg = "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(error_msg)
-            else:
-                await update_or_query.edit_message_text(error_msg)
+            await respond(update_or_query, error_msg)
             return ConversationHandler.END
 
         current_column = context.user_data['remaining_columns'][0]
-        logger.info(f"العمود الحالي: {current_column}")
+        logger.debug("العمود الحالي: %s", current_column)
         
-        sheet_config = context.user_data.get('current_sheet')
-        if not sheet_config:
-            logger.error("لم يتم العثور على current_sheet")
-            error_msg = "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(error_msg)
-            else:
-                await update_or_query.edit_message_text(error_msg)
+        schema, stale = get_current_schema(context)
+        if not schema:
+            logger.error("لم يتم العثور على الجدول الحالي")
+            error_msg = STALE_SHEET_MSG if stale else "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
+            await respond(update_or_query, error_msg)
             return ConversationHandler.END
         
         # التحقق مما إذا كان العمود اختياري
-        optional_columns = sheet_config.get('optional_columns', [])
-        is_optional = current_column in optional_columns
+        is_optional = schema.is_optional(current_column)
         
         # إنشاء زر التخطي إذا كان العمود اختياري
         keyboard = []
@@ -253,70 +260,80 @@ async def request_next_column(update_or_query, context: ContextTypes.DEFAULT_TYP
             
         reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
         
-        # إرسال رسالة طلب إدخال القيمة
+        # تعديل بطاقة الإدخال بطلب القيمة التالية بدلاً من إرسال رسالة جديدة لكل عمود
         message = f"الرجاء إدخال قيمة {current_column}"
         if is_optional:
             message += "\nأرسل /skip للتخطي"
+        if len(schema.prompt_order) > 1 and len(context.user_data['remaining_columns']) == len(schema.prompt_order):
+            message += "\n\n💡 أو أدخل جميع القيم في رسالة واحدة:\n" + " | ".join(schema.prompt_order)
+            message += "\nأو أرسل /bulk لإدخال عدة صفوف دفعة واحدة، أو ملف CSV/XLSX لاستيراده"
             
-        if hasattr(update_or_query, 'message'):
-            await update_or_query.message.reply_text(message, reply_markup=reply_markup)
-        else:
-            await update_or_query.edit_message_text(message, reply_markup=reply_markup)
+        await show_entry_card(
+            update_or_query, context, entry_card_text(schema, context, message, error), reply_markup=reply_markup
+        )
             
         context.user_data['CURRENT_STATE'] = ENTERING_DATA
-        logger.info(f"تم تعيين الحالة إلى ENTERING_DATA")
+        logger.debug("تم تعيين الحالة إلى ENTERING_DATA")
         return ENTERING_DATA
         
     except Exception as e:
         logger.error(f"خطأ في request_next_column: {str(e)}", exc_info=True)
         error_msg = "❌ حدث خطأ غير متوقع. الرجاء المحاولة مرة أخرى باستخدام /start"
-        if hasattr(update_or_query, 'message'):
-            await update_or_query.message.reply_text(error_msg)
-        else:
-            await update_or_query.edit_message_text(error_msg)
+        await respond(update_or_query, error_msg)
         return ConversationHandler.END
 
+@track_handler
 async def handle_data_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة البيانات المدخلة من المستخدم"""
     try:
         if not context.user_data.get('remaining_columns'):
             logger.error("لم يتم العثور على remaining_columns")
-            await update.message.reply_text(
+            await respond(
+                update,
                 "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
             )
             return ConversationHandler.END
 
         current_column = context.user_data['remaining_columns'][0]
-        sheet_config = context.user_data.get('current_sheet')
+        schema, stale = get_current_schema(context)
         
-        if not sheet_config:
-            logger.error("لم يتم العثور على current_sheet")
-            await update.message.reply_text(
+        if not schema:
+            logger.error("لم يتم العثور على الجدول الحالي")
+            await respond(
+                update,
+                STALE_SHEET_MSG if stale else
                 "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
             )
             return ConversationHandler.END
 
         # التعامل مع أمر التخطي
         if update.message.text == '/skip':
-            if current_column not in sheet_config.get('optional_columns', []):
-                await update.message.reply_text("❌ لا يمكن تخطي هذا الحقل لأنه إلزامي")
-                return ENTERING_DATA
+            if not schema.is_optional(current_column):
+                return await request_next_column(update, context, error="❌ لا يمكن تخطي هذا الحقل لأنه إلزامي")
             context.user_data['remaining_columns'].pop(0)
             if not context.user_data['remaining_columns']:
                 return await save_data_to_sheet(update, context)
             return await request_next_column(update, context)
 
-        # حفظ القيمة المدخلة
-        input_value = update.message.text.strip()
-        column_type = sheet_config.get('column_types', {}).get(current_column)
-
-        # التحقق من نوع البيانات
-        if column_type == 'number':
+        # إدخال عدة أعمدة في رسالة واحدة (قيم مفصولة بـ | أو سطور عمود=قيمة)
+        # عند أول حقل فقط، حتى لا تستبدل القيم التي أدخلها المستخدم ويقبل | داخل النص بعدها
+        entered = [
+            column for column in context.user_data.get('current_data', {})
+            if column not in schema.auto_columns
+        ]
+        if not entered:
             try:
-                float(input_value)
-            except ValueError:
-                await update.message.reply_text("❌ الرجاء إدخال رقم صحيح")
-                return ENTERING_DATA
+                structured = schema.split_structured(update.message.text)
+            except ValueError as e:
+                return await request_next_column(update, context, error=str(e))
+            if structured is not None:
+                return await handle_structured_input(update, context, schema, structured)
+
+        # التحقق من نوع البيانات وتحويلها إلى الصيغة الموحدة
+        try:
+            input_value = schema.parse(current_column, update.message.text)
+        except ValueError as e:
+            return await request_next_column(update, context, error=str(e))
 
         # حفظ القيمة وإزالة العمود من القائمة
         context.user_data.setdefault('current_data', {})
@@ -332,32 +349,178 @@ async def handle_data_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     except Exception as e:
         logger.error(f"خطأ في handle_data_input: {str(e)}", exc_info=True)
-        await update.message.reply_text(
+        await respond(
+            update,
             "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
         )
         return ConversationHandler.END
 
+async def handle_structured_input(update: Update, context: ContextTypes.DEFAULT_TYPE, schema, raw: dict):
+    """تعبئة عدة أعمدة من رسالة واحدة والحفظ مباشرة، مع طلب الحقول التي فشل تحليلها فقط"""
+    values, errors = schema.parse_values(raw)
+    logger.info("إدخال منظم: %d قيمة صحيحة، %d خطأ", len(values), len(errors), extra=SAMPLED)
+    
+    context.user_data.setdefault('current_data', {}).update(values)
+    # الأعمدة الاختيارية غير المذكورة تعتبر متخطاة، والإلزامية غير المذكورة تطلب لاحقاً
+    context.user_data['remaining_columns'] = [
+        column for column in context.user_data['remaining_columns']
+        if column in errors or (column not in raw and not schema.is_optional(column))
+    ]
+    
+    if not context.user_data['remaining_columns']:
+        return await save_data_to_sheet(update, context)
+    # أخطاء التحليل تظهر في بطاقة الإدخال مع طلب أول حقل لم يكتمل
+    error = "\n".join(f"{column}: {message}" for column, message in errors.items()) if errors else None
+    return await request_next_column(update, context, error=error)
+
+@track_handler
+async def start_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """بدء الإدخال الجماعي: كل سطر في الرسالة التالية صف كامل"""
+    try:
+        schema, stale = get_current_schema(context)
+        if not schema:
+            await respond(
+                update,
+                STALE_SHEET_MSG if stale else "❌ الرجاء اختيار جدول أولاً باستخدام /start"
+            )
+            return ConversationHandler.END
+        
+        # إذا كتبت الأسطر في نفس رسالة الأمر تتم معالجتها مباشرة
+        _, _, text = update.message.text.partition('\n')
+        if text.strip():
+            return await save_bulk_rows(update, context, text)
+        
+        await respond(
+            update,
+            f"📋 إدخال جماعي في جدول {schema.sheet_key}\n"
+            f"أرسل الصفوف في رسالة واحدة، كل سطر صف، والقيم مفصولة بـ | أو فاصلة أو Tab بالترتيب:\n"
+            f"{' | '.join(schema.prompt_order)}\n"
+            f"الحد الأقصى {config.BULK_MAX_ROWS} سطر. استخدم /cancel للإلغاء."
+        )
+        return BULK_ENTRY
+        
+    except Exception as e:
+        logger.error(f"خطأ في start_bulk: {str(e)}", exc_info=True)
+        await respond(
+            update,
+            "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
+        )
+        return ConversationHandler.END
+
+@track_handler
+async def handle_bulk_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """رسالة الإدخال الجماعي بعد أمر /bulk"""
+    return await save_bulk_rows(update, context, update.message.text)
+
+async def save_bulk_rows(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """تحليل أسطر الإدخال الجماعي وحفظ الأسطر الصحيحة كدفعة واحدة"""
+    try:
+        schema, stale = get_current_schema(context)
+        if not schema:
+            await respond(
+                update,
+                STALE_SHEET_MSG if stale else "❌ الرجاء اختيار جدول أولاً باستخدام /start"
+            )
+            return ConversationHandler.END
+        
+        rows, errors = schema.parse_bulk(text, config.BULK_MAX_ROWS)
+        logger.info("إدخال جماعي في %s: %d سطر صحيح، %d خطأ", schema.sheet_key, len(rows), len(errors))
+        
+        if rows:
+            # مفتاح كل سطر مشتق من الرسالة لمنع التكرار عند إعادة معالجتها،
+            # ومفتاح الدفعة المشترك يجعل الأسطر ترسل في طلب values.append واحد
+            chat_id = str(update.message.chat_id)
+            batch_key = f"bulk:{chat_id}:{update.message.message_id}"
+            user_id = str(update.effective_user.id)
+            await outbox.add_many([
+                (f"{batch_key}:{line_no}", schema.sheet_key, schema.sheet_config, row, user_id, chat_id, batch_key)
+                for line_no, row in rows
+            ])
+        
+        lines = [f"✅ تم حفظ {len(rows)} صف."]
+        if errors:
+            lines.append(f"❌ {len(errors)} سطر لم يتم حفظه:")
+            shown = errors[:config.BULK_MAX_ERRORS_SHOWN]
+            lines.extend(f"السطر {line_no}: {message}" for line_no, message in shown)
+            if len(errors) > len(shown):
+                lines.append(f"... و {len(errors) - len(shown)} أخطاء أخرى")
+        lines.append("استخدم /start للبدء من جديد.")
+        await respond(update, "\n".join(lines))
+        return ConversationHandler.END
+        
+    except Exception as e:
+        logger.error(f"خطأ في save_bulk_rows: {str(e)}", exc_info=True)
+        await respond(
+            update,
+            "❌ حدث خطأ أثناء إضافة البيانات للجدول\n"
+            "الرجاء المحاولة مرة أخرى."
+        )
+        return ConversationHandler.END
+
+@track_handler
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """استيراد ملف CSV أو XLSX إلى الجدول المختار في الخلفية"""
+    try:
+        schema, stale = get_current_schema(context)
+        if not schema:
+            await respond(
+                update,
+                STALE_SHEET_MSG if stale else "❌ الرجاء اختيار جدول أولاً باستخدام /start"
+            )
+            return ConversationHandler.END
+        
+        document = update.message.document
+        error_msg = document_import.check_document(document)
+        if error_msg:
+            await respond(update, error_msg)
+            return ENTERING_DATA
+        
+        logger.info("استيراد الملف %s (%s بايت) إلى الجدول %s", document.file_name, document.file_size, schema.sheet_key)
+        progress_message = await respond(update, "📥 جاري تحميل الملف...")
+        job = document_import.DocumentImport(
+            context.bot,
+            document,
+            schema,
+            str(update.effective_user.id),
+            str(update.message.chat_id),
+            progress_message
+        )
+        # الاستيراد قد يستغرق وقتاً طويلاً، لذلك يعمل كمهمة منفصلة حتى لا يوقف باقي التحديثات
+        context.application.create_task(job.run(), update=update)
+        return ConversationHandler.END
+        
+    except Exception as e:
+        logger.error(f"خطأ في handle_document: {str(e)}", exc_info=True)
+        await respond(
+            update,
+            "❌ حدث خطأ أثناء استيراد الملف. الرجاء المحاولة مرة أخرى باستخدام /start"
+        )
+        return ConversationHandler.END
+
+@track_handler
 async def handle_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة أمر التخطي"""
     try:
         if not context.user_data.get('remaining_columns'):
-            await update.message.reply_text(
+            await respond(
+                update,
                 "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
             )
             return ConversationHandler.END
 
         current_column = context.user_data['remaining_columns'][0]
-        sheet_config = context.user_data.get('current_sheet')
+        schema, stale = get_current_schema(context)
         
-        if not sheet_config:
-            await update.message.reply_text(
+        if not schema:
+            await respond(
+                update,
+                STALE_SHEET_MSG if stale else
                 "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
             )
             return ConversationHandler.END
 
-        if current_column not in sheet_config.get('optional_columns', []):
-            await update.message.reply_text("❌ لا يمكن تخطي هذا الحقل لأنه إلزامي")
-            return ENTERING_DATA
+        if not schema.is_optional(current_column):
+            return await request_next_column(update, context, error="❌ لا يمكن تخطي هذا الحقل لأنه إلزامي")
 
         # تخطي العمود الحالي
         context.user_data['remaining_columns'].pop(0)
@@ -371,11 +534,13 @@ async def handle_skip(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     except Exception as e:
         logger.error(f"خطأ في handle_skip: {str(e)}", exc_info=True)
-        await update.message.reply_text(
+        await respond(
+            update,
             "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
         )
         return ConversationHandler.END
 
+@track_handler
 async def handle_skip_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة الضغط على زر التخطي"""
     try:
@@ -383,23 +548,25 @@ async def handle_skip_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer()
 
         if not context.user_data.get('remaining_columns'):
-            await query.edit_message_text(
+            await respond(
+                query,
                 "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
             )
             return ConversationHandler.END
 
         current_column = context.user_data['remaining_columns'][0]
-        sheet_config = context.user_data.get('current_sheet')
+        schema, stale = get_current_schema(context)
         
-        if not sheet_config:
-            await query.edit_message_text(
+        if not schema:
+            await respond(
+                query,
+                STALE_SHEET_MSG if stale else
                 "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
             )
             return ConversationHandler.END
 
-        if current_column not in sheet_config.get('optional_columns', []):
-            await query.edit_message_text("❌ لا يمكن تخطي هذا الحقل لأنه إلزامي")
-            return ENTERING_DATA
+        if not schema.is_optional(current_column):
+            return await request_next_column(query, context, error="❌ لا يمكن تخطي هذا الحقل لأنه إلزامي")
 
         # تخطي العمود الحالي
         context.user_data['remaining_columns'].pop(0)
@@ -414,7 +581,8 @@ async def handle_skip_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except Exception as e:
         logger.error(f"خطأ في handle_skip_button: {str(e)}", exc_info=True)
         if query:
-            await query.edit_message_text(
+            await respond(
+                query,
                 "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
             )
         return ConversationHandler.END
@@ -422,110 +590,58 @@ async def handle_skip_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def save_data_to_sheet(update_or_query, context):
     """حفظ البيانات في Google Sheets"""
     try:
-        sheet_config = context.user_data['current_sheet']
+        schema, stale = get_current_schema(context)
         data = context.user_data['current_data']
         
-        logger.info(f"محاولة حفظ البيانات: {data}")
-        logger.info(f"إعدادات الجدول: {sheet_config}")
+        if not schema:
+            error_msg = STALE_SHEET_MSG if stale else "❌ حدث خطأ في إدخال البيانات. الرجاء المحاولة مرة أخرى باستخدام /start"
+            await respond(update_or_query, error_msg)
+            return ConversationHandler.END
+        
+        logger.debug("محاولة حفظ البيانات: %s", data)
+        logger.debug("الجدول: %s", schema.sheet_key)
         
         # التحقق من وجود جميع الأعمدة المطلوبة
-        missing_columns = []
-        for col in sheet_config.get('required_columns', []):
-            if not data.get(col):
-                missing_columns.append(col)
+        missing_columns = schema.missing_required(data)
         
         if missing_columns:
             error_msg = "❌ لم يتم إدخال جميع الأعمدة المطلوبة:\n" + "\n".join(missing_columns)
             logger.error(error_msg)
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(error_msg)
-            else:
-                await update_or_query.edit_message_text(error_msg)
-            return ConversationHandler.END
-        
-        # الاتصال بـ Google Sheets
-        try:
-            logger.info("جاري الاتصال بـ Google Sheets...")
-            client = await get_sheets_client()
-            logger.info("تم الاتصال بنجاح")
-        except Exception as e:
-            error_msg = (
-                "❌ فشل الاتصال بخدمة Google Sheets\n"
-                "تأكد من صحة ملف التوثيق وصلاحيته.\n"
-                "الرجاء التواصل مع المسؤول."
-            )
-            logger.error(f"خطأ في الاتصال: {str(e)}", exc_info=True)
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(error_msg)
-            else:
-                await update_or_query.edit_message_text(error_msg)
-            return ConversationHandler.END
-        
-        try:
-            logger.info(f"محاولة فتح الجدول: {sheet_config['sheet_name']}")
-            sheet = client.open(sheet_config['sheet_name']).worksheet(sheet_config['worksheet_name'])
-            logger.info("تم فتح الجدول بنجاح")
-        except gspread.exceptions.SpreadsheetNotFound:
-            error_msg = (
-                "❌ لم يتم العثور على الجدول المطلوب\n"
-                "تأكد من وجود الجدول وصلاحيات الوصول إليه."
-            )
-            logger.error(error_msg)
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(error_msg)
-            else:
-                await update_or_query.edit_message_text(error_msg)
-            return ConversationHandler.END
-        except gspread.exceptions.WorksheetNotFound:
-            error_msg = (
-                "❌ لم يتم العثور على ورقة العمل المطلوبة\n"
-                "تأكد من وجود ورقة العمل في الجدول."
-            )
-            logger.error(error_msg)
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(error_msg)
-            else:
-                await update_or_query.edit_message_text(error_msg)
-            return ConversationHandler.END
-        except gspread.exceptions.APIError as e:
-            error_msg = (
-                f"❌ خطأ في الاتصال بـ Google Sheets: {str(e)}\n"
-                "قد تكون هناك مشكلة في الصلاحيات أو حد الاستخدام."
-            )
-            logger.error(f"خطأ في API: {str(e)}")
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(error_msg)
-            else:
-                await update_or_query.edit_message_text(error_msg)
+            await respond(update_or_query, error_msg)
             return ConversationHandler.END
         
         # تحضير البيانات للإضافة
-        logger.info("تحضير البيانات للإضافة...")
-        row_data = [data.get(col, '') for col in sheet_config['column_order']]
-        logger.info(f"البيانات المراد إضافتها: {row_data}")
+        logger.debug("تحضير البيانات للإضافة...")
+        row_data = schema.build_row(data)
+        logger.debug("البيانات المراد إضافتها: %s", row_data)
         
-        # إضافة البيانات
+        # حفظ الصف في الصندوق الصادر المحلي، ويتولى OutboxDrainer إرساله إلى Google Sheets
         try:
-            sheet.append_row(row_data)
-            logger.info("تم إضافة البيانات بنجاح")
+            entry_id = context.user_data.get('entry_id') or uuid.uuid4().hex
+            user = getattr(update_or_query, 'effective_user', None) or getattr(update_or_query, 'from_user', None)
+            await outbox.add(
+                entry_id,
+                schema.sheet_key,
+                schema.sheet_config,
+                row_data,
+                user_id=str(user.id) if user else None,
+                chat_id=str(update_or_query.message.chat_id) if update_or_query.message else None
+            )
+            logger.info("تم حفظ البيانات محلياً بالمفتاح: %s", entry_id, extra=SAMPLED)
             success_msg = (
                 "✅ تم حفظ البيانات بنجاح!\n"
                 "استخدم /start للبدء من جديد."
             )
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(success_msg)
-            else:
-                await update_or_query.edit_message_text(success_msg)
+            # البطاقة النهائية تعرض القيم المحفوظة
+            await show_entry_card(update_or_query, context, entry_card_text(schema, context, success_msg))
+            context.user_data.pop('entry_card', None)
         except Exception as e:
             error_msg = (
                 "❌ حدث خطأ أثناء إضافة البيانات للجدول\n"
                 "الرجاء المحاولة مرة أخرى."
             )
             logger.error(f"خطأ في إضافة البيانات: {str(e)}", exc_info=True)
-            if hasattr(update_or_query, 'message'):
-                await update_or_query.message.reply_text(error_msg)
-            else:
-                await update_or_query.edit_message_text(error_msg)
+            await respond(update_or_query, error_msg)
             return ConversationHandler.END
         
         return ConversationHandler.END
@@ -536,20 +652,272 @@ async def save_data_to_sheet(update_or_query, context):
             "الرجاء المحاولة مرة أخرى أو التواصل مع المسؤول."
         )
         logger.error(f"خطأ غير متوقع: {str(e)}", exc_info=True)
-        if hasattr(update_or_query, 'message'):
-            await update_or_query.message.reply_text(error_msg)
-        else:
-            await update_or_query.edit_message_text(error_msg)
+        await respond(update_or_query, error_msg)
         return ConversationHandler.END
 
+def report_keyboard(schema) -> InlineKeyboardMarkup:
+    """أزرار أنواع التجميع المتاحة لجدول"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=f"report_{group}")]
+        for group, label in group_options(schema)
+    ])
+
+@track_handler
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر /report: اختيار الجدول ثم نوع التجميع"""
+    try:
+        user_id = str(update.effective_user.id)
+        snapshot = config_store.get()
+        sheets = [
+            key for key in get_user_accessible_sheets(user_id, snapshot)
+            if group_options(snapshot.get_schema(key))
+        ]
+        if not sheets:
+            await respond(update, "⚠️ لا توجد جداول تحتوي على أعمدة رقمية متاحة لك.")
+            return
+        
+        if len(sheets) == 1:
+            context.user_data['report_sheet_key'] = sheets[0]
+            context.user_data['report_sheet_version'] = snapshot.sheet_versions[sheets[0]]
+            await respond(
+                update,
+                f"📊 تقرير جدول {sheets[0]}\nاختر نوع التجميع:",
+                reply_markup=report_keyboard(snapshot.get_schema(sheets[0]))
+            )
+            return
+        
+        keyboard = [[InlineKeyboardButton(key, callback_data=f"report_sheet_{key}")] for key in sheets]
+        await respond(
+            update,
+            "📊 اختر الجدول للتقرير:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        
+    except Exception as e:
+        logger.error(f"خطأ في report_command: {str(e)}", exc_info=True)
+        await respond(update, "❌ حدث خطأ أثناء إعداد التقرير. الرجاء المحاولة مرة أخرى.")
+
+@track_handler
+async def handle_report_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالجة اختيار جدول التقرير"""
+    query = update.callback_query
+    try:
+        await query.answer()
+        sheet_key = query.data[len('report_sheet_'):]
+        snapshot = config_store.get()
+        schema = snapshot.get_schema(sheet_key)
+        if sheet_key not in snapshot.sheets_for_user(update.effective_user.id) or schema is None:
+            await respond(query, "⚠️ عذراً، ليس لديك صلاحية الوصول لهذا الجدول.")
+            return
+        
+        context.user_data['report_sheet_key'] = sheet_key
+        context.user_data['report_sheet_version'] = snapshot.sheet_versions[sheet_key]
+        await respond(
+            query,
+            f"📊 تقرير جدول {sheet_key}\nاختر نوع التجميع:",
+            reply_markup=report_keyboard(schema)
+        )
+        
+    except Exception as e:
+        logger.error(f"خطأ في handle_report_sheet: {str(e)}", exc_info=True)
+        await respond(query, "❌ حدث خطأ أثناء إعداد التقرير. الرجاء المحاولة مرة أخرى.")
+
+@track_handler
+async def handle_report_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إنشاء التقرير حسب نوع التجميع المختار"""
+    query = update.callback_query
+    try:
+        await query.answer()
+        group = query.data[len('report_'):]
+        sheet_key = context.user_data.get('report_sheet_key')
+        snapshot = config_store.get()
+        schema = snapshot.get_schema(sheet_key, context.user_data.get('report_sheet_version')) if sheet_key else None
+        if schema is None or sheet_key not in snapshot.sheets_for_user(update.effective_user.id):
+            await respond(query, "⚠️ تم تعديل إعدادات الجدول. الرجاء استخدام /report من جديد.")
+            return
+        if group not in dict(group_options(schema)):
+            await respond(query, "❌ نوع تجميع غير صالح. الرجاء استخدام /report من جديد.")
+            return
+        
+        await respond(query, "⏳ جاري إعداد التقرير...")
+        text = await reports.build(schema, context.user_data['report_sheet_version'], group)
+        await respond(query, text, reply_markup=report_keyboard(schema))
+        
+    except ValueError as e:
+        await respond(query, str(e))
+    except Exception as e:
+        logger.error(f"خطأ في handle_report_group: {str(e)}", exc_info=True)
+        await respond(query, "❌ حدث خطأ أثناء إعداد التقرير. الرجاء المحاولة مرة أخرى.")
+
+async def render_find_page(search: dict, results: list, page: int) -> tuple:
+    """نص صفحة من نتائج البحث وأزرار التنقل"""
+    pages = max(1, -(-len(results) // config.FIND_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * config.FIND_PAGE_SIZE
+    shown = results[start:start + config.FIND_PAGE_SIZE]
+    
+    rows = {}
+    for sheet_key in dict.fromkeys(sheet_key for sheet_key, _ in shown):
+        numbers = [row_number for key, row_number in shown if key == sheet_key]
+        rows[sheet_key] = await mirror.get_rows(sheet_key, numbers)
+    
+    lines = [f"🔍 نتائج البحث عن: {search['query']} ({len(results)} نتيجة)", ""]
+    for position, (sheet_key, row_number) in enumerate(shown, start + 1):
+        values = rows[sheet_key].get(row_number, [])
+        summary = " | ".join(value for value in values if value)
+        if len(summary) > 200:
+            summary = summary[:200] + "…"
+        lines.append(f"{position}. {sheet_key} - الصف {row_number}:\n{summary}")
+    
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ السابق", callback_data=f"find_{search['id']}_{page - 1}"))
+    if pages > 1:
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"find_{search['id']}_{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("التالي ▶️", callback_data=f"find_{search['id']}_{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+@track_handler
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر /find: البحث في الأعمدة النصية للجداول المتاحة"""
+    try:
+        text = " ".join(context.args or []).strip()
+        if not text:
+            await respond(update, "الرجاء كتابة نص البحث بعد الأمر، مثال:\n/find فندق")
+            return
+        
+        user_id = str(update.effective_user.id)
+        snapshot = config_store.get()
+        schemas = [
+            (snapshot.get_schema(key), snapshot.sheet_versions[key])
+            for key in get_user_accessible_sheets(user_id, snapshot)
+            if snapshot.get_schema(key) is not None
+        ]
+        if not schemas:
+            await respond(update, "⚠️ عذراً، ليس لديك صلاحية الوصول لأي جدول.")
+            return
+        
+        message = await respond(update, "🔍 جاري البحث...")
+        results = await search_index.search(schemas, text, config.FIND_MAX_RESULTS)
+        logger.info("بحث المستخدم %s: %d نتيجة", user_id, len(results), extra=SAMPLED)
+        if not results:
+            await edit(message, f"لم يتم العثور على نتائج لـ: {text}")
+            return
+        
+        # النتائج في ذاكرة البحث المشتركة، و user_data يحفظ معرف البحث ونصه فقط.
+        # معرف البحث في أزرار التنقل حتى لا تتصفح أزرار بحث قديم نتائج بحث أحدث
+        previous = context.user_data.get('find')
+        if previous:
+            search_index.drop_results(user_id, previous['id'])
+        search = {'id': search_index.save_results(user_id, results), 'query': text}
+        context.user_data['find'] = search
+        page_text, reply_markup = await render_find_page(search, results, 0)
+        await edit(message, page_text, reply_markup=reply_markup)
+        
+    except Exception as e:
+        logger.error(f"خطأ في find_command: {str(e)}", exc_info=True)
+        await respond(update, "❌ حدث خطأ أثناء البحث. الرجاء المحاولة مرة أخرى.")
+
+@track_handler
+async def handle_find_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """التنقل بين صفحات نتائج البحث"""
+    query = update.callback_query
+    try:
+        await query.answer()
+        search_id, page = (int(part) for part in query.data[len('find_'):].split('_'))
+        search = context.user_data.get('find')
+        results = None
+        if search and search['id'] == search_id:
+            results = search_index.get_results(str(update.effective_user.id), search_id)
+        if not results:
+            await respond(query, "⚠️ انتهت صلاحية نتائج هذا البحث. الرجاء استخدام /find من جديد.")
+            return
+        
+        page_text, reply_markup = await render_find_page(search, results, page)
+        if page_text != query.message.text:
+            await respond(query, page_text, reply_markup=reply_markup)
+        
+    except Exception as e:
+        logger.error(f"خطأ في handle_find_page: {str(e)}", exc_info=True)
+        await respond(query, "❌ حدث خطأ أثناء عرض النتائج. الرجاء استخدام /find من جديد.")
+
+def is_admin(update: Update) -> bool:
+    """هل المرسل هو المسؤول (ADMIN_USER_ID)"""
+    return update.effective_user is not None and str(update.effective_user.id) == config.ADMIN_USER_ID
+
+@track_handler
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر /profile start|stop للمسؤول: تحليل الأداء بأخذ العينات أثناء التشغيل"""
+    if not is_admin(update):
+        await respond(update, "⚠️ هذا الأمر متاح للمسؤول فقط.")
+        return
+    try:
+        action = (context.args or [''])[0].lower()
+        if action == 'start':
+            if not profiler.start():
+                await respond(update, "⚠️ تحليل الأداء يعمل بالفعل. أرسل /profile stop لإيقافه.")
+                return
+            await respond(
+                update,
+                f"▶️ بدأ تحليل الأداء (عينة كل {profiler.interval * 1000:.0f} مللي ثانية).\n"
+                f"أرسل /profile stop للحصول على النتيجة. يتوقف تلقائياً بعد {profiler.max_seconds:.0f} ثانية."
+            )
+        elif action == 'stop':
+            if not profiler.stop():
+                await respond(update, "⚠️ تحليل الأداء لا يعمل. أرسل /profile start لبدئه.")
+                return
+            summary = profiler.summary()
+            collapsed = await asyncio.to_thread(profiler.collapsed)
+            await reply_document(
+                update.effective_message,
+                collapsed.encode('utf-8'),
+                f"profile-{int(profiler.started_at)}.collapsed.txt",
+                caption=summary[:1024]
+            )
+        else:
+            await respond(update, "الاستخدام: /profile start أو /profile stop")
+    except Exception as e:
+        logger.error(f"خطأ في profile_command: {str(e)}", exc_info=True)
+        await respond(update, "❌ حدث خطأ أثناء تحليل الأداء.")
+
+@track_handler
+async def memsnap_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر /memsnap للمسؤول: لقطة ذاكرة tracemalloc مع المقارنة باللقطة السابقة"""
+    if not is_admin(update):
+        await respond(update, "⚠️ هذا الأمر متاح للمسؤول فقط.")
+        return
+    try:
+        if (context.args or [''])[0].lower() == 'stop':
+            stopped = memory_tracker.stop()
+            await respond(update, "⏹ تم إيقاف tracemalloc." if stopped else "⚠️ tracemalloc لا يعمل.")
+            return
+        started = memory_tracker.start()
+        # حجم user_data يقاس هنا في حلقة الأحداث لأنها التي تعدله، والقطة نفسها في خيط منفصل
+        user_sizes = {user_id: deep_size(data) for user_id, data in context.application.user_data.items()}
+        summary, report_text = await asyncio.to_thread(memory_tracker.report, user_sizes)
+        if started:
+            summary += "\n\nℹ️ تم تشغيل tracemalloc الآن، أرسل /memsnap لاحقاً لمقارنة الذاكرة بهذه اللقطة."
+        await reply_document(
+            update.effective_message,
+            report_text.encode('utf-8'),
+            f"memsnap-{memory_tracker.snapshots}.txt",
+            caption=summary[:1024]
+        )
+    except Exception as e:
+        logger.error(f"خطأ في memsnap_command: {str(e)}", exc_info=True)
+        await respond(update, "❌ حدث خطأ أثناء أخذ لقطة الذاكرة.")
+
+@track_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إلغاء العملية الحالية"""
-    await update.message.reply_text("تم إلغاء العملية. استخدم /start للبدء من جديد.")
+    await respond(update, "تم إلغاء العملية. استخدم /start للبدء من جديد.")
     return ConversationHandler.END
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """معالجة الأخطاء العامة في البوت"""
     logger.error("حدث خطأ أثناء معالجة التحديث:", exc_info=context.error)
+    metrics.update_errors.inc(exception=type(context.error).__name__)
     
     try:
         # جمع معلومات الخطأ
@@ -562,59 +930,142 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         
         # إرسال رسالة للمستخدم
         if update and hasattr(update, 'effective_message'):
-            await update.effective_message.reply_text(
+            await respond(
+                update,
                 "⚠️ عذراً، حدث خطأ أثناء معالجة طلبك.\n"
                 "تم تسجيل الخطأ وسيتم إصلاحه قريباً."
             )
     except Exception as e:
         logger.error(f"خطأ في معالج الأخطاء: {e}")
 
+# أنواع التحديثات التي تعالجها المعالجات المسجلة فقط، حتى لا يرسل Telegram غيرها
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+async def start_receiving(application: Application):
+    """بدء استقبال التحديثات عبر webhook أو الاستطلاع (polling) حسب الإعدادات"""
+    if config.TELEGRAM_UPDATE_MODE != 'webhook':
+        await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        logger.info("يتم استقبال التحديثات عبر الاستطلاع (polling)")
+        return
+
+    if not config.WEBHOOK_URL:
+        raise ValueError("يجب تحديد WEBHOOK_URL عند استخدام وضع webhook")
+    # رمز سري جديد في كل تشغيل إذا لم يحدد، يتحقق منه الخادم في كل طلب وارد
+    secret_token = config.WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+    webhook_url = f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}"
+    await application.updater.start_webhook(
+        listen=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        url_path=config.WEBHOOK_PATH,
+        cert=config.WEBHOOK_CERT or None,
+        key=config.WEBHOOK_KEY or None,
+        webhook_url=webhook_url,
+        allowed_updates=ALLOWED_UPDATES,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        secret_token=secret_token
+    )
+    logger.info(f"يتم استقبال التحديثات عبر webhook على {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}/{config.WEBHOOK_PATH}")
+
+async def stop_receiving(application: Application):
+    """إيقاف استقبال التحديثات وإلغاء تسجيل webhook"""
+    if application.updater.running:
+        await application.updater.stop()
+    if config.TELEGRAM_UPDATE_MODE == 'webhook':
+        try:
+            # التحديثات الجديدة تبقى لدى Telegram حتى التشغيل التالي
+            await application.bot.delete_webhook()
+            logger.info("تم إلغاء تسجيل webhook")
+        except Exception as e:
+            logger.warning(f"تعذر إلغاء تسجيل webhook: {str(e)}")
+
+def build_application(token: str = None, request=None) -> Application:
+    """إنشاء التطبيق وتسجيل جميع المعالجات"""
+    # إنشاء التطبيق: التحديثات تعالج بالتوازي بين المحادثات وبالترتيب داخل كل محادثة
+    builder = Application.builder().token(token or config.TELEGRAM_TOKEN).concurrent_updates(update_processor)
+    if request is not None:
+        # اتصال بديل بـ Bot API بدون استقبال تحديثات (يستخدم في اختبار الأداء)
+        builder = builder.request(request).updater(None)
+    application = builder.build()
+    
+    # إضافة معالج المحادثة
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('start', start)],
+        states={
+            CHOOSING_SHEET: [
+                CallbackQueryHandler(handle_sheet_choice, pattern='^sheet_.*$'),
+                CallbackQueryHandler(show_all_sheets, pattern='^show_all_sheets$')
+            ],
+            ENTERING_DATA: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_data_input),
+                MessageHandler(filters.Document.ALL, handle_document),
+                CommandHandler('skip', handle_skip),
+                CallbackQueryHandler(handle_skip_button, pattern='^skip$'),
+                CommandHandler('bulk', start_bulk),
+                CommandHandler('cancel', cancel)
+            ],
+            BULK_ENTRY: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_bulk_input),
+                CommandHandler('cancel', cancel)
+            ]
+        },
+        fallbacks=[
+            CommandHandler('cancel', cancel),
+            MessageHandler(filters.COMMAND, cancel)
+        ],
+        per_message=False
+    )
+    
+    # التقارير والبحث متاحة في أي وقت، لذلك تسجل قبل معالج المحادثة
+    application.add_handler(CommandHandler('report', report_command))
+    application.add_handler(CallbackQueryHandler(handle_report_sheet, pattern='^report_sheet_'))
+    application.add_handler(CallbackQueryHandler(handle_report_group, pattern='^report_'))
+    application.add_handler(CommandHandler('find', find_command))
+    application.add_handler(CallbackQueryHandler(handle_find_page, pattern=r'^find_\d+_\d+$'))
+    application.add_handler(CommandHandler('profile', profile_command))
+    application.add_handler(CommandHandler('memsnap', memsnap_command))
+    application.add_handler(conv_handler)
+    application.add_error_handler(error_handler)
+    return application
+
 async def main():
     """تشغيل البوت"""
+    metrics_server = None
     try:
-        # إعداد السجلات
-        logging.basicConfig(
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            level=logging.INFO
-        )
+        # إعداد السجلات (تكتب في خيط منفصل)
+        setup_logging()
         logger.info("بدء تشغيل البوت...")
         
-        # تحميل إعدادات الجداول
-        await load_sheets_config()
-        
-        # إنشاء التطبيق
-        application = Application.builder().token(config.TELEGRAM_TOKEN).build()
-        
-        # إضافة معالج المحادثة
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('start', start)],
-            states={
-                CHOOSING_SHEET: [
-                    CallbackQueryHandler(handle_sheet_choice, pattern='^sheet_.*$'),
-                    CallbackQueryHandler(show_all_sheets, pattern='^show_all_sheets$')
-                ],
-                ENTERING_DATA: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_data_input),
-                    CommandHandler('skip', handle_skip),
-                    CallbackQueryHandler(handle_skip_button, pattern='^skip$'),
-                    CommandHandler('cancel', cancel)
-                ]
-            },
-            fallbacks=[
-                CommandHandler('cancel', cancel),
-                MessageHandler(filters.COMMAND, cancel)
-            ],
-            per_message=False
-        )
+        # تحميل إعدادات الجداول ومراقبة تعديلها
+        config_store.start()
         
-        application.add_handler(conv_handler)
-        application.add_error_handler(error_handler)
+        application = build_application()
         
         # بدء البوت
         logger.info("جاري بدء البوت...")
         await application.initialize()
         await application.start()
-        await application.updater.start_polling()
+        await start_receiving(application)
+        await drainer.start()
+        await mirror.start()
+        loop_lag.start()
+        # مسار /metrics المحلي مع إحصائيات المكونات الرئيسية.
+        # مكونات حلقة الأحداث تقرأ داخل الحلقة كلقطات دورية، ومكونات Sheets المحمية بأقفال مباشرة
+        metrics.loop_stats.register('bot', update_processor.stats)
+        metrics.loop_stats.register('bot', scheduler.stats)
+        metrics.loop_stats.register('sheets_append', append_queue.stats)
+        # الصفوف المعلقة في الصندوق الصادر هي أهم مؤشر على تأخر الإرسال إلى Google Sheets
+        metrics.loop_stats.register('sheets', outbox.stats)
+        metrics.loop_stats.register('sheets', drainer.stats)
+        metrics.loop_stats.register('sheets', mirror.stats)
+        metrics.loop_stats.register('bot', reports.stats)
+        metrics.loop_stats.register('bot', search_index.stats)
+        metrics.loop_stats.start()
+        metrics.registry.register_stats('sheets', sheets_client.pool.stats)
+        # عدادات كل حساب خدمة: الطلبات وأخطاء الحصة وتجديد الرمز وإعادة استخدام الاتصالات
+        metrics.registry.register_stats('sheets_account', sheets_client.pool.account_stats, label='account')
+        metrics.registry.register_stats('sheets_rate_limit', limiter.stats)
+        metrics.registry.register_stats('sheets_rate_limit', limiter.bucket_stats, label='bucket')
+        metrics_server = metrics.start_http_server()
         
         # الانتظار إلى ما لا نهاية
         stop_signal = asyncio.Event()
@@ -625,8 +1076,23 @@ async def main():
         sys.exit(1)
     finally:
         # إيقاف البوت
-        await application.updater.stop()
+        document_import.stop_imports()
+        profiler.stop()
+        await loop_lag.stop()
+        await metrics.loop_stats.stop()
+        # إيقاف استقبال التحديثات قبل إغلاق الصندوق الصادر حتى تحفظ التحديثات الجارية
+        await stop_receiving(application)
         await application.stop()
+        await scheduler.stop()
+        await mirror.stop()
+        await drainer.stop()
+        await append_queue.flush_all()
+        await outbox.close()
+        await mirror.close()
+        config_store.stop()
+        sheets_client.shutdown()
+        if metrics_server is not None:
+            metrics_server.shutdown()
 
 if __name__ == '__main__':
     # تشغيل البوت
@@ -642,3 +1108,4 @@ if __name__ == '__main__':
         logger.error(f"خطأ غير متوقع: {str(e)}", exc_info=True)
     finally:
         loop.close()
+        stop_logging()
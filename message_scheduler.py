@@ -0,0 +1,319 @@
+"""
+جدولة الرسائل الصادرة إلى Telegram حسب حدود الإرسال.
+
+جميع رسائل البوت وتعديلاتها تمر عبر طابور واحد بثلاث أولويات: ردود المحادثة أولاً،
+ثم الإشعارات، ثم تحديثات التقدم في الخلفية. يتم الإرسال بمعدل لا يتجاوز الحد العام
+(حوالي 30 رسالة في الثانية) وحد كل محادثة، مع طلب واحد فقط جارٍ لكل محادثة حتى تصل
+رسائلها بالترتيب. التعديلات المتتالية لنفس الرسالة التي لم ترسل بعد تدمج في تعديل
+واحد بآخر نص. عند رد RetryAfter يتم إيقاف المحادثة المدة المطلوبة وإعادة الطلب.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram import CallbackQuery, Update
+from telegram.error import BadRequest, RetryAfter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# أولويات الطابور
+INTERACTIVE = 0
+NOTIFICATION = 1
+BACKGROUND = 2
+
+
+class _Bucket:
+    """دلو رموز بسيط لحلقة الأحداث"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """المدة حتى يتوفر رمز"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        """هل امتلأ الدلو ولا يوجد إيقاف (يمكن حذفه)"""
+        return self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('chat_id', 'priority', 'factory', 'future', 'edit_key', 'attempts', 'queued_at')
+
+    def __init__(self, chat_id, priority: int, factory, future, edit_key):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.factory = factory
+        self.future = future
+        self.edit_key = edit_key
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+
+class MessageScheduler:
+    """طابور الرسائل الصادرة مع حدود الإرسال العامة ولكل محادثة"""
+
+    def __init__(self):
+        self._global = _Bucket(config.TELEGRAM_GLOBAL_RATE, config.TELEGRAM_GLOBAL_BURST)
+        self._chats = {}  # chat_id -> _Bucket
+        self._lanes = [deque(), deque(), deque()]
+        self._edits = {}  # (chat_id, message_id) -> تعديل في الطابور لم يرسل بعد
+        self._busy = set()  # محادثات لديها طلب جارٍ
+        self._sending = set()
+        self._wakeup = None
+        self._task = None
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.retry_after = 0
+        self.max_depth = 0
+        self.max_queue_wait = 0.0
+
+    def _chat_bucket(self, chat_id) -> _Bucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # المجموعات لها حد أقل من المحادثات الخاصة (20 رسالة في الدقيقة)
+            rate = config.TELEGRAM_CHAT_RATE if not str(chat_id).startswith('-') else config.TELEGRAM_GROUP_RATE
+            bucket = _Bucket(rate, config.TELEGRAM_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, chat_id, factory, priority: int = INTERACTIVE, edit_key=None) -> asyncio.Future:
+        """إضافة طلب إلى الطابور. factory دالة ترجع coroutine الطلب.
+
+        إذا كان هناك تعديل لنفس الرسالة (edit_key) لم يرسل بعد، يتم استبدال نصه
+        ويرجع نفس Future.
+        """
+        self._ensure_running()
+        if edit_key is not None:
+            pending = self._edits.get(edit_key)
+            if pending is not None:
+                pending.factory = factory
+                if priority < pending.priority:
+                    self._lanes[pending.priority].remove(pending)
+                    pending.priority = priority
+                    self._lanes[priority].append(pending)
+                self.coalesced += 1
+                return pending.future
+        job = _Job(chat_id, priority, factory, asyncio.get_running_loop().create_future(), edit_key)
+        if edit_key is not None:
+            self._edits[edit_key] = job
+        self._lanes[priority].append(job)
+        self.max_depth = max(self.max_depth, self.depth())
+        self._wakeup.set()
+        return job.future
+
+    def _next_job(self, now: float) -> tuple:
+        """أول طلب يمكن إرساله الآن حسب الأولوية. يرجع (الطلب، مدة الانتظار إن لم يوجد)"""
+        wait = self._global.delay(now)
+        if wait > 0:
+            return None, wait
+        wait = None
+        for lane in self._lanes:
+            for index, job in enumerate(lane):
+                if job.chat_id in self._busy:
+                    continue
+                chat_wait = self._chat_bucket(job.chat_id).delay(now)
+                if chat_wait > 0:
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                    continue
+                del lane[index]
+                return job, None
+        return None, wait
+
+    async def _run(self):
+        """حلقة الإرسال"""
+        while True:
+            job, wait = self._next_job(time.monotonic())
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if job.edit_key is not None and self._edits.get(job.edit_key) is job:
+                del self._edits[job.edit_key]
+            self._global.take()
+            self._chat_bucket(job.chat_id).take()
+            self._busy.add(job.chat_id)
+            task = asyncio.get_running_loop().create_task(self._send(job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, job: _Job):
+        """تنفيذ طلب واحد وإعادة جدولته عند RetryAfter"""
+        self.max_queue_wait = max(self.max_queue_wait, time.monotonic() - job.queued_at)
+        try:
+            result = await job.factory()
+        except RetryAfter as e:
+            self.retry_after += 1
+            job.attempts += 1
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+            bucket = self._chat_bucket(job.chat_id)
+            bucket.paused_until = max(bucket.paused_until, time.monotonic() + delay)
+            if job.attempts > config.TELEGRAM_MAX_RETRIES:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                logger.warning(f"تجاوز حد الإرسال في المحادثة {job.chat_id}، إعادة المحاولة بعد {delay:.1f} ثانية")
+                # يعود إلى بداية طابوره حتى لا تسبقه رسائل المحادثة التالية
+                self._lanes[job.priority].appendleft(job)
+                if job.edit_key is not None and job.edit_key not in self._edits:
+                    self._edits[job.edit_key] = job
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._busy.discard(job.chat_id)
+            now = time.monotonic()
+            bucket = self._chats.get(job.chat_id)
+            if bucket is not None and job.chat_id not in self._busy and bucket.idle(now):
+                del self._chats[job.chat_id]
+            self._wakeup.set()
+
+    def depth(self) -> int:
+        """عدد الطلبات المنتظرة في الطابور"""
+        return sum(len(lane) for lane in self._lanes)
+
+    async def stop(self, timeout: float = None):
+        """إرسال الطلبات المتبقية (بحد أقصى timeout ثانية) ثم إيقاف حلقة الإرسال"""
+        if self._task is None:
+            return
+        timeout = timeout if timeout is not None else config.TELEGRAM_DRAIN_TIMEOUT
+        deadline = time.monotonic() + timeout
+        while (self.depth() or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for lane in self._lanes:
+            while lane:
+                job = lane.popleft()
+                if not job.future.done():
+                    job.future.cancel()
+        self._edits.clear()
+
+    def stats(self) -> dict:
+        """إحصائيات الطابور"""
+        return {
+            'outbound_depth': self.depth(),
+            'outbound_depth_by_priority': [len(lane) for lane in self._lanes],
+            'outbound_depth_max': self.max_depth,
+            'outbound_in_flight': len(self._sending),
+            'outbound_sent': self.sent,
+            'outbound_failed': self.failed,
+            'outbound_coalesced_edits': self.coalesced,
+            'outbound_retry_after': self.retry_after,
+            'outbound_queue_wait_max_ms': round(self.max_queue_wait * 1000, 2)
+        }
+
+
+scheduler = MessageScheduler()
+
+
+def _log_failure(future: asyncio.Future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None and 'not modified' not in str(error).lower():
+        logger.warning(f"تعذر إرسال رسالة في الخلفية: {str(error)}")
+
+
+async def _wait(future: asyncio.Future, wait: bool):
+    if not wait:
+        future.add_done_callback(_log_failure)
+        return None
+    # shield حتى لا يلغي إلغاء أحد المنتظرين تعديلاً مدمجاً ينتظره آخرون
+    return await asyncio.shield(future)
+
+
+async def reply(message, text: str, priority: int = INTERACTIVE, wait: bool = True, **kwargs):
+    """إرسال رسالة ردّاً على message عبر الطابور"""
+    future = scheduler.submit(message.chat_id, lambda: message.reply_text(text, **kwargs), priority)
+    return await _wait(future, wait)
+
+
+async def reply_document(message, document, filename: str, priority: int = NOTIFICATION, wait: bool = True, **kwargs):
+    """إرسال ملف ردّاً على message عبر الطابور"""
+    future = scheduler.submit(
+        message.chat_id,
+        lambda: message.reply_document(document=document, filename=filename, **kwargs),
+        priority
+    )
+    return await _wait(future, wait)
+
+
+async def _edit(chat_id, message_id, factory, priority: int, wait: bool):
+    future = scheduler.submit(chat_id, factory, priority, edit_key=(chat_id, message_id))
+    try:
+        return await _wait(future, wait)
+    except BadRequest as e:
+        # التعديل بنفس النص الحالي ليس خطأ
+        if 'not modified' in str(e).lower():
+            return None
+        raise
+
+
+async def edit(message, text: str, priority: int = INTERACTIVE, wait: bool = True, **kwargs):
+    """تعديل نص رسالة عبر الطابور، مع دمج التعديلات المتتالية لنفس الرسالة"""
+    return await _edit(
+        message.chat_id, message.message_id, lambda: message.edit_text(text, **kwargs), priority, wait
+    )
+
+
+async def edit_by_id(bot, chat_id, message_id: int, text: str, priority: int = INTERACTIVE,
+                     wait: bool = True, **kwargs):
+    """تعديل نص رسالة محفوظ معرفها فقط عبر الطابور"""
+    return await _edit(
+        chat_id,
+        message_id,
+        lambda: bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs),
+        priority,
+        wait
+    )
+
+
+async def respond(update_or_query, text: str, priority: int = INTERACTIVE, **kwargs):
+    """الرد على تحديث: تعديل رسالة الأزرار عند الضغط على زر، أو رسالة جديدة عند رسالة نصية"""
+    if isinstance(update_or_query, CallbackQuery):
+        if update_or_query.message is not None:
+            return await edit(update_or_query.message, text, priority, **kwargs)
+        # رسالة الزر غير متوفرة (رسالة قديمة أو inline)، فالمفتاح هو المستخدم الذي ضغط الزر
+        query = update_or_query
+        future = scheduler.submit(
+            query.from_user.id,
+            lambda: query.edit_message_text(text, **kwargs),
+            priority,
+            edit_key=(query.from_user.id, query.inline_message_id or query.id)
+        )
+        return await _wait(future, True)
+    message = update_or_query.effective_message if isinstance(update_or_query, Update) else update_or_query
+    return await reply(message, text, priority, **kwargs)
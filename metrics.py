@@ -0,0 +1,412 @@
+"""
+مقاييس أداء البوت.
+
+LoopLagMonitor يقيس تأخر حلقة الأحداث: مهمة تنام لفترة ثابتة وتسجل الفرق
+بين وقت الاستيقاظ المتوقع والفعلي. أي استدعاء متزامن يعطل الحلقة يظهر هنا مباشرة.
+
+العدادات (Counter) والمقاييس اللحظية (Gauge) والتوزيعات (Histogram) تسجل في سجل
+مشترك آمن للاستخدام من عدة خيوط، وتعرض بصيغة Prometheus النصية عبر /metrics من خادم
+HTTP محلي صغير (start_http_server) أو من أي تطبيق ويب عبر render().
+
+إحصائيات المكونات التي تملكها حلقة الأحداث (قواميس تعدلها الحلقة فقط) لا تقرأ من خيط
+خادم المقاييس، بل يجمعها StatsSnapshots داخل الحلقة بشكل دوري ويعرض الخادم آخر لقطة.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels_text(names: tuple, values: tuple, extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """أساس المقاييس: قيمة لكل مجموعة قيم للتسميات (labels)"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _samples(self) -> list:
+        with self._lock:
+            return [(self.name, key, '', value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_labels_text(self.labelnames, key, extra)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """عداد تصاعدي"""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """قيمة لحظية يمكن أن تزيد أو تنقص"""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """توزيع القيم على فئات (buckets) مع المجموع والعدد"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self) -> list:
+        samples = []
+        with self._lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", key, f'le="{_number(bound)}"', cumulative))
+            samples.append((f"{self.name}_sum", key, '', total))
+            samples.append((f"{self.name}_count", key, '', count))
+        return samples
+
+
+class Registry:
+    """سجل المقاييس ودوال الإحصائيات الإضافية"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_stats(self, prefix: str, stats_func, label: str = None):
+        """إضافة دالة stats() ترجع قاموساً، تعرض قيمه الرقمية كمقاييس لحظية.
+
+        إذا حدد label فإن الدالة ترجع {قيمة التسمية: قاموس إحصائيات}، مثل إحصائيات كل حساب خدمة.
+        """
+        with self._lock:
+            self._collectors.append((prefix, stats_func, label))
+
+    def _collected(self) -> list:
+        samples = {}  # اسم المقياس -> أسطر القيم، حتى يكتب سطر TYPE مرة واحدة لكل اسم
+        for prefix, stats_func, label in list(self._collectors):
+            try:
+                stats = stats_func()
+            except Exception as e:
+                logger.warning(f"تعذر جمع إحصائيات {prefix}: {str(e)}")
+                continue
+            groups = stats.items() if label else [(None, stats)]
+            for label_value, group in groups:
+                if not isinstance(group, dict):
+                    continue
+                labels = _labels_text((label,), (label_value,)) if label else ''
+                for key, value in group.items():
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        continue
+                    name = f"{prefix}_{key}"
+                    samples.setdefault(name, []).append(f"{name}{labels} {_number(value)}")
+        lines = []
+        for name, values in samples.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(values)
+        return lines
+
+    def render(self) -> str:
+        """جميع المقاييس بصيغة Prometheus النصية"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        lines.extend(self._collected())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# مقاييس المعالجات
+handler_latency = registry.histogram(
+    'bot_handler_duration_seconds', 'Handler callback latency', ('handler',)
+)
+handler_errors = registry.counter(
+    'bot_handler_errors_total', 'Exceptions raised by handler callbacks', ('handler', 'exception')
+)
+handlers_in_flight = registry.gauge(
+    'bot_handlers_in_flight', 'Handler callbacks currently running', ('handler',)
+)
+update_errors = registry.counter(
+    'bot_update_errors_total', 'Errors reported to the application error handler', ('exception',)
+)
+
+# مقاييس طلبات Google Sheets
+sheets_latency = registry.histogram(
+    'sheets_request_duration_seconds', 'Google Sheets API request latency', ('kind',)
+)
+sheets_errors = registry.counter(
+    'sheets_request_errors_total', 'Failed Google Sheets API requests', ('kind', 'exception', 'status')
+)
+sheets_in_flight = registry.gauge(
+    'sheets_requests_in_flight', 'Google Sheets API requests currently running'
+)
+sheets_wait = registry.histogram(
+    'sheets_rate_limit_wait_seconds', 'Time spent waiting for the Sheets rate limiter', ('kind',)
+)
+
+# تأخر حلقة الأحداث
+loop_lag_seconds = registry.histogram(
+    'event_loop_lag_seconds', 'Event loop scheduling lag',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.5, 1.0, 2.5)
+)
+
+
+def track_handler(func):
+    """تسجيل زمن تنفيذ المعالج والاستثناءات الصادرة منه وعدد النسخ الجارية"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        handlers_in_flight.inc(handler=name)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            handler_errors.inc(handler=name, exception=type(e).__name__)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, handler=name)
+            handlers_in_flight.dec(handler=name)
+
+    return wrapper
+
+
+def render() -> str:
+    """نص المقاييس لمسار /metrics"""
+    return registry.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int = None, host: str = None):
+    """تشغيل خادم /metrics في خيط منفصل. يرجع الخادم أو None إذا كان معطلاً"""
+    port = config.METRICS_PORT if port is None else port
+    host = host or config.METRICS_HOST
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning(f"تعذر تشغيل مسار المقاييس على {host}:{port}: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"تم تشغيل مسار المقاييس على http://{host}:{port}/metrics")
+    return server
+
+
+class StatsSnapshots:
+    """جمع إحصائيات مكونات حلقة الأحداث داخل الحلقة كل interval ثانية.
+
+    الدوال قد تكون متزامنة أو async (مثل Outbox.stats)، وخادم المقاييس يقرأ آخر لقطة
+    لكل دالة فقط فلا ينتظر الحلقة ولا يقرأ قواميسها أثناء تعديلها.
+    """
+
+    def __init__(self, interval: float = None):
+        self.interval = interval if interval is not None else config.METRICS_SNAPSHOT_INTERVAL
+        self._sources = []
+        self._values = {}
+        self._task = None
+
+    def register(self, prefix: str, stats_func, label: str = None):
+        """مثل Registry.register_stats لكن الدالة تستدعى داخل حلقة الأحداث"""
+        index = len(self._sources)
+        self._sources.append((prefix, stats_func))
+        registry.register_stats(prefix, lambda: self._values.get(index, {}), label=label)
+
+    async def refresh(self):
+        """أخذ لقطة جديدة من جميع الدوال"""
+        for index, (prefix, stats_func) in enumerate(self._sources):
+            try:
+                stats = stats_func()
+                if asyncio.iscoroutine(stats):
+                    stats = await stats
+            except Exception as e:
+                logger.warning(f"تعذر جمع إحصائيات {prefix}: {str(e)}")
+                continue
+            # استبدال القاموس كاملاً، فيرى خيط الخادم اللقطة القديمة أو الجديدة فقط
+            self._values[index] = stats
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """بدء أخذ اللقطات في الحلقة الحالية"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """إيقاف أخذ اللقطات"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class LoopLagMonitor:
+    """قياس تأخر حلقة الأحداث بشكل دوري"""
+
+    def __init__(self, interval: float = None, warn_threshold: float = None):
+        self.interval = interval if interval is not None else config.LOOP_LAG_INTERVAL
+        self.warn_threshold = warn_threshold if warn_threshold is not None else config.LOOP_LAG_WARN_THRESHOLD
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.samples = 0
+        self._task = None
+
+    async def _run(self):
+        """حلقة القياس"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - expected, 0.0)
+            self.record(lag)
+
+    def record(self, lag: float):
+        """تسجيل قراءة تأخر واحدة"""
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+        self.samples += 1
+        loop_lag_seconds.observe(lag)
+        if lag >= self.warn_threshold:
+            logger.warning(f"تأخر حلقة الأحداث: {lag * 1000:.1f} مللي ثانية")
+
+    def start(self):
+        """بدء المراقبة في الحلقة الحالية"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """إيقاف المراقبة"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def reset(self):
+        """تصفير القراءات (مفيد بين سيناريوهات القياس)"""
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.samples = 0
+
+    def stats(self) -> dict:
+        """ملخص القراءات بالمللي ثانية"""
+        avg = self.total_lag / self.samples if self.samples else 0.0
+        return {
+            'loop_lag_last_ms': round(self.last_lag * 1000, 2),
+            'loop_lag_max_ms': round(self.max_lag * 1000, 2),
+            'loop_lag_avg_ms': round(avg * 1000, 2),
+            'loop_lag_samples': self.samples
+        }
+
+
+loop_lag = LoopLagMonitor()
+loop_stats = StatsSnapshots()
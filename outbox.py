@@ -0,0 +1,559 @@
+"""
+صندوق صادر محلي (outbox) دائم للصفوف قبل إرسالها إلى Google Sheets.
+
+كل صف يكتب أولاً في قاعدة بيانات SQLite بوضع WAL مع مفتاح فريد (idempotency key)،
+ثم يقوم OutboxDrainer في الخلفية بإرسال الصفوف المعلقة عبر طابور الكتابة
+مع إعادة المحاولة بتأخير أسي. عند إعادة التشغيل يكمل من حيث توقف.
+
+الصفوف التي لا يعرف إن كانت أضيفت أم لا (كانت قيد الإرسال لحظة التوقف، أو فشل إرسالها
+بانتهاء المهلة أو انقطاع الاتصال أو خطأ 5xx) يتم التحقق منها في الجدول قبل إعادة إرسالها
+حتى لا تتكرر. لكل ورقة عمل يحفظ رقم آخر صف معروف من ردود values.append، ويسجل مع كل صف
+عند حجزه (base_row)، فيقرأ التحقق الصفوف بعد هذا الرقم فقط ويبحث فيها عن صفوف كل طلب
+متتالية وبنفس الترتيب، فلا تحسب صفوف قديمة مطابقة في المحتوى كأنها الصفوف المرسلة.
+"""
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+import requests
+
+import config
+import sheets_client
+from append_queue import append_queue, target_key
+from search_index import search_index
+from sheet_mirror import mirror
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+INFLIGHT = 'inflight'
+VERIFY = 'verify'
+DONE = 'done'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    sheet_key TEXT NOT NULL,
+    target TEXT NOT NULL,
+    row TEXT NOT NULL,
+    user_id TEXT,
+    chat_id TEXT,
+    batch_key TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS outbox_targets (
+    target TEXT PRIMARY KEY,
+    last_row INTEGER NOT NULL
+);
+"""
+
+
+def target_fields(sheet_config: dict) -> dict:
+    """الحقول اللازمة فقط لتحديد ورقة العمل الهدف"""
+    return {
+        'sheet_name': sheet_config['sheet_name'],
+        'worksheet_name': sheet_config['worksheet_name'],
+        'spreadsheet_id': sheet_config.get('spreadsheet_id') or ''
+    }
+
+
+def retry_delay(attempts: int) -> float:
+    """تأخير أسي مع عشوائية لإعادة المحاولة"""
+    delay = min(config.OUTBOX_RETRY_BASE * (2 ** max(attempts - 1, 0)), config.OUTBOX_RETRY_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _target_id(target: dict) -> str:
+    """مفتاح ورقة العمل في جدول outbox_targets (بنفس صيغة target في النسخة المحلية)"""
+    return json.dumps(list(target_key(target)), ensure_ascii=False)
+
+
+def maybe_applied(error: BaseException) -> bool:
+    """هل قد تكون الإضافة نفذت في الجدول رغم الخطأ (انتهاء المهلة، انقطاع الاتصال، 5xx)"""
+    if isinstance(error, gspread.exceptions.APIError):
+        return error.response.status_code >= 500
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+
+
+def send_groups(entries: list) -> list:
+    """تقسيم الصفوف إلى طلبات: صفوف الإدخال الجماعي الواحد معاً، وباقي الصفوف كل منها على حدة"""
+    groups = []
+    batches = {}
+    for entry in entries:
+        if entry['batch_key']:
+            if entry['batch_key'] not in batches:
+                batches[entry['batch_key']] = []
+                groups.append(batches[entry['batch_key']])
+            batches[entry['batch_key']].append(entry)
+        else:
+            groups.append([entry])
+    return groups
+
+
+def find_run(values: list, rows: list, start: int = 0) -> int:
+    """موضع أول ظهور للصفوف rows متتالية في values بدءاً من start، أو -1 (الصفوف بعد _normalize_row)"""
+    for position in range(start, len(values) - len(rows) + 1):
+        if values[position:position + len(rows)] == rows:
+            return position
+    return -1
+
+
+def _normalize_row(row) -> tuple:
+    """توحيد الصف للمقارنة: نصوص بدون الخلايا الفارغة في النهاية"""
+    values = ['' if value is None else str(value) for value in row]
+    while values and values[-1] == '':
+        values.pop()
+    return tuple(values)
+
+
+def _entry(record) -> dict:
+    """تحويل سجل من قاعدة البيانات إلى قاموس"""
+    row_id, sheet_key, target, row, attempts, batch_key, base_row = record
+    return {
+        'id': row_id,
+        'sheet_key': sheet_key,
+        'target': json.loads(target),
+        'row': json.loads(row),
+        'attempts': attempts,
+        'batch_key': batch_key,
+        'base_row': base_row
+    }
+
+
+_ENTRY_COLUMNS = "id, sheet_key, target, row, attempts, batch_key, base_row"
+
+
+class Outbox:
+    """تخزين الصفوف محلياً في SQLite قبل إرسالها"""
+
+    def __init__(self, path: str = None):
+        self.path = path or config.OUTBOX_DB_PATH
+        # خيط واحد لجميع عمليات SQLite يضمن تسلسلها دون أقفال إضافية
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+        self._conn = None
+        self.wakeup = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """فتح قاعدة البيانات وتفعيل وضع WAL"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={config.OUTBOX_SYNCHRONOUS}')
+            conn.executescript(SCHEMA)
+            # قواعد البيانات المنشأة قبل إضافة الإدخال الجماعي
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(outbox)')}
+            if 'batch_key' not in columns:
+                conn.execute('ALTER TABLE outbox ADD COLUMN batch_key TEXT')
+            if 'base_row' not in columns:
+                conn.execute('ALTER TABLE outbox ADD COLUMN base_row INTEGER')
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        """تنفيذ عملية SQLite في خيط الصندوق الصادر"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _add_many(self, entries: list) -> int:
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            cursor = conn.executemany(
+                "INSERT OR IGNORE INTO outbox "
+                "(idempotency_key, sheet_key, target, row, user_id, chat_id, batch_key, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        key,
+                        sheet_key,
+                        json.dumps(target_fields(sheet_config), ensure_ascii=False),
+                        json.dumps(row, ensure_ascii=False),
+                        user_id,
+                        chat_id,
+                        batch_key,
+                        now
+                    )
+                    for key, sheet_key, sheet_config, row, user_id, chat_id, batch_key in entries
+                ]
+            )
+            return cursor.rowcount
+
+    async def add(self, key: str, sheet_key: str, sheet_config: dict, row: list,
+                  user_id: str = None, chat_id: str = None) -> bool:
+        """حفظ صف واحد محلياً. يرجع False إذا كان المفتاح محفوظاً مسبقاً"""
+        inserted = await self.add_many([(key, sheet_key, sheet_config, row, user_id, chat_id, None)])
+        return inserted > 0
+
+    async def add_many(self, entries: list) -> int:
+        """حفظ عدة صفوف في معاملة واحدة.
+
+        كل عنصر: (key, sheet_key, sheet_config, row, user_id, chat_id, batch_key).
+        الصفوف التي تشترك في batch_key ترسل معاً في طلب واحد.
+        """
+        inserted = await self._run(self._add_many, entries)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return inserted
+
+    def _claim_due(self, limit: int) -> list:
+        conn = self._connect()
+        with conn:
+            rows = conn.execute(
+                f"SELECT {_ENTRY_COLUMNS} FROM outbox "
+                "WHERE status = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (PENDING, time.time(), limit)
+            ).fetchall()
+            last_rows = dict(conn.execute("SELECT target, last_row FROM outbox_targets"))
+            entries = [_entry(row) for row in rows]
+            for entry in entries:
+                entry['base_row'] = last_rows.get(_target_id(entry['target']))
+            conn.executemany(
+                "UPDATE outbox SET status = ?, base_row = ? WHERE id = ?",
+                [(INFLIGHT, entry['base_row'], entry['id']) for entry in entries]
+            )
+        return entries
+
+    async def claim_due(self, limit: int) -> list:
+        """حجز الصفوف المستحقة للإرسال وتحويلها إلى حالة inflight مع آخر صف معروف في ورقة العمل"""
+        return await self._run(self._claim_due, limit)
+
+    def _record_last_rows(self, last_rows: dict, only_higher: bool):
+        conn = self._connect()
+        update = "MAX(last_row, excluded.last_row)" if only_higher else "excluded.last_row"
+        with conn:
+            conn.executemany(
+                "INSERT INTO outbox_targets (target, last_row) VALUES (?, ?) "
+                f"ON CONFLICT(target) DO UPDATE SET last_row = {update}",
+                [(_target_id(target), last_row) for target, last_row in last_rows.values()]
+            )
+
+    def _set_base_rows(self, ids: list, base_row: int):
+        conn = self._connect()
+        with conn:
+            conn.executemany("UPDATE outbox SET base_row = ? WHERE id = ?", [(base_row, row_id) for row_id in ids])
+
+    async def set_base_rows(self, ids: list, base_row: int):
+        """تسجيل آخر صف معروف قبل إرسال صفوف لم يكن لورقتها رقم محفوظ"""
+        await self._run(self._set_base_rows, ids, base_row)
+
+    async def record_last_rows(self, last_rows: dict, only_higher: bool = False):
+        """حفظ آخر صف معروف لكل ورقة عمل. last_rows: {مفتاح الورقة: (الإعدادات، رقم الصف)}
+
+        رد values.append يحدد آخر صف فعلياً، أما التحقق فيرفع الرقم فقط (only_higher).
+        """
+        if last_rows:
+            await self._run(self._record_last_rows, last_rows, only_higher)
+
+    def _mark_done(self, ids: list):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                [(DONE, now, row_id) for row_id in ids]
+            )
+
+    async def mark_done(self, ids: list):
+        """تعليم الصفوف كمرسلة"""
+        await self._run(self._mark_done, ids)
+
+    def _mark_failed(self, entries: list, error: str, status: str):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                [
+                    (status, entry['attempts'] + 1, now + retry_delay(entry['attempts'] + 1), error, entry['id'])
+                    for entry in entries
+                ]
+            )
+
+    async def mark_failed(self, entries: list, error: str, status: str = PENDING):
+        """إعادة الصفوف إلى الانتظار مع تأخير أسي (أو إلى التحقق إذا كانت قد أضيفت رغم الخطأ)"""
+        await self._run(self._mark_failed, entries, error, status)
+
+    def _mark_unverified(self) -> int:
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("UPDATE outbox SET status = ? WHERE status = ?", (VERIFY, INFLIGHT))
+            return cursor.rowcount
+
+    async def mark_unverified(self) -> int:
+        """الصفوف التي كانت قيد الإرسال عند توقف العملية السابقة تحتاج إلى تحقق"""
+        return await self._run(self._mark_unverified)
+
+    def _list_unverified(self) -> list:
+        rows = self._connect().execute(
+            f"SELECT {_ENTRY_COLUMNS} FROM outbox WHERE status = ? AND next_attempt_at <= ? ORDER BY id",
+            (VERIFY, time.time())
+        ).fetchall()
+        return [_entry(row) for row in rows]
+
+    async def list_unverified(self) -> list:
+        """الصفوف المستحقة للتحقق من وجودها في الجدول"""
+        return await self._run(self._list_unverified)
+
+    def _requeue(self, ids: list):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, next_attempt_at = 0 WHERE id = ?",
+                [(PENDING, row_id) for row_id in ids]
+            )
+
+    async def requeue(self, ids: list):
+        """إعادة صفوف إلى الانتظار لإرسالها فوراً"""
+        await self._run(self._requeue, ids)
+
+    def _purge(self, older_than: float) -> int:
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM outbox WHERE status = ? AND sent_at < ?",
+                (DONE, older_than)
+            )
+            return cursor.rowcount
+
+    async def purge(self) -> int:
+        """حذف الصفوف المرسلة الأقدم من مدة الاحتفاظ"""
+        return await self._run(self._purge, time.time() - config.OUTBOX_RETENTION)
+
+    def _counts(self) -> dict:
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return dict(rows)
+
+    async def stats(self) -> dict:
+        """عدد الصفوف في كل حالة"""
+        counts = await self._run(self._counts)
+        return {f'outbox_{status}': counts.get(status, 0) for status in (PENDING, INFLIGHT, VERIFY, DONE)}
+
+    def _batch_counts(self, prefix: str) -> dict:
+        rows = self._connect().execute(
+            "SELECT status, COUNT(*) FROM outbox WHERE substr(batch_key, 1, ?) = ? GROUP BY status",
+            (len(prefix), prefix)
+        ).fetchall()
+        return dict(rows)
+
+    async def batch_counts(self, prefix: str) -> dict:
+        """عدد صفوف الدفعات التي يبدأ مفتاحها بالبادئة المعطاة في كل حالة"""
+        return await self._run(self._batch_counts, prefix)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        """إغلاق قاعدة البيانات"""
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+
+class OutboxDrainer:
+    """مهمة خلفية ترسل الصفوف المعلقة من الصندوق الصادر إلى Google Sheets"""
+
+    def __init__(self, outbox: Outbox, queue=None, mirror=None, search_index=None):
+        self.outbox = outbox
+        self.queue = queue or append_queue
+        self.mirror = mirror
+        self.search_index = search_index
+        self.sent = 0
+        self.failures = 0
+        self.unconfirmed = 0
+        self._task = None
+        self._wakeup = None
+        self._stopping = False
+        self._last_purge = 0.0
+
+    async def start(self):
+        """بدء الإرسال في الخلفية"""
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self.outbox.wakeup = self._wakeup
+        unverified = await self.outbox.mark_unverified()
+        if unverified:
+            logger.warning(f"{unverified} صف كانت قيد الإرسال عند التوقف السابق، سيتم التحقق منها")
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """إيقاف الإرسال بعد انتهاء الدورة الحالية"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        """حلقة الإرسال"""
+        while not self._stopping:
+            try:
+                await self._verify_unsent()
+                claimed = await self.outbox.claim_due(config.OUTBOX_CLAIM_LIMIT)
+                if claimed:
+                    await self._send(claimed)
+                    continue
+                if time.time() - self._last_purge > config.OUTBOX_PURGE_INTERVAL:
+                    self._last_purge = time.time()
+                    await self.outbox.purge()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في إرسال الصندوق الصادر: {str(e)}", exc_info=True)
+
+            if self._stopping:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=config.OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, entries: list):
+        """إرسال الصفوف المحجوزة عبر طابور الكتابة (مجمعة حسب ورقة العمل)"""
+        await self._seed_base_rows(entries)
+        groups = send_groups(entries)
+        futures = [
+            self.queue.submit_rows(group[0]['target'], [entry['row'] for entry in group])
+            for group in groups
+        ]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+
+        done = []
+        sent_groups = []
+        last_rows = {}
+        failed = {}
+        unconfirmed = {}
+        for group, result in zip(groups, results):
+            if isinstance(result, BaseException):
+                # بعد انتهاء المهلة أو انقطاع الاتصال قد تكون الصفوف أضيفت، فيتم التحقق قبل إعادتها
+                errors = unconfirmed if maybe_applied(result) else failed
+                errors.setdefault(str(result) or type(result).__name__, []).extend(group)
+                continue
+            done.extend(entry['id'] for entry in group)
+            sent_groups.append((group, result))
+            if result is not None:
+                target = group[0]['target']
+                previous = last_rows.get(target_key(target), (target, 0))[1]
+                last_rows[target_key(target)] = (target, max(previous, result + len(group) - 1))
+
+        if done:
+            await self.outbox.mark_done(done)
+            await self.outbox.record_last_rows(last_rows)
+            self.sent += len(done)
+        if self.mirror is not None:
+            for group, start_row in sent_groups:
+                try:
+                    await self.mirror.record_appended(
+                        group[0]['sheet_key'], group[0]['target'], start_row, [entry['row'] for entry in group]
+                    )
+                    if self.search_index is not None:
+                        self.search_index.schedule_update(group[0]['sheet_key'])
+                except Exception as e:
+                    logger.warning(f"تعذر تحديث النسخة المحلية للجدول {group[0]['sheet_key']}: {str(e)}")
+        for error, group in failed.items():
+            self.failures += len(group)
+            logger.warning(f"فشل إرسال {len(group)} صف، ستتم إعادة المحاولة: {error}")
+            await self.outbox.mark_failed(group, error)
+        for error, group in unconfirmed.items():
+            self.failures += len(group)
+            self.unconfirmed += len(group)
+            logger.warning(f"لم يتأكد إرسال {len(group)} صف، سيتم التحقق منها قبل إعادة الإرسال: {error}")
+            await self.outbox.mark_failed(group, error, status=VERIFY)
+
+    async def _seed_base_rows(self, entries: list):
+        """أول إرسال لورقة عمل: آخر صف معروف من النسخة المحلية بدلاً من ردود values.append"""
+        if self.mirror is None:
+            return
+        unknown = {}
+        for entry in entries:
+            if entry['base_row'] is None:
+                unknown.setdefault(target_key(entry['target']), []).append(entry)
+        for target_entries in unknown.values():
+            target = target_entries[0]['target']
+            try:
+                state = await self.mirror.state(target_entries[0]['sheet_key'])
+            except Exception as e:
+                logger.warning(f"تعذرت قراءة النسخة المحلية للجدول {target['sheet_name']}: {str(e)}")
+                continue
+            if state is None or state['target'] != _target_id(target):
+                continue
+            for entry in target_entries:
+                entry['base_row'] = state['row_count']
+            await self.outbox.set_base_rows([entry['id'] for entry in target_entries], state['row_count'])
+
+    async def _verify_unsent(self):
+        """التحقق من الصفوف التي قد تكون أضيفت دون تأكيد لتجنب تكرارها"""
+        entries = await self.outbox.list_unverified()
+        if not entries:
+            return
+
+        targets = {}
+        for entry in entries:
+            targets.setdefault(target_key(entry['target']), []).append(entry)
+
+        for target_entries in targets.values():
+            target = target_entries[0]['target']
+            bases = [entry['base_row'] for entry in target_entries]
+            window = len(target_entries) + config.OUTBOX_VERIFY_WINDOW
+            try:
+                if None in bases:
+                    # لا يعرف آخر صف قبل الإرسال (أول إرسال لهذه الورقة): فحص آخر الصفوف فقط
+                    values = await sheets_client.run_on_worksheet(target, gspread.Worksheet.get_all_values)
+                    base = max(len(values) - window, 0)
+                    values = values[base:]
+                else:
+                    # صفوف الطلب تضاف بعد آخر صف كان معروفاً عند حجزها
+                    base = min(bases)
+                    values = await sheets_client.run_on_worksheet(
+                        target, gspread.Worksheet.get_values, f"{base + 1}:{base + window}"
+                    )
+            except Exception as e:
+                logger.warning(f"تعذر التحقق من الصفوف غير المؤكدة في {target['sheet_name']}: {str(e)}")
+                await self.outbox.mark_failed(target_entries, str(e) or type(e).__name__, status=VERIFY)
+                continue
+
+            values = [_normalize_row(row) for row in values]
+            present, missing = [], []
+            position = 0
+            for group in send_groups(target_entries):
+                found = find_run(values, [_normalize_row(entry['row']) for entry in group], position)
+                if found < 0:
+                    missing.extend(entry['id'] for entry in group)
+                else:
+                    present.extend(entry['id'] for entry in group)
+                    position = found + len(group)
+
+            if present:
+                await self.outbox.mark_done(present)
+                await self.outbox.record_last_rows({target_key(target): (target, base + position)}, only_higher=True)
+            if missing:
+                await self.outbox.requeue(missing)
+            logger.info(
+                f"التحقق من {target['sheet_name']}: {len(present)} صف موجود مسبقاً، "
+                f"{len(missing)} صف سيعاد إرساله"
+            )
+
+    def stats(self) -> dict:
+        """إحصائيات الإرسال"""
+        return {
+            'outbox_sent': self.sent,
+            'outbox_send_failures': self.failures,
+            'outbox_unconfirmed_sends': self.unconfirmed
+        }
+
+
+outbox = Outbox()
+drainer = OutboxDrainer(outbox, mirror=mirror, search_index=search_index)
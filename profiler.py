@@ -0,0 +1,252 @@
+"""
+أدوات تشخيص الأداء أثناء التشغيل دون إعادة تشغيل البوت.
+
+SamplingProfiler يأخذ عينة من مكدس استدعاءات جميع الخيوط كل PROFILE_INTERVAL ثانية
+من خيط منفصل (sys._current_frames)، فلا يضيف أي تكلفة على الدوال نفسها. النتيجة
+بصيغة المكدسات المطوية (collapsed) التي تقبلها أدوات flamegraph.pl و speedscope.
+
+MemoryTracker يشغل tracemalloc عند أول طلب ويأخذ لقطة في كل طلب، ويقارنها باللقطة
+السابقة لإظهار الأسطر التي زادت استهلاك الذاكرة، مع حجم user_data لكل مستخدم.
+"""
+import linecache
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# دوال الانتظار في قاع مكدس حلقة الأحداث عندما لا يوجد عمل
+_IDLE_FUNCTIONS = {'select', 'poll', 'epoll', 'kqueue', '_poll', 'wait'}
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+
+class SamplingProfiler:
+    """محلل أداء بأخذ العينات يعمل في خيط منفصل"""
+
+    def __init__(self, interval: float = None, max_seconds: float = None):
+        self.interval = interval if interval is not None else config.PROFILE_INTERVAL
+        self.max_seconds = max_seconds if max_seconds is not None else config.PROFILE_MAX_SECONDS
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> bool:
+        """بدء أخذ العينات. يرجع False إذا كان يعمل بالفعل"""
+        if self.running:
+            return False
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+        self.started_at = time.time()
+        self.stopped_at = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        logger.info(f"بدء تحليل الأداء: عينة كل {self.interval * 1000:.0f} مللي ثانية")
+        return True
+
+    def stop(self) -> bool:
+        """إيقاف أخذ العينات. يرجع False إذا لم يكن يعمل"""
+        if self._thread is None:
+            return False
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        logger.info(f"تم إيقاف تحليل الأداء بعد {self.samples} عينة")
+        return True
+
+    def _run(self):
+        """حلقة أخذ العينات (تتوقف تلقائياً بعد max_seconds)"""
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(';', ','))
+                stacks.append(';'.join(reversed(stack)))
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
+            if time.monotonic() >= deadline:
+                logger.warning(f"تم إيقاف تحليل الأداء تلقائياً بعد {self.max_seconds:.0f} ثانية")
+                break
+        self.stopped_at = time.time()
+
+    def collapsed(self) -> str:
+        """المكدسات المطوية: سطر لكل مكدس بالصيغة «إطار;إطار;... العدد»"""
+        with self._lock:
+            stacks = list(self._stacks.items())
+        stacks.sort(key=lambda item: item[1], reverse=True)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def summary(self, top: int = 8) -> str:
+        """ملخص نصي: نسبة انشغال الخيط الرئيسي (حلقة الأحداث) وأكثر الدوال ظهوراً فيه"""
+        with self._lock:
+            stacks = list(self._stacks.items())
+            samples = self.samples
+        main_name = threading.main_thread().name
+        busy = 0
+        inclusive = Counter()
+        leaves = Counter()
+        for stack, count in stacks:
+            frames = stack.split(';')
+            if frames[0] != main_name or frames[-1].split(' ', 1)[0] in _IDLE_FUNCTIONS:
+                continue
+            busy += count
+            # الإطارات حتى Handle._run هي حلقة الأحداث نفسها، وما بعدها هو المهمة الجارية
+            start = 1
+            for index, frame in enumerate(frames):
+                if frame.startswith('_run (events.py'):
+                    start = index + 1
+            # كل دالة تحسب مرة واحدة لكل عينة حتى مع الاستدعاء المتكرر
+            inclusive.update({frame: count for frame in set(frames[start:])})
+            leaves[frames[-1]] += count
+        end = self.stopped_at or time.time()
+        duration = end - self.started_at if self.started_at else 0.0
+        lines = [
+            f"⏱ المدة: {duration:.1f} ثانية، {samples} عينة",
+            f"🔁 انشغال حلقة الأحداث: {busy * 100 / samples:.1f}%" if samples else "🔁 لا توجد عينات"
+        ]
+        for title, counter in (("أكثر الدوال ظهوراً في حلقة الأحداث:", inclusive), ("أكثر الدوال استهلاكاً بنفسها:", leaves)):
+            if counter:
+                lines.append(f"\n{title}")
+                for frame, count in counter.most_common(top):
+                    lines.append(f"{count * 100 / samples:5.1f}%  {frame}")
+        return "\n".join(lines)
+
+
+def deep_size(obj, seen: set = None) -> int:
+    """الحجم التقريبي للكائن مع محتوياته (القواميس والقوائم والمجموعات)"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def _format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+class MemoryTracker:
+    """لقطات tracemalloc مع المقارنة باللقطة السابقة"""
+
+    # إطارات الأدوات نفسها لا تهم في التقرير
+    _FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>')
+    )
+
+    def __init__(self, frames: int = None, top: int = None):
+        self.frames = frames or config.TRACEMALLOC_FRAMES
+        self.top = top or config.MEMSNAP_TOP
+        self._previous = None
+        self.snapshots = 0
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self) -> bool:
+        """تشغيل tracemalloc. يرجع False إذا كان يعمل بالفعل"""
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(self.frames)
+        self._previous = None
+        logger.info(f"تم تشغيل tracemalloc ({self.frames} إطار لكل تخصيص)")
+        return True
+
+    def stop(self) -> bool:
+        """إيقاف tracemalloc وحذف اللقطة السابقة"""
+        if not tracemalloc.is_tracing():
+            return False
+        tracemalloc.stop()
+        self._previous = None
+        logger.info("تم إيقاف tracemalloc")
+        return True
+
+    def report(self, user_sizes: dict = None) -> tuple:
+        """أخذ لقطة وإرجاع (ملخص قصير، تقرير كامل).
+
+        user_sizes قاموس {المستخدم: حجم user_data}، ويقاس في خيط حلقة الأحداث لأنها
+        التي تعدل user_data، بينما يمكن استدعاء هذه الدالة من خيط آخر.
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(self._FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        self.snapshots += 1
+        lines = [
+            f"tracemalloc: current={_format_size(current)} peak={_format_size(peak)} "
+            f"overhead={_format_size(tracemalloc.get_tracemalloc_memory())}",
+            ""
+        ]
+
+        if self._previous is not None:
+            lines.append(f"Top {self.top} changes since previous snapshot (lineno):")
+            for stat in snapshot.compare_to(self._previous, 'lineno')[:self.top]:
+                lines.append(str(stat))
+            lines.append("")
+        lines.append(f"Top {self.top} allocations (lineno):")
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            lines.append(str(stat))
+        lines.append("")
+        lines.append("Largest allocation traceback:")
+        largest = snapshot.statistics('traceback')[:1]
+        if largest:
+            lines.extend(largest[0].traceback.format())
+
+        summary = [f"💾 الذاكرة المتتبعة: {_format_size(current)} (الذروة {_format_size(peak)})"]
+        if self._previous is not None:
+            growth = sum(stat.size_diff for stat in snapshot.compare_to(self._previous, 'filename'))
+            summary.append(f"📈 التغير منذ اللقطة السابقة: {_format_size(growth)}")
+
+        if user_sizes is not None:
+            total = sum(user_sizes.values())
+            summary.append(f"👥 user_data: {len(user_sizes)} مستخدم، {_format_size(total)}")
+            lines.append("")
+            lines.append(f"user_data: {len(user_sizes)} users, {_format_size(total)}")
+            for user_id, size in sorted(user_sizes.items(), key=lambda item: item[1], reverse=True)[:self.top]:
+                lines.append(f"  {user_id}: {_format_size(size)}")
+
+        self._previous = snapshot
+        return "\n".join(summary), "\n".join(lines) + "\n"
+
+
+profiler = SamplingProfiler()
+memory_tracker = MemoryTracker()
@@ -0,0 +1,332 @@
+"""
+محدد معدل لطلبات Google Sheets حسب حصص القراءة والكتابة.
+
+كل طلب HTTP يمر عبر دلو رموز (token bucket) لحساب الخدمة ودلو آخر للجدول نفسه،
+منفصلين للقراءة والكتابة، وينتظر حتى يتوفر رمز بدلاً من أن يفشل. عند رد 429
+(أو 403 بسبب تجاوز المعدل) يتم إيقاف دلو الحساب مؤقتاً حسب Retry-After أو بتأخير أسي
+مع عشوائية، وتخفيض معدلها إلى النصف ثم استعادته تدريجياً مع الطلبات الناجحة.
+تتم إعادة المحاولة بعد تجاوز الحصة حتى مرور RATE_LIMIT_DEADLINE ثانية.
+المحدد مشترك لجميع مكونات العملية وآمن للاستخدام من عدة خيوط.
+
+داخل deferred_waits() لا ينتظر الطلب في الخيط الذي ينفذه، بل يحجز دوره في الدلاء ويرفع
+RateLimitWait قبل إرساله، فينتظر المتصل (run_on_worksheet) في حلقة الأحداث دون أن
+يحجز خيطاً من مجمع الخيوط، ثم يعيد الاستدعاء مع الحجز نفسه.
+"""
+import contextlib
+import logging
+import random
+import re
+import threading
+import time
+
+import gspread
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+READ = 'read'
+WRITE = 'write'
+
+_SPREADSHEET_ID = re.compile(r'/spreadsheets/([a-zA-Z0-9_-]+)')
+_QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED')
+
+# حالة الانتظار المؤجل للخيط الحالي (انظر deferred_waits)
+_local = threading.local()
+
+
+def spreadsheet_id_from_url(url: str) -> str:
+    """معرف الجدول من رابط طلب Sheets API، أو None لطلبات Drive"""
+    match = _SPREADSHEET_ID.search(url or '')
+    return match.group(1) if match else None
+
+
+def is_quota_error(error: gspread.exceptions.APIError) -> bool:
+    """هل الخطأ بسبب تجاوز الحصة أو المعدل"""
+    response = error.response
+    if response.status_code == 429:
+        return True
+    if response.status_code == 403:
+        text = response.text or ''
+        return any(reason in text for reason in _QUOTA_REASONS)
+    return False
+
+
+def retry_after(response) -> float:
+    """قيمة ترويسة Retry-After بالثواني، أو None"""
+    value = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """تأخير أسي مع عشوائية (equal jitter)"""
+    delay = min(config.RATE_LIMIT_BACKOFF_BASE * (2 ** max(attempt - 1, 0)), config.RATE_LIMIT_BACKOFF_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket:
+    """دلو رموز: يمتلئ بمعدل rate رمز في الثانية حتى السعة capacity"""
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        self.name = name
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.throttles = 0
+        self.strikes = 0  # عدد ردود 429 المتتالية منذ آخر طلب ناجح
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """حجز رمز وإرجاع مدة الانتظار حتى يصبح متاحاً.
+
+        الرصيد قد يصبح سالباً، فيحصل كل طلب منتظر على دوره بالترتيب.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.blocked_until - now, 0.0)
+            if wait > 0:
+                self.waits += 1
+                self.wait_time += wait
+            return wait
+
+    def refund(self):
+        """إرجاع رمز محجوز لم يستخدم"""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def blocked_for(self) -> float:
+        """المدة المتبقية من الإيقاف المؤقت بعد رد 429"""
+        return max(self.blocked_until - time.monotonic(), 0.0)
+
+    def throttle(self, delay: float):
+        """إيقاف الدلو مؤقتاً وتخفيض معدله إلى النصف"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.blocked_until = max(self.blocked_until, now + delay)
+            self.rate = max(self.base_rate * config.RATE_LIMIT_MIN_FACTOR, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self.throttles += 1
+            self.strikes += 1
+
+    def recover(self):
+        """استعادة المعدل تدريجياً بعد طلب ناجح"""
+        self.strikes = 0
+        if self.rate >= self.base_rate:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.base_rate, self.rate + self.base_rate * config.RATE_LIMIT_RECOVERY_STEP)
+
+    def stats(self) -> dict:
+        return {
+            'rate_per_minute': round(self.rate * 60, 2),
+            'tokens': round(self.tokens, 2),
+            'waits': self.waits,
+            'wait_time_s': round(self.wait_time, 3),
+            'throttles': self.throttles
+        }
+
+
+class RateLimiter:
+    """دلاء الرموز لجميع حسابات الخدمة والجداول"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.quota_errors = 0
+
+    def _bucket(self, scope: str, key: str, kind: str) -> TokenBucket:
+        name = (scope, key, kind)
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(name)
+                if bucket is None:
+                    if scope == 'account':
+                        per_minute = config.SHEETS_READ_PER_MINUTE if kind == READ else config.SHEETS_WRITE_PER_MINUTE
+                    else:
+                        per_minute = (config.SHEETS_SPREADSHEET_READ_PER_MINUTE if kind == READ
+                                      else config.SHEETS_SPREADSHEET_WRITE_PER_MINUTE)
+                    bucket = TokenBucket(f"{scope}:{key}:{kind}", per_minute / 60.0, config.SHEETS_RATE_BURST)
+                    self._buckets[name] = bucket
+        return bucket
+
+    def buckets(self, account: str, spreadsheet_id: str, kind: str) -> list:
+        """دلاء الطلب: دلو الحساب، ودلو الجدول إذا كان الطلب على جدول محدد"""
+        buckets = [self._bucket('account', account or '', kind)]
+        if spreadsheet_id:
+            buckets.append(self._bucket('spreadsheet', spreadsheet_id, kind))
+        return buckets
+
+    def reserve(self, account: str, spreadsheet_id: str, kind: str) -> tuple:
+        """حجز دور الطلب في دلاء الحساب والجدول دون انتظار. يرجع (الدلاء، مدة الانتظار)"""
+        buckets = self.buckets(account, spreadsheet_id, kind)
+        return buckets, max(bucket.reserve() for bucket in buckets)
+
+    def acquire(self, account: str, spreadsheet_id: str, kind: str) -> float:
+        """انتظار دور الطلب في دلاء الحساب والجدول. يرجع مدة الانتظار الكلية"""
+        buckets, wait = self.reserve(account, spreadsheet_id, kind)
+        waited = 0.0
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            # قد يكون رد 429 آخر قد أوقف الدلاء أثناء الانتظار
+            wait = max(bucket.blocked_for() for bucket in buckets)
+        return waited
+
+    def succeeded(self, account: str, spreadsheet_id: str, kind: str):
+        """تسجيل طلب ناجح لاستعادة المعدل"""
+        for bucket in self.buckets(account, spreadsheet_id, kind):
+            bucket.recover()
+
+    def throttled(self, account: str, kind: str, delay: float = None) -> float:
+        """تسجيل رد تجاوز الحصة وإيقاف دلو الحساب. يرجع مدة الإيقاف"""
+        # حصص Google تحسب لكل حساب خدمة، فلا يتم إيقاف الجدول لبقية الحسابات
+        bucket = self._bucket('account', account or '', kind)
+        # التأخير الأسي حسب ردود 429 المتتالية على الحساب، حتى لو جاءت من طلبات مختلفة
+        delay = delay if delay is not None else backoff_delay(bucket.strikes + 1)
+        self.quota_errors += 1
+        bucket.throttle(delay)
+        return delay
+
+    def account_blocked_for(self, account: str) -> float:
+        """المدة المتبقية من إيقاف حساب خدمة بعد تجاوز حصته"""
+        return max(
+            (bucket.blocked_for() for (scope, key, _), bucket in list(self._buckets.items())
+             if scope == 'account' and key == account),
+            default=0.0
+        )
+
+    def bucket_stats(self) -> dict:
+        """إحصائيات كل دلو: {اسم الدلو: الإحصائيات}"""
+        return {bucket.name: bucket.stats() for bucket in list(self._buckets.values())}
+
+    def stats(self) -> dict:
+        """إحصائيات جميع الدلاء"""
+        return {
+            'quota_errors': self.quota_errors,
+            'buckets': self.bucket_stats()
+        }
+
+
+limiter = RateLimiter()
+
+
+class RateLimitWait(Exception):
+    """لم يرسل الطلب لأن دوره في دلاء المعدل لم يحن بعد، أو لأن Google رد بتجاوز الحصة.
+
+    delay مدة الانتظار قبل إعادة الاستدعاء، و reservation الدلاء التي حجز فيها دور الطلب
+    (تمرر إلى deferred_waits في المحاولة التالية)، و error رد تجاوز الحصة إن وجد.
+    """
+
+    def __init__(self, delay: float, kind: str, reservation: list = None, error: Exception = None):
+        super().__init__(f"انتظار {delay:.2f} ثانية لحصة Google Sheets ({kind})")
+        self.delay = delay
+        self.kind = kind
+        self.reservation = reservation
+        self.error = error
+
+    def release(self):
+        """إرجاع الرموز المحجوزة إذا لن تتم إعادة الطلب"""
+        for bucket in self.reservation or ():
+            bucket.refund()
+        self.reservation = None
+
+
+@contextlib.contextmanager
+def deferred_waits(reservation: list = None):
+    """رفع RateLimitWait بدلاً من الانتظار في الخيط الحالي، مع استخدام حجز سابق إن وجد"""
+    previous = getattr(_local, 'defer', False), getattr(_local, 'reservation', None)
+    _local.defer, _local.reservation = True, reservation
+    try:
+        yield
+    finally:
+        # حجز لم يستخدم (مثلاً انتقل الطلب إلى حساب خدمة آخر)
+        for bucket in _local.reservation or ():
+            bucket.refund()
+        _local.defer, _local.reservation = previous
+
+
+class RateLimitedClient(gspread.Client):
+    """عميل gspread يمر كل طلب فيه عبر محدد المعدل، ويعيد المحاولة عند تجاوز الحصة"""
+
+    account = ''
+    # 0: عدم إعادة المحاولة بعد تجاوز الحصة، للانتقال إلى حساب خدمة آخر بدلاً من الانتظار
+    max_retries = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = {READ: 0, WRITE: 0}
+        self.quota_errors = 0
+
+    def _pace(self, spreadsheet_id: str, kind: str):
+        """حجز دور الطلب، أو رفع RateLimitWait في وضع الانتظار المؤجل إذا لم يحن دوره"""
+        if not getattr(_local, 'defer', False):
+            metrics.sheets_wait.observe(limiter.acquire(self.account, spreadsheet_id, kind), kind=kind)
+            return
+        buckets = limiter.buckets(self.account, spreadsheet_id, kind)
+        if _local.reservation == buckets:
+            # الدور محجوز في محاولة سابقة، لكن قد يكون الحساب أوقف بعد 429 أثناء الانتظار
+            _local.reservation = None
+            wait = max(bucket.blocked_for() for bucket in buckets)
+        else:
+            buckets, wait = limiter.reserve(self.account, spreadsheet_id, kind)
+        if wait > 0:
+            raise RateLimitWait(wait, kind, reservation=buckets)
+
+    def request(self, method, endpoint, *args, **kwargs):
+        kind = READ if method == 'get' else WRITE
+        spreadsheet_id = spreadsheet_id_from_url(endpoint)
+        deadline = time.monotonic() + config.RATE_LIMIT_DEADLINE
+        attempt = 0
+        while True:
+            self._pace(spreadsheet_id, kind)
+            self.requests[kind] += 1
+            metrics.sheets_in_flight.inc()
+            started = time.perf_counter()
+            try:
+                response = super().request(method, endpoint, *args, **kwargs)
+            except Exception as e:
+                status = e.response.status_code if isinstance(e, gspread.exceptions.APIError) else ''
+                metrics.sheets_errors.inc(kind=kind, exception=type(e).__name__, status=status)
+                if not isinstance(e, gspread.exceptions.APIError) or not is_quota_error(e):
+                    raise
+                self.quota_errors += 1
+                attempt += 1
+                delay = limiter.throttled(self.account, kind, retry_after(e.response))
+                if getattr(_local, 'defer', False):
+                    raise RateLimitWait(delay, kind, error=e) from e
+                if self.max_retries is not None and attempt > self.max_retries:
+                    raise
+                if time.monotonic() + delay > deadline:
+                    logger.error(
+                        "تجاوز حصة Google Sheets (%s، %s) مستمر منذ أكثر من %.0f ثانية",
+                        kind, spreadsheet_id or 'Drive', config.RATE_LIMIT_DEADLINE
+                    )
+                    raise
+                logger.warning(
+                    "تم تجاوز حصة Google Sheets (%s، %s)، إعادة المحاولة %d بعد %.1f ثانية",
+                    kind, spreadsheet_id or 'Drive', attempt, delay
+                )
+                continue
+            finally:
+                metrics.sheets_latency.observe(time.perf_counter() - started, kind=kind)
+                metrics.sheets_in_flight.dec()
+            limiter.succeeded(self.account, spreadsheet_id, kind)
+            return response
@@ -0,0 +1,263 @@
+"""
+تقارير مجمعة للأعمدة الرقمية من النسخة المحلية للجداول.
+
+يتم تحويل صفوف الجدول مرة واحدة إلى مصفوفات NumPy حسب نوع كل عمود (أرقام float
+وتواريخ datetime64 ونصوص)، ثم يتم التجميع حسب اليوم أو الأسبوع أو الشهر أو حسب عمود
+نصي باستخدام np.unique و np.bincount دون حلقات على الصفوف. المصفوفات والتقارير تخزن
+مؤقتاً حسب (الجدول، إصدار البيانات، إصدار الإعدادات) فتكون التقارير المتكررة فورية.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+import config
+from sheet_mirror import mirror, strip_header
+from sheet_schema import normalize_digits, parse_date
+
+logger = logging.getLogger(__name__)
+
+# أنواع التجميع حسب عمود التاريخ
+TIME_GROUPINGS = {
+    'day': 'يومي',
+    'week': 'أسبوعي',
+    'month': 'شهري'
+}
+
+def _float_or_nan(value: str) -> float:
+    value = normalize_digits(value.strip()).replace(',', '')
+    if not value:
+        return np.nan
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def _date_or_nat(value: str):
+    if not value.strip():
+        return np.datetime64('NaT', 'D')
+    try:
+        return np.datetime64(parse_date(value)[:10], 'D')
+    except ValueError:
+        return np.datetime64('NaT', 'D')
+
+
+def to_numbers(values: np.ndarray) -> np.ndarray:
+    """تحويل نصوص عمود رقمي إلى مصفوفة float، والقيم الفارغة أو غير الصالحة NaN.
+
+    يتم تحليل كل قيمة مختلفة مرة واحدة ثم توزيع النتائج على الصفوف.
+    """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    parsed = np.array([_float_or_nan(value) for value in uniques], dtype=np.float64)
+    return parsed[inverse]
+
+
+def to_dates(values: np.ndarray) -> np.ndarray:
+    """تحويل نصوص عمود تاريخ إلى مصفوفة datetime64 بدقة يوم، والقيم غير الصالحة NaT.
+
+    يتم تحليل كل قيمة مختلفة مرة واحدة بنفس دالة التحقق في البوت ثم توزيع النتائج على الصفوف.
+    """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    parsed = np.array([_date_or_nat(value) for value in uniques], dtype='datetime64[D]')
+    return parsed[inverse]
+
+
+class ReportData:
+    """أعمدة الجدول كمصفوفات حسب نوعها"""
+
+    def __init__(self, schema, rows: list):
+        width = len(schema.column_order)
+        padded = [row[:width] + [''] * (width - len(row)) for _, row in rows if any(row)]
+        self.size = len(padded)
+        table = np.array(padded, dtype=str).reshape(len(padded), width)
+        self.numbers = {}
+        self.dates = {}
+        self.texts = {}
+        for index, column in enumerate(schema.column_order):
+            column_type = schema.columns[column].type
+            if column_type == 'number':
+                self.numbers[column] = to_numbers(table[:, index])
+            elif column_type == 'date':
+                self.dates[column] = to_dates(table[:, index])
+            else:
+                self.texts[column] = np.char.strip(table[:, index])
+
+
+def group_options(schema) -> list:
+    """أنواع التجميع المتاحة لجدول: قائمة (المعرف، الوصف)"""
+    if not any(spec.type == 'number' for spec in schema.columns.values()):
+        return []
+    options = []
+    date_columns = [column for column in schema.column_order if schema.columns[column].type == 'date']
+    if date_columns:
+        options.extend((group, f"{label} ({date_columns[0]})") for group, label in TIME_GROUPINGS.items())
+    options.extend(
+        (f"col_{index}", f"حسب {column}")
+        for index, column in enumerate(schema.column_order)
+        if schema.columns[column].type == 'text'
+    )
+    return options
+
+
+def group_keys(data: ReportData, schema, group: str) -> tuple:
+    """مفاتيح التجميع لكل صف وقناع الصفوف الصالحة. يرجع (المفاتيح، القناع، اسم العمود)"""
+    if group in TIME_GROUPINGS:
+        column = next(column for column in schema.column_order if column in data.dates)
+        dates = data.dates[column]
+        valid = ~np.isnat(dates)
+        if group == 'week':
+            # بداية الأسبوع (الاثنين): 1970-01-01 كان يوم خميس
+            days = dates.astype(np.int64)
+            dates = (days - (days + 3) % 7).astype('datetime64[D]')
+        elif group == 'month':
+            dates = dates.astype('datetime64[M]')
+        return dates, valid, column
+    column = schema.column_order[int(group[len('col_'):])]
+    keys = data.texts[column]
+    return keys, keys != '', column
+
+
+def aggregate(data: ReportData, schema, group: str) -> dict:
+    """حساب العدد والمجموع والمتوسط لكل عمود رقمي في كل مجموعة"""
+    keys, valid, column = group_keys(data, schema, group)
+    labels, inverse = np.unique(keys[valid], return_inverse=True)
+    if np.issubdtype(labels.dtype, np.datetime64):
+        # التحويل إلى نص للمجموعات فقط وليس لكل صف
+        labels = np.datetime_as_string(labels)
+    size = len(labels)
+    counts = np.bincount(inverse, minlength=size)
+    columns = {}
+    for name, values in data.numbers.items():
+        values = values[valid]
+        present = ~np.isnan(values)
+        sums = np.bincount(inverse, weights=np.where(present, values, 0.0), minlength=size)
+        filled = np.bincount(inverse, weights=present, minlength=size)
+        averages = np.divide(sums, filled, out=np.full(size, np.nan), where=filled > 0)
+        total = float(sums.sum())
+        columns[name] = {
+            'sums': sums,
+            'averages': averages,
+            'total': total,
+            'average': total / filled.sum() if filled.sum() else np.nan
+        }
+    return {
+        'group_column': column,
+        'labels': labels,
+        'counts': counts,
+        'columns': columns,
+        'rows': int(valid.sum()),
+        'skipped': int(data.size - valid.sum())
+    }
+
+
+def _number(value: float) -> str:
+    if np.isnan(value):
+        return '-'
+    if float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+
+def format_report(sheet_key: str, group: str, result: dict) -> str:
+    """نص التقرير: المجموعات الأحدث (أو الأكبر) أولاً مع الإجماليات"""
+    labels = result['labels']
+    order = np.arange(len(labels))
+    if group in TIME_GROUPINGS:
+        order = order[::-1]
+    elif result['columns']:
+        first = next(iter(result['columns'].values()))
+        order = np.argsort(-first['sums'], kind='stable')
+    shown = order[:config.REPORT_MAX_GROUPS]
+
+    title = TIME_GROUPINGS.get(group, f"حسب {result['group_column']}")
+    lines = [f"📊 تقرير {title} - {sheet_key}", ""]
+    for index in shown:
+        parts = [f"العدد {int(result['counts'][index])}"]
+        for name, column in result['columns'].items():
+            parts.append(
+                f"{name}: مجموع {_number(column['sums'][index])}، متوسط {_number(column['averages'][index])}"
+            )
+        lines.append(f"▫️ {labels[index]}: " + " | ".join(parts))
+    if len(labels) > len(shown):
+        lines.append(f"... و {len(labels) - len(shown)} مجموعة أخرى")
+
+    lines.append("")
+    lines.append(f"الإجمالي: {result['rows']} صف في {len(labels)} مجموعة")
+    for name, column in result['columns'].items():
+        lines.append(f"{name}: مجموع {_number(column['total'])}، متوسط {_number(column['average'])}")
+    if result['skipped']:
+        lines.append(f"ℹ️ {result['skipped']} صف بدون قيمة في {result['group_column']} لم يتم احتسابها")
+    text = "\n".join(lines)
+    # حد طول رسالة Telegram
+    return text if len(text) <= 4000 else text[:3990] + "\n..."
+
+
+class _LRUCache:
+    """تخزين مؤقت بحد أقصى لعدد العناصر"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+
+class ReportEngine:
+    """إنشاء التقارير مع تخزين المصفوفات والنتائج حسب إصدار البيانات"""
+
+    def __init__(self):
+        self._data = _LRUCache(config.REPORT_CACHE_SIZE)
+        self._reports = _LRUCache(config.REPORT_CACHE_SIZE)
+        self.hits = 0
+        self.misses = 0
+
+    async def _load(self, schema, key: tuple) -> ReportData:
+        data = self._data.get(key)
+        if data is None:
+            rows = strip_header(await mirror.rows(schema.sheet_key), schema.column_order)
+            data = await asyncio.to_thread(ReportData, schema, rows)
+            self._data.put(key, data)
+        return data
+
+    async def build(self, schema, sheet_version: int, group: str) -> str:
+        """نص التقرير لجدول ونوع تجميع"""
+        # المزامنة البطيئة تكمل في الخلفية والتقرير يستخدم النسخة المحلية الحالية
+        await mirror.ensure_fresh(schema.sheet_key, schema.sheet_config, timeout=config.MIRROR_FRESH_WAIT)
+        state = await mirror.state(schema.sheet_key)
+        # قبل اكتمال أول مزامنة تكون النسخة المحلية فارغة أو جزئية
+        if state is None or not state['synced_at']:
+            raise ValueError("❌ لا توجد بيانات محلية لهذا الجدول بعد. الرجاء المحاولة لاحقاً")
+        data_version = state['version']
+
+        key = (schema.sheet_key, data_version, sheet_version)
+        text = self._reports.get(key + (group,))
+        if text is not None:
+            self.hits += 1
+            return text
+
+        self.misses += 1
+        data = await self._load(schema, key)
+        result = await asyncio.to_thread(aggregate, data, schema, group)
+        text = format_report(schema.sheet_key, group, result)
+        self._reports.put(key + (group,), text)
+        logger.info("تقرير %s للجدول %s: %d صف (إصدار البيانات %s)", group, schema.sheet_key, data.size, data_version)
+        return text
+
+    def stats(self) -> dict:
+        """إحصائيات التخزين المؤقت للتقارير"""
+        return {'report_cache_hits': self.hits, 'report_cache_misses': self.misses}
+
+
+reports = ReportEngine()
@@ -0,0 +1,254 @@
+"""
+فهرس بحث (inverted index) على الأعمدة النصية لكل جدول، مبني من النسخة المحلية.
+
+يتم توحيد النص العربي قبل الفهرسة والبحث: إزالة التشكيل والتطويل، وتوحيد أشكال الألف
+والهمزة والتاء المربوطة والألف المقصورة، وتحويل الأرقام العربية إلى لاتينية. كل كلمة
+تفهرس أيضاً بدون "ال" التعريف. البحث يطابق بداية الكلمات ويرجع الصفوف التي تحتوي على
+جميع كلمات البحث، الأحدث أولاً.
+الفهرس يحدث بإضافة الصفوف الجديدة فقط طالما لم تعدل أو تحذف صفوف موجودة (رقم الحقبة
+في النسخة المحلية)، وإلا يعاد بناؤه. بعد كل إرسال من الصندوق الصادر يتم تحديث الفهرس
+في الخلفية (schedule_update) حتى لا يتحمل أول بحث بعد الإضافة تكلفة الفهرسة.
+نتائج البحث المعروضة للتصفح تحفظ هنا بعدد محدود لجميع المستخدمين، وليس في user_data.
+"""
+import asyncio
+import bisect
+import itertools
+import logging
+import re
+from collections import OrderedDict
+
+import config
+from sheet_mirror import mirror, strip_header
+from sheet_schema import normalize_digits
+
+logger = logging.getLogger(__name__)
+
+# التشكيل وعلامة المد والتطويل
+_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+_LETTERS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه',
+    'ى': 'ي',
+    'ؤ': 'و',
+    'ئ': 'ي',
+})
+_TOKEN = re.compile(r'\w+')
+
+
+def normalize_arabic(text: str) -> str:
+    """توحيد النص العربي للبحث"""
+    text = _DIACRITICS.sub('', normalize_digits(str(text)))
+    return text.translate(_LETTERS).lower()
+
+
+def tokenize(text: str) -> list:
+    """كلمات النص بعد التوحيد"""
+    return _TOKEN.findall(normalize_arabic(text))
+
+
+def _without_article(token: str) -> str:
+    if token.startswith('ال') and len(token) > 3:
+        return token[2:]
+    return token
+
+
+def index_terms(text: str) -> set:
+    """الكلمات المفهرسة لنص: كل كلمة، وبدون "ال" التعريف إن وجدت"""
+    terms = set()
+    for token in tokenize(text):
+        terms.add(token)
+        terms.add(_without_article(token))
+    return terms
+
+
+def query_terms(text: str) -> list:
+    """كلمات البحث بدون "ال" التعريف، لتطابق الكلمة مع "ال" وبدونها"""
+    return [_without_article(token) for token in tokenize(text)]
+
+
+class SheetIndex:
+    """فهرس جدول واحد: الكلمة -> أرقام الصفوف (تصاعدياً)"""
+
+    def __init__(self, sheet_key: str, epoch: int, sheet_version: int, columns: list):
+        self.sheet_key = sheet_key
+        self.epoch = epoch
+        self.sheet_version = sheet_version
+        self.version = None
+        self.columns = columns
+        self.last_row = 0
+        self.postings = {}
+        self.vocabulary = []
+
+    def add_rows(self, rows: list):
+        """فهرسة صفوف جديدة (أرقامها أكبر من آخر صف مفهرس)"""
+        new_terms = []
+        for row_number, values in rows:
+            terms = set()
+            for index in self.columns:
+                if index < len(values) and values[index]:
+                    terms |= index_terms(values[index])
+            for term in terms:
+                posting = self.postings.get(term)
+                if posting is None:
+                    self.postings[term] = [row_number]
+                    new_terms.append(term)
+                else:
+                    posting.append(row_number)
+            self.last_row = max(self.last_row, row_number)
+        if new_terms:
+            self.vocabulary = sorted(self.vocabulary + new_terms)
+
+    def _matching(self, token: str) -> set:
+        """الصفوف التي تحتوي على كلمة تبدأ بـ token"""
+        rows = set()
+        position = bisect.bisect_left(self.vocabulary, token)
+        while position < len(self.vocabulary) and self.vocabulary[position].startswith(token):
+            rows.update(self.postings[self.vocabulary[position]])
+            position += 1
+        return rows
+
+    def search(self, tokens: list) -> list:
+        """أرقام الصفوف التي تحتوي على جميع الكلمات، الأحدث أولاً"""
+        result = None
+        # البدء بالكلمات الأطول لأنها غالباً الأقل نتائج
+        for token in sorted(tokens, key=len, reverse=True):
+            rows = self._matching(token)
+            result = rows if result is None else result & rows
+            if not result:
+                return []
+        return sorted(result or (), reverse=True)
+
+
+class SearchIndex:
+    """فهارس جميع الجداول مع تحديثها من النسخة المحلية عند البحث"""
+
+    def __init__(self):
+        self._indexes = {}
+        self._locks = {}
+        self._pending = set()  # الجداول التي لها تحديث في الخلفية لم يبدأ بعد
+        self._tasks = set()
+        self._results = OrderedDict()  # (معرف المستخدم، معرف البحث) -> النتائج
+        self._search_ids = itertools.count(1)
+        self.rebuilds = 0
+        self.incremental_updates = 0
+        self.background_updates = 0
+
+    def _lock(self, sheet_key: str) -> asyncio.Lock:
+        if sheet_key not in self._locks:
+            self._locks[sheet_key] = asyncio.Lock()
+        return self._locks[sheet_key]
+
+    async def _refresh(self, schema, sheet_version: int):
+        """تحديث فهرس جدول: إضافة الصفوف الجديدة فقط، أو إعادة البناء إذا تغيرت صفوف موجودة"""
+        sheet_key = schema.sheet_key
+        async with self._lock(sheet_key):
+            # المزامنة البطيئة تكمل في الخلفية والبحث يستخدم النسخة المحلية الحالية
+            await mirror.ensure_fresh(sheet_key, schema.sheet_config, timeout=config.MIRROR_FRESH_WAIT)
+            state = await mirror.state(sheet_key)
+            if state is None:
+                return None
+
+            index = self._indexes.get(sheet_key)
+            if index is not None and index.version == state['version']:
+                return index
+            if index is None or index.epoch != state['epoch'] or index.sheet_version != sheet_version:
+                # إعادة البناء في خيط منفصل على فهرس جديد لم يستخدمه أي بحث بعد
+                columns = [
+                    position for position, column in enumerate(schema.column_order)
+                    if schema.columns[column].type == 'text'
+                ]
+                index = SheetIndex(sheet_key, state['epoch'], sheet_version, columns)
+                rows = strip_header(await mirror.rows(sheet_key), schema.column_order)
+                await asyncio.to_thread(index.add_rows, rows)
+                self.rebuilds += 1
+            else:
+                await self._add_new_rows(index)
+                self.incremental_updates += 1
+            index.version = state['version']
+            self._indexes[sheet_key] = index
+            return index
+
+    @staticmethod
+    async def _add_new_rows(index: SheetIndex):
+        # الصفوف الجديدة فقط، في حلقة الأحداث حتى لا يتغير الفهرس أثناء بحث آخر
+        index.add_rows(await mirror.rows(index.sheet_key, index.last_row + 1))
+
+    def schedule_update(self, sheet_key: str):
+        """تحديث فهرس الجدول في الخلفية بعد إضافة صفوف إلى نسخته المحلية (إذا كان مفهرساً)"""
+        if sheet_key not in self._indexes or sheet_key in self._pending:
+            return
+        self._pending.add(sheet_key)
+        task = asyncio.get_running_loop().create_task(self._update(sheet_key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update(self, sheet_key: str):
+        """إضافة الصفوف الجديدة إلى فهرس موجود دون مزامنة مع Google Sheets"""
+        try:
+            async with self._lock(sheet_key):
+                # الصفوف التي تضاف بعد هذه النقطة تجدول تحديثاً جديداً
+                self._pending.discard(sheet_key)
+                index = self._indexes.get(sheet_key)
+                state = await mirror.state(sheet_key)
+                if index is None or state is None or index.version == state['version']:
+                    return
+                if index.epoch != state['epoch']:
+                    # تغيرت صفوف موجودة، فيعاد بناء الفهرس عند البحث التالي
+                    return
+                await self._add_new_rows(index)
+                index.version = state['version']
+                self.background_updates += 1
+        except Exception as e:
+            self._pending.discard(sheet_key)
+            logger.warning("تعذر تحديث فهرس البحث للجدول %s: %s", sheet_key, e)
+
+    async def search(self, schemas: list, text: str, limit: int) -> list:
+        """البحث في عدة جداول. schemas قائمة (المخطط، إصدار الإعدادات).
+
+        يرجع قائمة (مفتاح الجدول، رقم الصف) بحد أقصى limit.
+        """
+        tokens = query_terms(text)
+        if not tokens:
+            return []
+        results = []
+        for schema, sheet_version in schemas:
+            index = await self._refresh(schema, sheet_version)
+            if index is None:
+                continue
+            results.extend((schema.sheet_key, row_number) for row_number in index.search(tokens))
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    def save_results(self, user_id: str, results: list) -> int:
+        """حفظ نتائج بحث للتصفح وإرجاع معرفه. يحفظ آخر FIND_CACHE_SIZE بحث فقط"""
+        search_id = next(self._search_ids)
+        self._results[(user_id, search_id)] = results
+        while len(self._results) > config.FIND_CACHE_SIZE:
+            self._results.popitem(last=False)
+        return search_id
+
+    def get_results(self, user_id: str, search_id: int):
+        """نتائج بحث محفوظ، أو None إذا لم يعد محفوظاً"""
+        results = self._results.get((user_id, search_id))
+        if results is not None:
+            self._results.move_to_end((user_id, search_id))
+        return results
+
+    def drop_results(self, user_id: str, search_id: int):
+        """حذف نتائج بحث سابق للمستخدم"""
+        self._results.pop((user_id, search_id), None)
+
+    def stats(self) -> dict:
+        """إحصائيات الفهارس"""
+        return {
+            'search_indexes': len(self._indexes),
+            'search_saved_results': len(self._results),
+            'search_terms': sum(len(index.postings) for index in self._indexes.values()),
+            'search_rebuilds': self.rebuilds,
+            'search_incremental_updates': self.incremental_updates,
+            'search_background_updates': self.background_updates
+        }
+
+
+search_index = SearchIndex()
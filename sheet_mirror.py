@@ -0,0 +1,410 @@
+"""
+نسخة محلية (mirror) من كل ورقة عمل مهيأة في SQLite، للاستعلامات دون استدعاء Google Sheets.
+
+يتم حفظ عدد الصفوف المعروف لكل جدول، والمزامنة تجلب الصفوف التي بعده فقط على صفحات.
+في كل مزامنة يعاد جلب آخر صف معروف مع الصفحة الأولى، وإذا تغير (حذف أو تعديل صفوف
+في الجدول) تتم إعادة المزامنة كاملة، كما تتم مزامنة كاملة دورية لالتقاط التعديلات
+في وسط الجدول. الصفوف التي يضيفها البوت نفسه تضاف فوراً إلى النسخة المحلية باستخدام
+أرقام الصفوف التي يرجعها values.append.
+كل تغيير في صفوف جدول يزيد رقم إصدار بياناته، ليتمكن القراء من تخزين نتائجهم مؤقتاً.
+أما رقم الحقبة (epoch) فيتغير فقط عند تعديل أو حذف صفوف موجودة، لذلك إذا لم يتغير
+يمكن للقراء تحديث بياناتهم بإضافة الصفوف الجديدة فقط.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+
+import config
+import sheets_client
+from log_config import SAMPLED
+from append_queue import target_key
+from config_store import config_store
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mirror_state (
+    sheet_key TEXT PRIMARY KEY,
+    target TEXT NOT NULL,
+    row_count INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0,
+    epoch INTEGER NOT NULL DEFAULT 0,
+    synced_at REAL NOT NULL DEFAULT 0,
+    full_synced_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS mirror_rows (
+    sheet_key TEXT NOT NULL,
+    row_number INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (sheet_key, row_number)
+) WITHOUT ROWID;
+"""
+
+
+def _target(sheet_config: dict) -> str:
+    """بصمة ورقة العمل المحفوظة مع النسخة المحلية"""
+    return json.dumps(list(target_key(sheet_config)), ensure_ascii=False)
+
+
+def normalize_row(row) -> list:
+    """توحيد الصف للمقارنة: نصوص بدون الخلايا الفارغة في النهاية"""
+    values = [str(value) for value in row or ()]
+    while values and values[-1] == '':
+        values.pop()
+    return values
+
+
+def strip_header(rows: list, column_order) -> list:
+    """إزالة سطر العناوين إذا كان أول صف في الجدول يطابق أسماء الأعمدة"""
+    if rows and rows[0][0] == 1 and set(normalize_row(rows[0][1])) & set(column_order):
+        return rows[1:]
+    return rows
+
+
+class SheetMirror:
+    """النسخة المحلية من جميع الجداول"""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._conn = None
+        # اتصال SQLite واحد يعمل في خيط واحد مخصص
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mirror')
+        self._locks = {}
+        self._refreshes = {}  # مزامنات الاستعلامات الجارية في الخلفية لكل جدول
+        self._task = None
+        self._wakeup = None
+        self._stopping = False
+        self.syncs = 0
+        self.full_syncs = 0
+        self.rows_fetched = 0
+        self.rows_recorded = 0
+        self.stale_reads = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path or config.MIRROR_DB_PATH, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # النسخة المحلية يمكن إعادة بنائها من الجدول، لذلك لا حاجة لمزامنة كاملة مع القرص
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            # قواعد البيانات المنشأة قبل إضافة رقم الحقبة
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(mirror_state)')}
+            if 'epoch' not in columns:
+                conn.execute('ALTER TABLE mirror_state ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0')
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _lock(self, sheet_key: str) -> asyncio.Lock:
+        if sheet_key not in self._locks:
+            self._locks[sheet_key] = asyncio.Lock()
+        return self._locks[sheet_key]
+
+    # --- عمليات قاعدة البيانات (تعمل في خيط النسخة المحلية) ---
+
+    def _get_state(self, sheet_key: str):
+        row = self._connect().execute(
+            "SELECT target, row_count, version, epoch, synced_at, full_synced_at FROM mirror_state WHERE sheet_key = ?",
+            (sheet_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('target', 'row_count', 'version', 'epoch', 'synced_at', 'full_synced_at'), row))
+
+    def _reset(self, sheet_key: str, target: str):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM mirror_rows WHERE sheet_key = ?", (sheet_key,))
+            conn.execute(
+                "INSERT INTO mirror_state (sheet_key, target, row_count, version) VALUES (?, ?, 0, 1) "
+                "ON CONFLICT(sheet_key) DO UPDATE SET target = excluded.target, row_count = 0, "
+                "version = version + 1, epoch = epoch + 1",
+                (sheet_key, target)
+            )
+
+    def _store_rows(self, sheet_key: str, start_row: int, rows: list, row_count: int):
+        conn = self._connect()
+        with conn:
+            last_row = conn.execute(
+                "SELECT COALESCE(MAX(row_number), 0) FROM mirror_rows WHERE sheet_key = ?", (sheet_key,)
+            ).fetchone()[0]
+            records = [
+                (sheet_key, start_row + offset, json.dumps(normalize_row(row), ensure_ascii=False))
+                for offset, row in enumerate(rows)
+            ]
+            before = conn.total_changes
+            # الصفوف التي لم تتغير لا تعد تغييراً حتى لا يتغير رقم الإصدار دون داع
+            conn.executemany(
+                "INSERT INTO mirror_rows (sheet_key, row_number, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(sheet_key, row_number) DO UPDATE SET data = excluded.data "
+                "WHERE data != excluded.data",
+                [record for record in records if record[1] <= last_row]
+            )
+            rewritten = conn.total_changes - before
+            conn.executemany(
+                "INSERT OR REPLACE INTO mirror_rows (sheet_key, row_number, data) VALUES (?, ?, ?)",
+                [record for record in records if record[1] > last_row]
+            )
+            changed = conn.total_changes - before
+            conn.execute(
+                "UPDATE mirror_state SET row_count = ?, version = version + ?, epoch = epoch + ? WHERE sheet_key = ?",
+                (row_count, 1 if changed else 0, 1 if rewritten else 0, sheet_key)
+            )
+
+    def _finish_sync(self, sheet_key: str, row_count: int, full: bool):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            deleted = 0
+            if full:
+                # الصفوف التي حذفت من الجدول منذ آخر مزامنة
+                deleted = conn.execute(
+                    "DELETE FROM mirror_rows WHERE sheet_key = ? AND row_number > ?",
+                    (sheet_key, row_count)
+                ).rowcount
+            conn.execute(
+                "UPDATE mirror_state SET row_count = ?, version = version + ?, epoch = epoch + ?, synced_at = ?, "
+                "full_synced_at = CASE WHEN ? THEN ? ELSE full_synced_at END WHERE sheet_key = ?",
+                (row_count, 1 if deleted else 0, 1 if deleted else 0, now, full, now, sheet_key)
+            )
+
+    def _record(self, sheet_key: str, target: str, start_row: int, rows: list) -> bool:
+        state = self._get_state(sheet_key)
+        if state is None or state['target'] != target:
+            return False
+        row_count = state['row_count']
+        # إذا وجدت فجوة (صفوف أضيفت من خارج البوت) تملؤها المزامنة التالية
+        if start_row <= row_count + 1:
+            row_count = max(row_count, start_row + len(rows) - 1)
+        self._store_rows(sheet_key, start_row, rows, row_count)
+        return True
+
+    def _get_row(self, sheet_key: str, row_number: int) -> list:
+        row = self._connect().execute(
+            "SELECT data FROM mirror_rows WHERE sheet_key = ? AND row_number = ?",
+            (sheet_key, row_number)
+        ).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def _rows(self, sheet_key: str, start_row: int) -> list:
+        rows = self._connect().execute(
+            "SELECT row_number, data FROM mirror_rows WHERE sheet_key = ? AND row_number >= ? ORDER BY row_number",
+            (sheet_key, start_row)
+        ).fetchall()
+        return [(row_number, json.loads(data)) for row_number, data in rows]
+
+    def _get_rows(self, sheet_key: str, row_numbers: list) -> dict:
+        conn = self._connect()
+        result = {}
+        for row_number in row_numbers:
+            row = conn.execute(
+                "SELECT data FROM mirror_rows WHERE sheet_key = ? AND row_number = ?",
+                (sheet_key, row_number)
+            ).fetchone()
+            if row:
+                result[row_number] = json.loads(row[0])
+        return result
+
+    def _drop(self, sheet_keys: list):
+        conn = self._connect()
+        with conn:
+            for sheet_key in sheet_keys:
+                conn.execute("DELETE FROM mirror_rows WHERE sheet_key = ?", (sheet_key,))
+                conn.execute("DELETE FROM mirror_state WHERE sheet_key = ?", (sheet_key,))
+
+    def _list_keys(self) -> list:
+        return [row[0] for row in self._connect().execute("SELECT sheet_key FROM mirror_state")]
+
+    # --- الواجهة ---
+
+    async def sync(self, sheet_key: str, sheet_config: dict, full: bool = False) -> int:
+        """جلب الصفوف الجديدة لجدول من Google Sheets. يرجع عدد الصفوف التي تم جلبها"""
+        async with self._lock(sheet_key):
+            target = _target(sheet_config)
+            state = await self._run(self._get_state, sheet_key)
+            if state is None or state['target'] != target:
+                await self._run(self._reset, sheet_key, target)
+                full = True
+            # المزامنة الكاملة تعيد جلب جميع الصفوف فوق النسخة الحالية، فيبقى القراء على
+            # البيانات السابقة حتى تكتمل بدلاً من رؤية جدول فارغ
+            row_count = 0 if full else state['row_count']
+
+            page_size = config.MIRROR_PAGE_SIZE
+            fetched = 0
+            # الصفحة الأولى تبدأ من آخر صف معروف للتحقق من أنه لم يتغير
+            check_last = row_count > 0
+            while True:
+                start = row_count if check_last else row_count + 1
+                values = await sheets_client.run_on_worksheet(
+                    sheet_config, gspread.Worksheet.get_values, f"{start}:{start + page_size - 1}"
+                )
+                received = len(values)
+                if check_last:
+                    check_last = False
+                    expected = await self._run(self._get_row, sheet_key, row_count)
+                    if normalize_row(values[0] if values else []) != expected:
+                        logger.info(f"تغير آخر صف معروف في {sheet_key}، ستتم إعادة المزامنة كاملة")
+                        row_count = 0
+                        fetched = 0
+                        full = True
+                        continue
+                    values = values[1:]
+                if values:
+                    await self._run(self._store_rows, sheet_key, row_count + 1, values, row_count + len(values))
+                    row_count += len(values)
+                    fetched += len(values)
+                if received < page_size:
+                    break
+
+            await self._run(self._finish_sync, sheet_key, row_count, full)
+            self.syncs += 1
+            self.rows_fetched += fetched
+            if full:
+                self.full_syncs += 1
+            if fetched:
+                logger.info(
+                    "مزامنة %s: تم جلب %d صف (الإجمالي %d)", sheet_key, fetched, row_count, extra=SAMPLED
+                )
+            return fetched
+
+    async def ensure_fresh(self, sheet_key: str, sheet_config: dict, max_age: float = None, timeout: float = None):
+        """المزامنة إذا كانت النسخة المحلية أقدم من max_age ثانية.
+
+        المزامنة تعمل كمهمة في الخلفية مشتركة بين الاستعلامات المتزامنة لنفس الجدول،
+        وينتظرها المستدعي timeout ثانية على الأكثر (None بدون حد) ثم يكمل بالنسخة
+        المحلية الحالية. أخطاء المزامنة تسجل في السجل ولا ترفع إلى المستدعي.
+        """
+        max_age = config.MIRROR_MAX_AGE if max_age is None else max_age
+        state = await self._run(self._get_state, sheet_key)
+        if state is not None and state['target'] == _target(sheet_config) and time.time() - state['synced_at'] <= max_age:
+            return
+        task = self._refreshes.get(sheet_key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self.sync(sheet_key, sheet_config))
+            self._refreshes[sheet_key] = task
+            task.add_done_callback(lambda done: self._refresh_done(sheet_key, done))
+        try:
+            # shield: انتهاء مهلة الانتظار لا يلغي المزامنة نفسها
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            self.stale_reads += 1
+            logger.info(
+                "مزامنة %s لم تكتمل خلال %.1f ثانية، سيتم استخدام النسخة المحلية", sheet_key, timeout,
+                extra=SAMPLED
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # سجلت في _refresh_done
+            pass
+
+    def _refresh_done(self, sheet_key: str, task: asyncio.Task):
+        if self._refreshes.get(sheet_key) is task:
+            del self._refreshes[sheet_key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                f"تعذرت مزامنة {sheet_key} عند الاستعلام، سيتم استخدام النسخة المحلية: {str(task.exception())}"
+            )
+
+    async def record_appended(self, sheet_key: str, sheet_config: dict, start_row: int, rows: list):
+        """إضافة صفوف أرسلها البوت إلى النسخة المحلية فوراً"""
+        if start_row is None or not rows:
+            return
+        # القراءة والكتابة في نفس خيط قاعدة البيانات دون انتظار مزامنة جارية لنفس الجدول
+        if await self._run(self._record, sheet_key, _target(sheet_config), start_row, rows):
+            self.rows_recorded += len(rows)
+
+    async def rows(self, sheet_key: str, start_row: int = 1) -> list:
+        """صفوف الجدول من النسخة المحلية: قائمة (رقم الصف، القيم)"""
+        return await self._run(self._rows, sheet_key, start_row)
+
+    async def get_rows(self, sheet_key: str, row_numbers: list) -> dict:
+        """صفوف محددة من النسخة المحلية: {رقم الصف: القيم}"""
+        return await self._run(self._get_rows, sheet_key, row_numbers)
+
+    async def state(self, sheet_key: str):
+        """حالة النسخة المحلية لجدول (version و epoch و row_count...)، أو None إذا لم تتم مزامنته"""
+        return await self._run(self._get_state, sheet_key)
+
+    async def version(self, sheet_key: str) -> int:
+        """رقم إصدار بيانات الجدول (يتغير مع كل تغيير في صفوفه)، أو None إذا لم تتم مزامنته"""
+        state = await self._run(self._get_state, sheet_key)
+        return state['version'] if state else None
+
+    async def sync_all(self):
+        """مزامنة جميع الجداول المهيأة وحذف نسخ الجداول المحذوفة من الإعدادات"""
+        snapshot = config_store.get()
+        removed = [key for key in await self._run(self._list_keys) if key not in snapshot.sheets]
+        if removed:
+            await self._run(self._drop, removed)
+            logger.info(f"تم حذف النسخ المحلية للجداول المحذوفة: {removed}")
+        for sheet_key, sheet_config in snapshot.sheets.items():
+            if self._stopping:
+                break
+            try:
+                state = await self._run(self._get_state, sheet_key)
+                full = state is None or time.time() - state['full_synced_at'] > config.MIRROR_FULL_SYNC_INTERVAL
+                await self.sync(sheet_key, sheet_config, full=full)
+            except Exception as e:
+                logger.warning(f"تعذرت مزامنة النسخة المحلية للجدول {sheet_key}: {str(e)}")
+
+    async def start(self):
+        """بدء المزامنة الدورية في الخلفية"""
+        if config.MIRROR_SYNC_INTERVAL <= 0:
+            logger.info("المزامنة الدورية للنسخة المحلية معطلة")
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                await self.sync_all()
+            except Exception as e:
+                logger.error(f"خطأ في مزامنة النسخة المحلية: {str(e)}", exc_info=True)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=config.MIRROR_SYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        """إيقاف المزامنة الدورية ومزامنات الاستعلامات الجارية"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self._refreshes:
+            await asyncio.gather(*list(self._refreshes.values()), return_exceptions=True)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        """إغلاق قاعدة البيانات"""
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        """إحصائيات المزامنة"""
+        return {
+            'mirror_syncs': self.syncs,
+            'mirror_full_syncs': self.full_syncs,
+            'mirror_rows_fetched': self.rows_fetched,
+            'mirror_rows_recorded': self.rows_recorded,
+            'mirror_stale_reads': self.stale_reads
+        }
+
+
+mirror = SheetMirror()
@@ -0,0 +1,261 @@
+"""
+مخطط مترجم لكل جدول.
+
+يتم تحويل إعدادات كل جدول مرة واحدة عند تحميل الإعدادات إلى SheetSchema يحتوي على
+ترتيب الأعمدة المطلوب إدخالها (بدون الأعمدة التلقائية)، ومجموعات الأعمدة الاختيارية
+والإلزامية، ودالة تحليل وتحقق لكل عمود حسب نوعه، ودالة بناء الصف حسب column_order.
+"""
+import csv
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# تحويل الأرقام العربية-الهندية والفارسية إلى أرقام لاتينية
+_DIGITS = {ord(c): str(i) for i, c in enumerate('٠١٢٣٤٥٦٧٨٩')}
+_DIGITS.update({ord(c): str(i) for i, c in enumerate('۰۱۲۳۴۵۶۷۸۹')})
+_DIGITS.update({ord('٫'): '.', ord('٬'): None, ord('،'): None})
+
+DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%d/%m/%Y', '%d-%m-%Y')
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y/%m/%d %H:%M', '%d/%m/%Y %H:%M', '%d-%m-%Y %H:%M')
+TODAY_WORDS = frozenset({'اليوم', 'today'})
+
+
+def normalize_digits(text: str) -> str:
+    """تحويل الأرقام العربية إلى لاتينية وإزالة فواصل الآلاف العربية"""
+    return text.translate(_DIGITS)
+
+
+def parse_text(value: str, options: dict = None) -> str:
+    """التحقق من قيمة نصية"""
+    value = value.strip()
+    if not value:
+        raise ValueError("❌ الرجاء إدخال قيمة")
+    return value
+
+
+def parse_number(value: str, options: dict = None) -> str:
+    """التحقق من قيمة رقمية وإرجاعها بأرقام لاتينية"""
+    value = normalize_digits(value.strip()).replace(',', '')
+    try:
+        float(value)
+    except ValueError:
+        raise ValueError("❌ الرجاء إدخال رقم صحيح")
+    return value
+
+
+def date_format(options: dict = None) -> str:
+    """صيغة حفظ التاريخ حسب خيار include_time"""
+    if options and options.get('include_time'):
+        return '%Y-%m-%d %H:%M'
+    return '%Y-%m-%d'
+
+
+def parse_date(value: str, options: dict = None) -> str:
+    """التحقق من قيمة تاريخ وإرجاعها بالصيغة الموحدة"""
+    value = normalize_digits(value.strip())
+    if value.lower() in TODAY_WORDS:
+        return datetime.now().strftime(date_format(options))
+    for fmt in DATETIME_FORMATS + DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime(date_format(options))
+        except ValueError:
+            continue
+    raise ValueError("❌ الرجاء إدخال تاريخ صحيح بالشكل YYYY-MM-DD")
+
+
+def split_line(line: str) -> list:
+    """تقسيم سطر إدخال جماعي: | أو Tab (نسخ من جدول) أو فاصلة بصيغة CSV"""
+    if '|' in line:
+        return [value.strip() for value in line.split('|')]
+    if '\t' in line:
+        delimiter = '\t'
+    elif ',' not in line and '،' in line:
+        delimiter = '،'
+    else:
+        delimiter = ','
+    return [value.strip() for value in next(csv.reader([line], delimiter=delimiter))]
+
+
+PARSERS = {
+    'text': parse_text,
+    'number': parse_number,
+    'date': parse_date,
+}
+
+
+class ColumnSpec:
+    """وصف عمود واحد: النوع ودالة التحليل والخيارات"""
+
+    __slots__ = ('name', 'type', 'options', 'optional', 'required', 'auto', '_parser')
+
+    def __init__(self, name: str, column_type: str, options: dict, optional: bool, required: bool):
+        self.name = name
+        self.type = column_type if column_type in PARSERS else 'text'
+        self.options = options or {}
+        self.optional = optional
+        self.required = required
+        self.auto = self.type == 'date' and bool(self.options.get('auto', False))
+        self._parser = PARSERS[self.type]
+
+    def parse(self, value: str) -> str:
+        """تحليل القيمة المدخلة والتحقق منها؛ يرفع ValueError برسالة للمستخدم"""
+        return self._parser(value, self.options)
+
+    def auto_value(self) -> str:
+        """القيمة التلقائية للعمود (التاريخ الحالي)"""
+        return datetime.now().strftime(date_format(self.options))
+
+
+class SheetSchema:
+    """مخطط جدول مترجم من إعداداته"""
+
+    def __init__(self, sheet_key: str, sheet_config: dict):
+        self.sheet_key = sheet_key
+        self.sheet_config = sheet_config
+        self.column_order = tuple(sheet_config.get('column_order', ()))
+        self.required_columns = tuple(sheet_config.get('required_columns', ()))
+        self.optional = frozenset(sheet_config.get('optional_columns', ()))
+        self.required = frozenset(self.required_columns)
+
+        column_types = sheet_config.get('column_types', {})
+        date_options = sheet_config.get('date_options', {}) or {}
+        self.columns = {
+            name: ColumnSpec(
+                name,
+                column_types.get(name, 'text'),
+                date_options.get(name),
+                name in self.optional,
+                name in self.required
+            )
+            for name in self.column_order
+        }
+        self.auto_columns = tuple(name for name in self.column_order if self.columns[name].auto)
+        self.prompt_order = tuple(name for name in self.column_order if not self.columns[name].auto)
+
+    def is_optional(self, column: str) -> bool:
+        """هل يمكن تخطي العمود"""
+        return column in self.optional
+
+    def parse(self, column: str, value: str) -> str:
+        """تحليل قيمة عمود محدد"""
+        return self.columns[column].parse(value)
+
+    def initial_data(self) -> dict:
+        """بيانات الصف الأولية: قيم الأعمدة التلقائية"""
+        return {name: self.columns[name].auto_value() for name in self.auto_columns}
+
+    def missing_required(self, data: dict) -> list:
+        """الأعمدة الإلزامية التي لم يتم إدخالها"""
+        return [column for column in self.required_columns if not data.get(column)]
+
+    def _positional_columns(self, count: int) -> tuple:
+        """الأعمدة المقابلة للقيم المفصولة بـ |: أعمدة الإدخال، أو جميع الأعمدة إذا تطابق العدد"""
+        if count > len(self.prompt_order) and count == len(self.column_order):
+            return self.column_order
+        if count > len(self.prompt_order):
+            raise ValueError(
+                f"❌ عدد القيم ({count}) أكبر من عدد الأعمدة ({len(self.prompt_order)}).\n"
+                f"الترتيب المتوقع: {' | '.join(self.prompt_order)}"
+            )
+        return self.prompt_order
+
+    def split_structured(self, text: str):
+        """تقسيم رسالة منظمة إلى {العمود: النص}، أو None إذا لم تكن الرسالة منظمة.
+
+        الصيغ المدعومة: قيم مفصولة بـ | بعدد أعمدة الإدخال أو جميع الأعمدة بالترتيب،
+        أو سطور بالشكل عمود=قيمة. أي عدد آخر من القيم يعتبر نصاً عادياً يحتوي على |.
+        """
+        lines = [line.strip() for line in text.strip().splitlines() if line.strip()]
+        if lines and all('=' in line for line in lines):
+            pairs = [line.split('=', 1) for line in lines]
+            keys = [key.strip() for key, _ in pairs]
+            if any(key in self.columns for key in keys):
+                unknown = [key for key in keys if key not in self.columns]
+                if unknown:
+                    raise ValueError("❌ أعمدة غير معروفة: " + "، ".join(unknown))
+                return {key.strip(): value.strip() for key, value in pairs}
+        if '|' in text and len(lines) == 1:
+            values = [value.strip() for value in lines[0].split('|')]
+            for columns in (self.prompt_order, self.column_order):
+                if len(values) == len(columns):
+                    return dict(zip(columns, values))
+        return None
+
+    def parse_values(self, raw: dict) -> tuple:
+        """تحليل قيم عدة أعمدة دفعة واحدة.
+
+        يرجع (values, errors): القيم الصحيحة، ورسائل الخطأ للأعمدة التي فشل تحليلها.
+        القيم الفارغة للأعمدة الاختيارية تعتبر تخطياً، وللأعمدة الإلزامية خطأ.
+        """
+        values, errors = {}, {}
+        for column, value in raw.items():
+            if not value:
+                if column not in self.optional:
+                    errors[column] = "❌ الرجاء إدخال قيمة"
+                continue
+            try:
+                values[column] = self.parse(column, value)
+            except ValueError as e:
+                errors[column] = str(e)
+        return values, errors
+
+    def parse_line(self, values: list) -> tuple:
+        """تحويل قيم سطر واحد إلى صف كامل. يرجع (الصف، قائمة الأخطاء)"""
+        try:
+            columns = self._positional_columns(len(values))
+        except ValueError as e:
+            return None, [str(e)]
+        return self.parse_record(dict(zip(columns, values)))
+
+    def parse_record(self, raw: dict) -> tuple:
+        """تحويل {العمود: النص} إلى صف كامل. يرجع (الصف، قائمة الأخطاء)"""
+        parsed, errors = self.parse_values(raw)
+        messages = [f"{column}: {message}" for column, message in errors.items()]
+        messages += [
+            f"{column}: ❌ الرجاء إدخال قيمة"
+            for column in self.required_columns
+            if column not in raw and column not in errors and column not in self.auto_columns
+        ]
+        if messages:
+            return None, messages
+        data = self.initial_data()
+        data.update(parsed)
+        return self.build_row(data), []
+
+    def parse_bulk(self, text: str, max_rows: int = None) -> tuple:
+        """تحليل رسالة متعددة الأسطر، كل سطر صف.
+
+        يرجع (rows, errors): rows قائمة (رقم السطر، الصف)، و errors قائمة (رقم السطر، رسالة).
+        """
+        rows, errors = [], []
+        for line_no, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            if max_rows is not None and len(rows) + len(errors) >= max_rows:
+                errors.append((line_no, f"❌ تم تجاوز الحد الأقصى ({max_rows} سطر)"))
+                break
+            row, messages = self.parse_line(split_line(line))
+            if messages:
+                errors.append((line_no, "، ".join(messages)))
+            else:
+                rows.append((line_no, row))
+        return rows, errors
+
+    def build_row(self, data: dict) -> list:
+        """بناء الصف حسب column_order"""
+        return [data.get(column, '') for column in self.column_order]
+
+
+def compile_schemas(sheets: dict, previous=None) -> dict:
+    """ترجمة مخططات جميع الجداول، مع إعادة استخدام مخططات الجداول التي لم تتغير"""
+    schemas = {}
+    for key, sheet_config in sheets.items():
+        if previous is not None and previous.sheets.get(key) == sheet_config and key in previous.schemas:
+            schemas[key] = previous.schemas[key]
+            continue
+        try:
+            schemas[key] = SheetSchema(key, sheet_config)
+        except Exception as e:
+            logger.error(f"خطأ في إعدادات الجدول {key}: {str(e)}")
+    return schemas
@@ -0,0 +1,453 @@
+"""
+عميل Google Sheets مشترك على مستوى العملية.
+
+يتم إنشاء عميل واحد لكل حساب خدمة ويعاد استخدامه في جميع المعالجات،
+مع تجديد رمز الوصول قبل انتهاء صلاحيته وإعادة استخدام اتصالات HTTP المفتوحة.
+عند إعداد عدة حسابات خدمة يتم توزيع الطلبات عليها بالتناوب عبر ClientPool.
+جميع استدعاءات gspread المتزامنة تنفذ عبر run_blocking في مجمع خيوط محدود
+حتى لا تعطل حلقة الأحداث الخاصة بالبوت. انتظار حصص Google Sheets في run_on_worksheet
+يتم في حلقة الأحداث وليس داخل خيوط المجمع.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import gspread
+from google.auth.transport.requests import Request
+from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
+
+import config
+import metrics
+from rate_limiter import READ, WRITE, RateLimitedClient, RateLimitWait, deferred_waits, is_quota_error, limiter
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+
+class WorksheetCache:
+    """ذاكرة مؤقتة لكائنات Spreadsheet و Worksheet مفهرسة بمعرف الجدول spreadsheet_id"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spreadsheets = {}  # spreadsheet_id -> Spreadsheet
+        self._worksheets = {}  # (spreadsheet_id, worksheet_name) -> Worksheet
+        self._title_ids = {}  # sheet_name -> spreadsheet_id للجداول التي لا تحتوي على معرف
+        self._fingerprints = {}  # sheet_name -> بصمة إعدادات الجدول
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(sheet_config: dict) -> tuple:
+        """بصمة الحقول التي تحدد موقع ورقة العمل في الإعدادات"""
+        return (
+            sheet_config.get('spreadsheet_id') or '',
+            sheet_config.get('sheet_name', ''),
+            sheet_config.get('worksheet_name', '')
+        )
+
+    def _check_config(self, sheet_config: dict):
+        """إبطال المدخلات القديمة إذا تغيرت إعدادات الجدول"""
+        sheet_name = sheet_config.get('sheet_name', '')
+        fingerprint = self.fingerprint(sheet_config)
+        old = self._fingerprints.get(sheet_name)
+        if old is not None and old != fingerprint:
+            logger.info(f"تغيرت إعدادات الجدول {sheet_name}، سيتم إبطال الذاكرة المؤقتة")
+            old_id = old[0] or self._title_ids.get(sheet_name)
+            self._title_ids.pop(sheet_name, None)
+            if old_id:
+                self._drop(old_id)
+        self._fingerprints[sheet_name] = fingerprint
+
+    def _drop(self, spreadsheet_id: str, worksheet_name: str = None):
+        """حذف المدخلات الخاصة بجدول أو ورقة عمل محددة"""
+        if worksheet_name is not None:
+            self._worksheets.pop((spreadsheet_id, worksheet_name), None)
+            return
+        self._spreadsheets.pop(spreadsheet_id, None)
+        for key in [k for k in self._worksheets if k[0] == spreadsheet_id]:
+            del self._worksheets[key]
+        for title in [t for t, i in self._title_ids.items() if i == spreadsheet_id]:
+            del self._title_ids[title]
+
+    def _resolve_spreadsheet(self, client: gspread.Client, sheet_config: dict):
+        """فتح الجدول بالمعرف إن وجد، وإلا بالاسم مرة واحدة فقط"""
+        spreadsheet_id = sheet_config.get('spreadsheet_id') or self._title_ids.get(sheet_config['sheet_name'])
+        if spreadsheet_id:
+            spreadsheet = self._spreadsheets.get(spreadsheet_id)
+            if spreadsheet is None:
+                spreadsheet = client.open_by_key(spreadsheet_id)
+                self._spreadsheets[spreadsheet_id] = spreadsheet
+            return spreadsheet
+
+        spreadsheet = client.open(sheet_config['sheet_name'])
+        self._title_ids[sheet_config['sheet_name']] = spreadsheet.id
+        self._spreadsheets[spreadsheet.id] = spreadsheet
+        return spreadsheet
+
+    def get_worksheet(self, client: gspread.Client, sheet_config: dict) -> gspread.Worksheet:
+        """إرجاع ورقة العمل من الذاكرة المؤقتة أو فتحها وحفظها"""
+        worksheet_name = sheet_config['worksheet_name']
+        with self._lock:
+            self._check_config(sheet_config)
+            spreadsheet_id = sheet_config.get('spreadsheet_id') or self._title_ids.get(sheet_config['sheet_name'])
+            worksheet = self._worksheets.get((spreadsheet_id, worksheet_name)) if spreadsheet_id else None
+            if worksheet is not None:
+                self.hits += 1
+                return worksheet
+
+            self.misses += 1
+            try:
+                spreadsheet = self._resolve_spreadsheet(client, sheet_config)
+                worksheet = spreadsheet.worksheet(worksheet_name)
+            except gspread.exceptions.SpreadsheetNotFound:
+                if spreadsheet_id:
+                    self._drop(spreadsheet_id)
+                raise
+            except gspread.exceptions.WorksheetNotFound:
+                if spreadsheet_id:
+                    self._drop(spreadsheet_id, worksheet_name)
+                raise
+            self._worksheets[(spreadsheet.id, worksheet_name)] = worksheet
+            return worksheet
+
+    def invalidate(self, sheet_config: dict):
+        """إبطال ورقة العمل الخاصة بإعدادات جدول (عند حذفها أو تغيير صلاحياتها)"""
+        with self._lock:
+            spreadsheet_id = sheet_config.get('spreadsheet_id') or self._title_ids.get(sheet_config.get('sheet_name', ''))
+            if spreadsheet_id:
+                self._drop(spreadsheet_id)
+
+    def stats(self) -> dict:
+        """إحصائيات الذاكرة المؤقتة"""
+        return {
+            'worksheet_cache_size': len(self._worksheets),
+            'worksheet_cache_hits': self.hits,
+            'worksheet_cache_misses': self.misses
+        }
+
+
+class SheetsClient:
+    """عميل Google Sheets طويل العمر لحساب خدمة واحد"""
+
+    def __init__(self, credentials_file: str, max_retries: int = None):
+        self.credentials_file = credentials_file
+        self._lock = threading.Lock()
+        self.token_refreshes = 0
+        self.worksheets = WorksheetCache()
+
+        creds = ServiceAccountCredentials.from_json_keyfile_name(credentials_file, SCOPES)
+        # كل طلب يمر عبر محدد المعدل المشترك حسب حصص حساب الخدمة والجدول
+        self.client = RateLimitedClient(auth=creds)
+        self.client.account = self.service_account_email or credentials_file
+        self.client.set_timeout(config.SHEETS_HTTP_TIMEOUT)
+        self.client.max_retries = max_retries
+
+        # مجمع اتصالات keep-alive مشترك لجميع الطلبات
+        self._adapter = HTTPAdapter(
+            pool_connections=config.SHEETS_HTTP_POOL_SIZE,
+            pool_maxsize=config.SHEETS_HTTP_POOL_SIZE
+        )
+        self.client.session.mount('https://', self._adapter)
+
+    @property
+    def service_account_email(self) -> str:
+        """البريد الإلكتروني لحساب الخدمة"""
+        return getattr(self.client.auth, 'service_account_email', '')
+
+    def _token_expiring(self) -> bool:
+        """التحقق مما إذا كان الرمز سينتهي خلال هامش التجديد"""
+        creds = self.client.auth
+        if not creds.token or creds.expiry is None:
+            return True
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        margin = timedelta(seconds=config.SHEETS_TOKEN_REFRESH_MARGIN)
+        return creds.expiry - now <= margin
+
+    def ensure_fresh_token(self):
+        """تجديد رمز الوصول مسبقاً قبل انتهاء صلاحيته"""
+        if not self._token_expiring():
+            return
+        with self._lock:
+            # قد يكون خيط آخر قد جدد الرمز أثناء الانتظار
+            if not self._token_expiring():
+                return
+            self.client.auth.refresh(Request(self.client.session))
+            self.token_refreshes += 1
+            logger.info(f"تم تجديد رمز الوصول لحساب الخدمة: {self.service_account_email}")
+
+    def get_client(self) -> gspread.Client:
+        """إرجاع عميل gspread جاهز للاستخدام برمز صالح"""
+        self.ensure_fresh_token()
+        return self.client
+
+    def open_worksheet(self, sheet_config: dict) -> gspread.Worksheet:
+        """فتح ورقة العمل الخاصة بإعدادات الجدول باستخدام الذاكرة المؤقتة"""
+        return self.worksheets.get_worksheet(self.get_client(), sheet_config)
+
+    def connection_stats(self) -> dict:
+        """إحصائيات مجمع الاتصالات: عدد الاتصالات المفتوحة والطلبات التي أعادت استخدامها"""
+        connections = 0
+        requests_sent = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            'connections_opened': connections,
+            'requests_sent': requests_sent,
+            'connections_reused': max(requests_sent - connections, 0)
+        }
+
+    def stats(self) -> dict:
+        """إحصائيات العميل: الاستخدام وتجديدات الرمز وإعادة استخدام الاتصالات"""
+        stats = {
+            'account': self.client.account,
+            'read_requests': self.client.requests[READ],
+            'write_requests': self.client.requests[WRITE],
+            'quota_errors': self.client.quota_errors,
+            'token_refreshes': self.token_refreshes
+        }
+        stats.update(self.connection_stats())
+        stats.update(self.worksheets.stats())
+        return stats
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(credentials_file: str = None, max_retries: int = None) -> SheetsClient:
+    """الحصول على العميل المشترك لحساب الخدمة (يتم إنشاؤه مرة واحدة فقط).
+
+    max_retries يستخدم عند إنشاء العميل فقط: عدد مرات إعادة المحاولة بعد تجاوز الحصة.
+    """
+    credentials_file = credentials_file or config.GOOGLE_SHEETS_CREDENTIALS_FILE
+    client = _clients.get(credentials_file)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(credentials_file)
+        if client is None:
+            client = SheetsClient(credentials_file, max_retries)
+            _clients[credentials_file] = client
+            logger.info(f"تم إنشاء عميل Google Sheets مشترك: {credentials_file}")
+        return client
+
+
+def get_stats() -> dict:
+    """إحصائيات جميع العملاء المشتركين"""
+    return {path: client.stats() for path, client in _clients.items()}
+
+
+def is_permission_error(error: Exception) -> bool:
+    """هل الخطأ بسبب عدم مشاركة الجدول مع حساب الخدمة"""
+    if isinstance(error, gspread.exceptions.SpreadsheetNotFound):
+        return True
+    return (
+        isinstance(error, gspread.exceptions.APIError)
+        and error.response.status_code == 403
+        and not is_quota_error(error)
+    )
+
+
+class ClientPool:
+    """توزيع طلبات الجداول بالتناوب على حسابات الخدمة التي تملك صلاحية عليها.
+
+    الحساب الذي تجاوز حصته أو لا يملك صلاحية على الجدول يتم تجاوزه إلى الحساب التالي.
+    """
+
+    def __init__(self, credentials_files: list):
+        self.credentials_files = list(credentials_files)
+        self._lock = threading.Lock()
+        self._cursor = 0
+        self._denied = {}  # (ملف الحساب، بصمة الجدول) -> وقت اكتشاف عدم الصلاحية
+        self.failovers = 0
+        # مع عدة حسابات: الانتقال فوراً إلى حساب آخر بدلاً من انتظار انتهاء إيقاف هذا الحساب
+        self.max_retries = 0 if len(self.credentials_files) > 1 else None
+
+    def _client(self, credentials_file: str) -> SheetsClient:
+        return get_client(credentials_file, self.max_retries)
+
+    def _is_denied(self, credentials_file: str, spreadsheet: tuple) -> bool:
+        denied_at = self._denied.get((credentials_file, spreadsheet))
+        if denied_at is None:
+            return False
+        if time.monotonic() - denied_at > config.SHEETS_ACCESS_RECHECK:
+            self._denied.pop((credentials_file, spreadsheet), None)
+            return False
+        return True
+
+    def _candidates(self, spreadsheet: tuple) -> list:
+        """ترتيب الحسابات للطلب: بالتناوب، ثم الحسابات الموقوفة، ثم غير المصرح لها"""
+        with self._lock:
+            start = self._cursor
+            self._cursor = (self._cursor + 1) % len(self.credentials_files)
+        ordered = self.credentials_files[start:] + self.credentials_files[:start]
+        ready, blocked, denied = [], [], []
+        for credentials_file in ordered:
+            if self._is_denied(credentials_file, spreadsheet):
+                denied.append(credentials_file)
+                continue
+            client = self._client(credentials_file)
+            blocked_for = limiter.account_blocked_for(client.client.account)
+            if blocked_for > 0:
+                blocked.append((blocked_for, credentials_file))
+            else:
+                ready.append(credentials_file)
+        return ready + [path for _, path in sorted(blocked)] + denied
+
+    def call(self, sheet_config: dict, func, *args, **kwargs):
+        """تنفيذ func(worksheet, ...) على ورقة العمل باستخدام أول حساب متاح (استدعاء متزامن)"""
+        spreadsheet = WorksheetCache.fingerprint(sheet_config)[:2]
+        last_error = None
+        waits = []
+        for credentials_file in self._candidates(spreadsheet):
+            client = self._client(credentials_file)
+            try:
+                worksheet = client.open_worksheet(sheet_config)
+                result = func(worksheet, *args, **kwargs)
+                self._denied.pop((credentials_file, spreadsheet), None)
+                for wait in waits:
+                    wait.release()
+                return result
+            except RateLimitWait as e:
+                # لم يحن دور هذا الحساب بعد (وضع الانتظار المؤجل)، تجربة الحساب التالي
+                waits.append(e)
+                if e.error is not None and len(self.credentials_files) > 1:
+                    self.failovers += 1
+                continue
+            except Exception as e:
+                if is_permission_error(e):
+                    self._denied[(credentials_file, spreadsheet)] = time.monotonic()
+                    reason = "لا يملك صلاحية على الجدول"
+                elif isinstance(e, gspread.exceptions.APIError) and is_quota_error(e):
+                    reason = "تجاوز حصته"
+                else:
+                    # قد تكون ورقة العمل المحفوظة قد حذفت أو نقلت
+                    if isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 404:
+                        client.worksheets.invalidate(sheet_config)
+                    raise
+                last_error = e
+                if len(self.credentials_files) > 1:
+                    self.failovers += 1
+                    logger.warning(
+                        f"حساب الخدمة {client.client.account} {reason} "
+                        f"({sheet_config.get('sheet_name', '')})، سيتم استخدام حساب آخر"
+                    )
+        if waits:
+            # الانتظار للحساب الذي يحين دوره أولاً وإلغاء حجز بقية الحسابات
+            waits.sort(key=lambda wait: wait.delay)
+            for wait in waits[1:]:
+                wait.release()
+            raise waits[0]
+        raise last_error
+
+    def stats(self) -> dict:
+        """إحصائيات التوزيع على حسابات الخدمة"""
+        return {
+            'accounts': len(self.credentials_files),
+            'account_failovers': self.failovers,
+            'denied_spreadsheets': len(self._denied)
+        }
+
+    def account_stats(self) -> dict:
+        """إحصائيات كل حساب خدمة: إحصائيات عميله (الطلبات وأخطاء الحصة وتجديد الرمز والاتصالات)
+        مع مدة الإيقاف الحالية وعدد الجداول المرفوضة"""
+        stats = {}
+        for credentials_file in self.credentials_files:
+            client = _clients.get(credentials_file)
+            if client is None:
+                continue
+            account = client.client.account
+            stats[account] = client.stats()
+            stats[account]['blocked_seconds'] = round(limiter.account_blocked_for(account), 3)
+            stats[account]['denied_spreadsheets'] = sum(
+                1 for path, _ in list(self._denied) if path == credentials_file
+            )
+        return stats
+
+
+pool = ClientPool(config.GOOGLE_SHEETS_CREDENTIALS_FILES)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = 0
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """مجمع الخيوط المحدود الخاص باستدعاءات Google Sheets"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=config.SHEETS_MAX_CONCURRENCY,
+                    thread_name_prefix='sheets-io'
+                )
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """تنفيذ استدعاء متزامن خارج حلقة الأحداث وانتظار نتيجته"""
+    global _in_flight
+    loop = asyncio.get_running_loop()
+    _in_flight += 1
+    try:
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+    finally:
+        _in_flight -= 1
+
+
+def _call_deferred(reservation: list, sheet_config: dict, func, *args, **kwargs):
+    with deferred_waits(reservation):
+        return pool.call(sheet_config, func, *args, **kwargs)
+
+
+async def run_on_worksheet(sheet_config: dict, func, *args, **kwargs):
+    """تنفيذ func(worksheet, ...) على ورقة عمل الجدول عبر مجمع حسابات الخدمة خارج حلقة الأحداث.
+
+    إذا لم يحن دور الطلب في حصص Google Sheets أو تم تجاوز الحصة، يتم الانتظار هنا في حلقة
+    الأحداث دون حجز خيط من المجمع ثم إعادة الاستدعاء، حتى مرور RATE_LIMIT_DEADLINE ثانية.
+    """
+    deadline = time.monotonic() + config.RATE_LIMIT_DEADLINE
+    reservation = None
+    while True:
+        try:
+            return await run_blocking(_call_deferred, reservation, sheet_config, func, *args, **kwargs)
+        except RateLimitWait as e:
+            if time.monotonic() + e.delay > deadline:
+                e.release()
+                if e.error is not None:
+                    raise e.error
+                raise
+            reservation = e.reservation
+            metrics.sheets_wait.observe(e.delay, kind=e.kind)
+            try:
+                await asyncio.sleep(e.delay)
+            except asyncio.CancelledError:
+                e.release()
+                raise
+
+
+def in_flight() -> int:
+    """عدد استدعاءات Google Sheets الجارية أو المنتظرة في المجمع"""
+    return _in_flight
+
+
+def shutdown():
+    """إيقاف مجمع الخيوط بعد انتهاء الاستدعاءات الجارية"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
@@ -0,0 +1,23 @@
+import pytest
+
+from sheet_schema import SheetSchema
+
+
+@pytest.fixture
+def purchases_config():
+    """إعدادات جدول مثل جداول sheets_config.json: تاريخ تلقائي ونص ورقم وملاحظات اختيارية"""
+    return {
+        'sheet_name': 'المشتريات',
+        'worksheet_name': 'الورقة1',
+        'spreadsheet_id': 'sheet-id',
+        'column_types': {'التاريخ': 'date', 'المنتج': 'text', 'السعر': 'number', 'ملاحظات': 'text'},
+        'column_order': ['التاريخ', 'المنتج', 'السعر', 'ملاحظات'],
+        'date_options': {'التاريخ': {'auto': True, 'include_time': False}},
+        'required_columns': ['المنتج', 'السعر'],
+        'optional_columns': ['التاريخ', 'ملاحظات']
+    }
+
+
+@pytest.fixture
+def schema(purchases_config):
+    return SheetSchema('المشتريات', purchases_config)
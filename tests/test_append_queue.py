@@ -0,0 +1,96 @@
+import asyncio
+
+from append_queue import AppendQueue, appended_start_row
+
+SHEET = {'sheet_name': 'المشتريات', 'worksheet_name': 'الورقة1', 'spreadsheet_id': 'sheet-id'}
+OTHER = {'sheet_name': 'المبيعات', 'worksheet_name': 'الورقة1', 'spreadsheet_id': 'other-id'}
+
+
+class RecordingQueue(AppendQueue):
+    """طابور يسجل الطلبات بدلاً من إرسالها إلى Google Sheets"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writes = []
+        self.next_rows = {}
+        self.error = None
+
+    async def _write(self, sheet_config, rows):
+        self.writes.append((sheet_config['sheet_name'], list(rows)))
+        if self.error is not None:
+            raise self.error
+        start = self.next_rows.get(sheet_config['sheet_name'], 2)
+        self.next_rows[sheet_config['sheet_name']] = start + len(rows)
+        return start
+
+
+def test_appended_start_row():
+    assert appended_start_row({'updates': {'updatedRange': "'Sheet 1'!A12:D14"}}) == 12
+    assert appended_start_row({}) is None
+
+
+def test_rows_are_batched_until_flush_interval():
+    queue = RecordingQueue(batch_size=10, flush_interval=0.05)
+
+    async def scenario():
+        futures = [queue.submit(SHEET, [str(index)]) for index in range(3)]
+        await asyncio.sleep(0)
+        assert queue.writes == []
+        assert queue.depth() == 3
+        return await asyncio.gather(*futures)
+
+    assert asyncio.run(scenario()) == [2, 3, 4]
+    assert queue.writes == [('المشتريات', [['0'], ['1'], ['2']])]
+    assert queue.stats()['flushes'] == 1
+
+
+def test_full_batch_flushes_without_waiting():
+    queue = RecordingQueue(batch_size=2, flush_interval=60)
+
+    async def scenario():
+        futures = [queue.submit(SHEET, [str(index)]) for index in range(5)]
+        # امتلاء الدفعة يرسلها فوراً، وما بقي يرسل بعدها مباشرة دون انتظار المهلة
+        done, _ = await asyncio.wait(futures, timeout=1)
+        assert len(done) == 5
+
+        single = queue.submit(SHEET, ['5'])
+        await asyncio.sleep(0.05)
+        assert not single.done()
+        await queue.flush_all()
+        return await single
+
+    assert asyncio.run(scenario()) == 7
+    assert [len(rows) for _, rows in queue.writes] == [2, 2, 1, 1]
+
+
+def test_groups_are_not_split_and_targets_are_separate():
+    queue = RecordingQueue(batch_size=3, flush_interval=0.01)
+
+    async def scenario():
+        first = queue.submit(SHEET, ['a'])
+        group = queue.submit_rows(SHEET, [['b'], ['c'], ['d']])
+        other = queue.submit(OTHER, ['x'])
+        return await asyncio.gather(first, group, other)
+
+    first, group, other = asyncio.run(scenario())
+    # المجموعة لا تقسم بين طلبين حتى لو تجاوزت حجم الدفعة
+    assert sorted(queue.writes) == sorted([
+        ('المشتريات', [['a']]),
+        ('المشتريات', [['b'], ['c'], ['d']]),
+        ('المبيعات', [['x']])
+    ])
+    assert (first, group, other) == (2, 3, 2)
+
+
+def test_failed_flush_fails_every_future():
+    queue = RecordingQueue(batch_size=10, flush_interval=0.01)
+    queue.error = RuntimeError('HTTP 500')
+
+    async def scenario():
+        futures = [queue.submit(SHEET, [str(index)]) for index in range(2)]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert queue.stats()['failed_flushes'] == 1
+    assert queue.depth() == 0
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from document_import import download_to_disk
+
+
+class FakeTelegramFile:
+    """ملف Telegram وهمي يكتب محتواه عند التحميل"""
+
+    def __init__(self, content: bytes, file_size: int = None):
+        self.content = content
+        self.file_size = file_size
+        self.downloads = []
+
+    async def download_to_drive(self, custom_path=None, **kwargs):
+        self.downloads.append(custom_path)
+        with open(custom_path, 'wb') as f:
+            f.write(self.content)
+
+
+def test_download_uses_bot_file_api(tmp_path):
+    telegram_file = FakeTelegramFile('المنتج,السعر\nقلم,15\n'.encode('utf-8'))
+    path = str(tmp_path / 'import.csv')
+    size = asyncio.run(download_to_disk(telegram_file, path))
+    assert telegram_file.downloads == [path]
+    assert size == len(telegram_file.content)
+
+
+def test_download_rejects_large_files(tmp_path):
+    path = str(tmp_path / 'import.csv')
+    # الحجم المعلن يرفض قبل التحميل
+    declared = FakeTelegramFile(b'x', file_size=100)
+    with pytest.raises(ValueError):
+        asyncio.run(download_to_disk(declared, path, max_size=10))
+    assert declared.downloads == []
+
+    undeclared = FakeTelegramFile(b'x' * 100)
+    with pytest.raises(ValueError):
+        asyncio.run(download_to_disk(undeclared, path, max_size=10))
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import config
+from message_scheduler import BACKGROUND, INTERACTIVE, MessageScheduler
+
+
+def run(scenario):
+    async def wrapper():
+        scheduler = MessageScheduler()
+        try:
+            return await scenario(scheduler)
+        finally:
+            await scheduler.stop(timeout=1)
+    return asyncio.run(wrapper())
+
+
+def test_pending_edits_of_one_message_are_coalesced():
+    sent = []
+
+    async def scenario(scheduler):
+        release = asyncio.Event()
+
+        async def first():
+            await release.wait()
+            sent.append('first')
+
+        def edit(text):
+            async def send():
+                sent.append(text)
+                return text
+            return send
+
+        scheduler.submit(1, first)
+        await asyncio.sleep(0)
+        # المحادثة مشغولة بالطلب الأول، فتنتظر التعديلات في الطابور وتدمج
+        futures = [scheduler.submit(1, edit(text), edit_key=(1, 10)) for text in ('1/3', '2/3', '3/3')]
+        assert futures[0] is futures[1] is futures[2]
+        release.set()
+        return await futures[0], scheduler.stats()
+
+    result, stats = run(scenario)
+    assert result == '3/3'
+    assert sent == ['first', '3/3']
+    assert stats['outbound_coalesced_edits'] == 2
+
+
+def test_coalesced_edit_takes_higher_priority():
+    async def scenario(scheduler):
+        release = asyncio.Event()
+
+        async def block():
+            await release.wait()
+
+        async def noop():
+            return None
+
+        scheduler.submit(1, block)
+        await asyncio.sleep(0)
+        scheduler.submit(1, noop, BACKGROUND, edit_key=(1, 10))
+        assert scheduler.stats()['outbound_depth_by_priority'] == [0, 0, 1]
+        scheduler.submit(1, noop, INTERACTIVE, edit_key=(1, 10))
+        depths = scheduler.stats()['outbound_depth_by_priority']
+        release.set()
+        return depths
+
+    assert run(scenario) == [1, 0, 0]
+
+
+def test_retry_after_requeues_before_later_messages():
+    order = []
+
+    async def scenario(scheduler):
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RetryAfter(0)
+            order.append('first')
+            return 'sent'
+
+        async def second():
+            order.append('second')
+
+        first_future = scheduler.submit(1, flaky)
+        second_future = scheduler.submit(1, second)
+        result = await first_future
+        await second_future
+        return result, len(attempts), scheduler.stats()
+
+    result, attempts, stats = run(scenario)
+    assert result == 'sent'
+    assert attempts == 2
+    assert order == ['first', 'second']
+    assert stats['outbound_retry_after'] == 1
+
+
+def test_retry_after_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(config, 'TELEGRAM_MAX_RETRIES', 1)
+
+    async def scenario(scheduler):
+        async def always_limited():
+            raise RetryAfter(0)
+
+        with pytest.raises(RetryAfter):
+            await scheduler.submit(1, always_limited)
+        return scheduler.stats()
+
+    stats = run(scenario)
+    assert stats['outbound_retry_after'] == 2
+    assert stats['outbound_failed'] == 1
+
+
+def test_chats_are_sent_in_parallel_but_each_in_order():
+    events = []
+
+    async def scenario(scheduler):
+        def job(chat_id, name, delay):
+            async def send():
+                events.append(('start', name))
+                await asyncio.sleep(delay)
+                events.append(('end', name))
+            return send
+
+        futures = [
+            scheduler.submit(1, job(1, 'a1', 0.05)),
+            scheduler.submit(1, job(1, 'a2', 0)),
+            scheduler.submit(2, job(2, 'b1', 0)),
+        ]
+        await asyncio.gather(*futures)
+
+    run(scenario)
+    # b1 لا ينتظر محادثة أخرى، و a2 لا يبدأ قبل انتهاء a1
+    assert events.index(('end', 'b1')) < events.index(('end', 'a1'))
+    assert events.index(('end', 'a1')) < events.index(('start', 'a2'))
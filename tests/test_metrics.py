@@ -0,0 +1,34 @@
+import asyncio
+
+import metrics
+from metrics import StatsSnapshots
+
+
+def test_loop_stats_are_served_from_last_snapshot():
+    snapshots = StatsSnapshots(interval=60)
+    counts = {'items': 1}
+
+    async def async_stats():
+        return {'pending': 3}
+
+    def failing_stats():
+        raise RuntimeError('boom')
+
+    snapshots.register('snap_test', lambda: dict(counts))
+    snapshots.register('snap_async', async_stats)
+    snapshots.register('snap_labeled', lambda: {'a': {'value': 2}}, label='name')
+    snapshots.register('snap_failing', failing_stats)
+
+    # قبل أول لقطة لا تعرض قيم، ولا تستدعى الدوال من خيط الخادم
+    assert 'snap_test_items' not in metrics.render()
+
+    asyncio.run(snapshots.refresh())
+    counts['items'] = 5
+    text = metrics.render()
+    assert 'snap_test_items 1' in text
+    assert 'snap_async_pending 3' in text
+    assert 'snap_labeled_value{name="a"} 2' in text
+    assert 'snap_failing' not in text
+
+    asyncio.run(snapshots.refresh())
+    assert 'snap_test_items 5' in metrics.render()
@@ -0,0 +1,248 @@
+import asyncio
+
+import gspread
+import pytest
+import requests
+
+import sheets_client
+from outbox import DONE, INFLIGHT, PENDING, VERIFY, Outbox, OutboxDrainer, find_run, maybe_applied, send_groups
+
+TARGET = {'sheet_name': 'المشتريات', 'worksheet_name': 'الورقة1', 'spreadsheet_id': 'sheet-id'}
+
+
+@pytest.fixture
+def box(tmp_path):
+    box = Outbox(str(tmp_path / 'outbox.db'))
+    yield box
+    box._executor.shutdown(wait=True)
+
+
+def status_counts(box):
+    return box._counts()
+
+
+class FakeSheet:
+    """ورقة عمل وهمية: طابور كتابة يضيف الصفوف وقراءة نطاقات منها"""
+
+    def __init__(self, rows):
+        self.rows = [list(row) for row in rows]
+        self.reads = []
+        self.fail_next_write = None
+        self.apply_failed_write = False
+        self.fail_reads = 0
+
+    def submit_rows(self, target, rows):
+        future = asyncio.get_running_loop().create_future()
+        start = len(self.rows) + 1
+        if self.fail_next_write is not None:
+            error, self.fail_next_write = self.fail_next_write, None
+            if self.apply_failed_write:
+                self.rows.extend(rows)
+            future.set_exception(error)
+        else:
+            self.rows.extend(rows)
+            future.set_result(start)
+        return future
+
+    async def run_on_worksheet(self, target, func, *args):
+        self.reads.append((func.__name__,) + args)
+        if self.fail_reads:
+            self.fail_reads -= 1
+            raise requests.exceptions.ConnectionError('down')
+        if func is gspread.Worksheet.get_all_values:
+            return [list(row) for row in self.rows]
+        first, last = (int(number) for number in args[0].split(':'))
+        return [list(row) for row in self.rows[first - 1:last]]
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    sheet = FakeSheet([['المنتج', 'السعر'], ['قلم', '15']])
+    monkeypatch.setattr(sheets_client, 'run_on_worksheet', sheet.run_on_worksheet)
+    return sheet
+
+
+def test_add_dedups_by_idempotency_key(box):
+    async def scenario():
+        assert await box.add('key-1', 'المشتريات', TARGET, ['قلم', '15'])
+        assert not await box.add('key-1', 'المشتريات', TARGET, ['قلم', '99'])
+        return await box.claim_due(10)
+
+    claimed = asyncio.run(scenario())
+    assert [entry['row'] for entry in claimed] == [['قلم', '15']]
+
+
+def test_claim_done_and_requeue(box):
+    async def scenario():
+        await box.add_many([
+            (f'key-{index}', 'المشتريات', TARGET, [str(index)], None, None, None) for index in range(3)
+        ])
+        claimed = await box.claim_due(2)
+        assert [entry['row'] for entry in claimed] == [['0'], ['1']]
+        assert status_counts(box) == {INFLIGHT: 2, PENDING: 1}
+        # الصفوف المحجوزة لا تحجز مرة أخرى
+        assert [entry['row'] for entry in await box.claim_due(10)] == [['2']]
+
+        await box.mark_done([claimed[0]['id']])
+        await box.requeue([claimed[1]['id']])
+        assert status_counts(box) == {DONE: 1, PENDING: 1, INFLIGHT: 1}
+        assert [entry['row'] for entry in await box.claim_due(10)] == [['1']]
+
+    asyncio.run(scenario())
+
+
+def test_mark_failed_backs_off(box):
+    async def scenario():
+        await box.add('key-1', 'المشتريات', TARGET, ['قلم'])
+        claimed = await box.claim_due(10)
+        await box.mark_failed(claimed, 'HTTP 400')
+        assert status_counts(box) == {PENDING: 1}
+        # موعد المحاولة التالية في المستقبل
+        assert await box.claim_due(10) == []
+
+    asyncio.run(scenario())
+
+
+def test_mark_unverified_after_restart(box):
+    async def scenario():
+        await box.add('key-1', 'المشتريات', TARGET, ['قلم'])
+        await box.claim_due(10)
+        assert await box.mark_unverified() == 1
+        return await box.list_unverified()
+
+    assert [entry['row'] for entry in asyncio.run(scenario())] == [['قلم']]
+
+
+def test_send_groups_keeps_batches_together():
+    entries = [
+        {'id': 1, 'batch_key': None},
+        {'id': 2, 'batch_key': 'bulk'},
+        {'id': 3, 'batch_key': None},
+        {'id': 4, 'batch_key': 'bulk'},
+    ]
+    assert [[entry['id'] for entry in group] for group in send_groups(entries)] == [[1], [2, 4], [3]]
+
+
+def test_find_run_requires_contiguous_rows_in_order():
+    values = [('a',), ('b',), ('x',), ('a',), ('b',)]
+    assert find_run(values, [('a',), ('b',)]) == 0
+    assert find_run(values, [('a',), ('b',)], 1) == 3
+    assert find_run(values, [('b',), ('a',)]) == -1
+
+
+def test_maybe_applied():
+    assert maybe_applied(requests.exceptions.ReadTimeout())
+    assert maybe_applied(requests.exceptions.ConnectionError())
+    assert not maybe_applied(ValueError())
+
+
+def make_due(box):
+    """تجاوز تأخير إعادة المحاولة في الاختبار"""
+    def update():
+        with box._connect() as conn:
+            conn.execute("UPDATE outbox SET next_attempt_at = 0")
+    return box._run(update)
+
+
+def test_timeout_is_verified_instead_of_resent(box, sheet):
+    drainer = OutboxDrainer(box, queue=sheet)
+
+    async def scenario():
+        await box.add('key-1', 'المشتريات', TARGET, ['دفتر', '20'])
+        await drainer._send(await box.claim_due(10))
+        # الطلب التالي يضاف في الجدول لكن الرد لا يصل
+        sheet.fail_next_write = requests.exceptions.ReadTimeout('timed out')
+        sheet.apply_failed_write = True
+        await box.add('key-2', 'المشتريات', TARGET, ['قلم', '15'])
+        await drainer._send(await box.claim_due(10))
+        assert status_counts(box) == {DONE: 1, VERIFY: 1}
+
+        await make_due(box)
+        await drainer._verify_unsent()
+        assert status_counts(box) == {DONE: 2}
+
+    asyncio.run(scenario())
+    assert sheet.rows[-2:] == [['دفتر', '20'], ['قلم', '15']]
+    # القراءة بعد آخر صف معروف فقط
+    assert sheet.reads == [('get_values', '4:54')]
+
+
+def test_identical_older_row_does_not_count_as_sent(box, sheet):
+    drainer = OutboxDrainer(box, queue=sheet)
+
+    async def scenario():
+        await box.add('key-1', 'المشتريات', TARGET, ['دفتر', '20'])
+        await drainer._send(await box.claim_due(10))
+        # صف مطابق لصف موجود في الجدول (الصف 2) توقف البوت قبل إرساله
+        await box.add('key-2', 'المشتريات', TARGET, ['قلم', '15'])
+        await box.claim_due(10)
+        await box.mark_unverified()
+        await drainer._verify_unsent()
+        assert status_counts(box) == {DONE: 1, PENDING: 1}
+        await drainer._send(await box.claim_due(10))
+
+    asyncio.run(scenario())
+    assert sheet.rows == [['المنتج', 'السعر'], ['قلم', '15'], ['دفتر', '20'], ['قلم', '15']]
+
+
+def test_definite_error_is_retried_without_verify(box, sheet):
+    drainer = OutboxDrainer(box, queue=sheet)
+    response = requests.Response()
+    response.status_code = 400
+    response._content = b'{"error": {"code": 400, "message": "bad"}}'
+    sheet.fail_next_write = gspread.exceptions.APIError(response)
+
+    async def scenario():
+        await box.add('key-1', 'المشتريات', TARGET, ['قلم', '15'])
+        await drainer._send(await box.claim_due(10))
+
+    asyncio.run(scenario())
+    assert status_counts(box) == {PENDING: 1}
+
+
+def test_failed_verify_backs_off(box, sheet):
+    drainer = OutboxDrainer(box, queue=sheet)
+    sheet.fail_reads = 1
+
+    async def scenario():
+        await box.add('key-1', 'المشتريات', TARGET, ['ممحاة', '3'])
+        await box.claim_due(10)
+        await box.mark_unverified()
+        await drainer._verify_unsent()
+        assert status_counts(box) == {VERIFY: 1}
+        # لا تعاد القراءة قبل انتهاء التأخير
+        assert await box.list_unverified() == []
+        await make_due(box)
+        await drainer._verify_unsent()
+
+    asyncio.run(scenario())
+    # بدون آخر صف معروف (أول إرسال لهذه الورقة) يتم فحص آخر صفوف الجدول
+    assert [read[0] for read in sheet.reads] == ['get_all_values', 'get_all_values']
+    assert status_counts(box) == {PENDING: 1}
+
+
+class FakeMirror:
+    def __init__(self, row_count):
+        self.row_count = row_count
+
+    async def state(self, sheet_key):
+        return {'target': '["sheet-id", "الورقة1"]', 'row_count': self.row_count}
+
+    async def record_appended(self, *args):
+        pass
+
+
+def test_first_send_uses_mirror_row_count_as_base(box, sheet):
+    drainer = OutboxDrainer(box, queue=sheet, mirror=FakeMirror(2))
+    sheet.fail_next_write = requests.exceptions.ConnectionError('reset')
+
+    async def scenario():
+        await box.add('key-1', 'المشتريات', TARGET, ['قلم', '15'])
+        await drainer._send(await box.claim_due(10))
+        await make_due(box)
+        await drainer._verify_unsent()
+
+    asyncio.run(scenario())
+    # الصف 2 المطابق قبل آخر صف معروف، فلا يعتبر الصف المرسل
+    assert sheet.reads == [('get_values', '3:53')]
+    assert status_counts(box) == {PENDING: 1}
@@ -0,0 +1,119 @@
+import time
+
+import gspread
+import pytest
+import requests
+
+import config
+import rate_limiter
+from rate_limiter import RateLimiter, RateLimitWait, TokenBucket, deferred_waits, is_quota_error, retry_after
+
+
+def api_error(status, text='', headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = (text or '{"error": {"code": %d, "message": "x"}}' % status).encode()
+    response.headers.update(headers or {})
+    return gspread.exceptions.APIError(response)
+
+
+def test_bucket_burst_then_paced():
+    bucket = TokenBucket('test', rate=10.0, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # الرصيد يصبح سالباً فيحصل كل طلب منتظر على دوره بالترتيب
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+    assert bucket.stats()['waits'] == 2
+
+
+def test_bucket_refills_over_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    bucket = TokenBucket('test', rate=1.0, capacity=3)
+    for _ in range(3):
+        bucket.reserve()
+    now[0] += 2
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(1.0)
+    bucket.refund()
+    assert bucket.reserve() == pytest.approx(1.0)
+
+
+def test_throttle_blocks_and_halves_rate_then_recovers(monkeypatch):
+    monkeypatch.setattr(config, 'RATE_LIMIT_MIN_FACTOR', 0.25)
+    monkeypatch.setattr(config, 'RATE_LIMIT_RECOVERY_STEP', 0.25)
+    bucket = TokenBucket('test', rate=4.0, capacity=5)
+    bucket.throttle(2.0)
+    assert bucket.rate == 2.0
+    assert bucket.strikes == 1
+    assert bucket.blocked_for() == pytest.approx(2.0, abs=0.05)
+    assert bucket.reserve() >= 1.9
+    bucket.recover()
+    assert bucket.rate == 3.0
+    assert bucket.strikes == 0
+
+
+def test_is_quota_error_and_retry_after():
+    assert is_quota_error(api_error(429))
+    assert is_quota_error(api_error(403, '{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'))
+    assert not is_quota_error(api_error(403, '{"error": {"message": "The caller does not have permission"}}'))
+    assert retry_after(api_error(429, headers={'Retry-After': '7'}).response) == 7.0
+    assert retry_after(api_error(429).response) is None
+
+
+def test_backoff_follows_consecutive_throttles(monkeypatch):
+    monkeypatch.setattr(config, 'RATE_LIMIT_BACKOFF_BASE', 1.0)
+    monkeypatch.setattr(config, 'RATE_LIMIT_BACKOFF_MAX', 64.0)
+    limiter = RateLimiter()
+    delays = [limiter.throttled('account', 'write') for _ in range(4)]
+    for attempt, delay in enumerate(delays, 1):
+        assert 2 ** (attempt - 1) / 2 <= delay <= 2 ** (attempt - 1)
+    assert limiter.throttled('account', 'write', delay=3.0) == 3.0
+
+
+def test_deferred_request_raises_wait_instead_of_sleeping(monkeypatch):
+    limiter = RateLimiter()
+    monkeypatch.setattr(rate_limiter, 'limiter', limiter)
+    monkeypatch.setattr(gspread.Client, 'request', lambda self, *args, **kwargs: 'ok')
+    client = rate_limiter.RateLimitedClient.__new__(rate_limiter.RateLimitedClient)
+    client.requests = {'read': 0, 'write': 0}
+    client.quota_errors = 0
+    url = 'https://sheets.googleapis.com/v4/spreadsheets/abc/values/A1:append'
+
+    limiter.throttled('', 'write', delay=5.0)
+    with deferred_waits():
+        with pytest.raises(RateLimitWait) as raised:
+            client.request('post', url)
+    assert raised.value.delay == pytest.approx(5.0, abs=0.1)
+    assert client.requests['write'] == 0
+
+    # المحاولة التالية بنفس الحجز لا تحجز رمزاً جديداً
+    [bucket] = limiter.buckets('', None, 'write')
+    tokens = bucket.tokens
+    bucket.blocked_until = 0.0
+    with deferred_waits(raised.value.reservation):
+        assert client.request('post', url) == 'ok'
+    assert bucket.tokens <= tokens + 0.5
+
+
+def test_deferred_quota_error_is_not_retried_in_thread(monkeypatch):
+    limiter = RateLimiter()
+    monkeypatch.setattr(rate_limiter, 'limiter', limiter)
+    error = api_error(429, headers={'Retry-After': '3'})
+
+    def fail(self, *args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(gspread.Client, 'request', fail)
+    client = rate_limiter.RateLimitedClient.__new__(rate_limiter.RateLimitedClient)
+    client.requests = {'read': 0, 'write': 0}
+    client.quota_errors = 0
+    with deferred_waits():
+        with pytest.raises(RateLimitWait) as raised:
+            client.request('get', 'https://sheets.googleapis.com/v4/spreadsheets/abc')
+    assert raised.value.error is error
+    assert raised.value.delay == 3.0
+    assert client.requests['read'] == 1
+    assert limiter.account_blocked_for('') == pytest.approx(3.0, abs=0.1)
@@ -0,0 +1,108 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import report
+from report import ReportData, ReportEngine, aggregate, format_report, group_options, to_dates, to_numbers
+
+ROWS = [
+    (2, ['2024-01-01', 'قلم', '10', '']),
+    (3, ['2024-01-03', 'دفتر', '٢٠', '']),
+    (4, ['2024-01-08', 'قلم', '1,000', '']),
+    (5, ['2024-02-01', 'قلم', 'غير معروف', '']),
+    (6, ['', 'ممحاة', '5', '']),
+    (7, ['', '', '', '']),
+]
+
+
+def test_to_numbers_and_dates():
+    numbers = to_numbers(np.array(['5', '١٬٢٠٠', '', 'x']))
+    assert numbers[:2].tolist() == [5.0, 1200.0]
+    assert np.isnan(numbers[2:]).all()
+    dates = to_dates(np.array(['2024/01/02', '', 'x']))
+    assert str(dates[0]) == '2024-01-02'
+    assert np.isnat(dates[1:]).all()
+
+
+def test_group_options(schema):
+    assert [group for group, _ in group_options(schema)] == ['day', 'week', 'month', 'col_1', 'col_3']
+
+
+def test_group_options_without_number_columns(purchases_config):
+    from sheet_schema import SheetSchema
+    purchases_config['column_types']['السعر'] = 'text'
+    assert group_options(SheetSchema('x', purchases_config)) == []
+
+
+def test_report_data_skips_empty_rows(schema):
+    assert ReportData(schema, ROWS).size == 5
+
+
+def test_aggregate_by_month(schema):
+    result = aggregate(ReportData(schema, ROWS), schema, 'month')
+    assert result['labels'].tolist() == ['2024-01', '2024-02']
+    assert result['counts'].tolist() == [3, 1]
+    price = result['columns']['السعر']
+    assert price['sums'].tolist() == [1030.0, 0.0]
+    assert price['averages'][0] == pytest.approx(1030 / 3)
+    assert np.isnan(price['averages'][1])
+    assert result['rows'] == 4
+    assert result['skipped'] == 1
+
+
+def test_aggregate_by_week_starts_on_monday(schema):
+    result = aggregate(ReportData(schema, ROWS), schema, 'week')
+    assert result['labels'].tolist() == ['2024-01-01', '2024-01-08', '2024-01-29']
+    assert result['counts'].tolist() == [2, 1, 1]
+
+
+def test_aggregate_by_text_column(schema):
+    result = aggregate(ReportData(schema, ROWS), schema, 'col_1')
+    assert result['group_column'] == 'المنتج'
+    groups = dict(zip(result['labels'].tolist(), result['columns']['السعر']['sums'].tolist()))
+    assert groups == {'دفتر': 20.0, 'قلم': 1010.0, 'ممحاة': 5.0}
+    assert result['columns']['السعر']['total'] == 1035.0
+
+
+def test_format_report_orders_largest_groups_first(schema):
+    result = aggregate(ReportData(schema, ROWS), schema, 'col_1')
+    text = format_report('المشتريات', 'col_1', result)
+    lines = text.splitlines()
+    assert lines[0] == '📊 تقرير حسب المنتج - المشتريات'
+    assert lines[2].startswith('▫️ قلم: العدد 3')
+    assert 'مجموع 1,010' in lines[2]
+    assert 'الإجمالي: 5 صف في 3 مجموعة' in text
+
+
+class FakeMirror:
+    """نسخة محلية وهمية لم تكتمل مزامنتها الأولى ثم اكتملت"""
+
+    def __init__(self):
+        self.synced_at = 0
+        self.timeouts = []
+
+    async def ensure_fresh(self, sheet_key, sheet_config, timeout=None):
+        self.timeouts.append(timeout)
+
+    async def state(self, sheet_key):
+        return {'version': 3, 'synced_at': self.synced_at}
+
+    async def rows(self, sheet_key):
+        return ROWS
+
+
+def test_build_waits_for_first_sync_and_caches(schema, monkeypatch):
+    fake = FakeMirror()
+    monkeypatch.setattr(report, 'mirror', fake)
+    engine = ReportEngine()
+
+    with pytest.raises(ValueError):
+        asyncio.run(engine.build(schema, 1, 'month'))
+    fake.synced_at = 1.0
+    first = asyncio.run(engine.build(schema, 1, 'month'))
+    assert asyncio.run(engine.build(schema, 1, 'month')) == first
+    assert engine.stats() == {'report_cache_hits': 1, 'report_cache_misses': 1}
+    # المزامنة قبل التقرير محدودة بمهلة
+    assert all(timeout is not None for timeout in fake.timeouts)
+
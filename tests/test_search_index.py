@@ -0,0 +1,69 @@
+import config
+from search_index import SearchIndex, SheetIndex, index_terms, normalize_arabic, query_terms, tokenize
+
+
+def test_normalize_arabic():
+    assert normalize_arabic('أحمد') == normalize_arabic('احمد') == 'احمد'
+    assert normalize_arabic('إسلام آمنة') == 'اسلام امنه'
+    assert normalize_arabic('مُحَمَّد') == 'محمد'
+    assert normalize_arabic('مـــحمد') == 'محمد'
+    assert normalize_arabic('مصطفى') == 'مصطفي'
+    assert normalize_arabic('مؤسسة شاطئ') == 'موسسه شاطي'
+    assert normalize_arabic('Pen ١٢٣') == 'pen 123'
+
+
+def test_tokenize_and_article():
+    assert tokenize('قلم، أزرق - ٢ حبة') == ['قلم', 'ازرق', '2', 'حبه']
+    assert index_terms('الكتاب') == {'الكتاب', 'كتاب'}
+    # "ال" لا تحذف من الكلمات القصيرة
+    assert index_terms('الم') == {'الم'}
+    assert query_terms('الكتاب الأزرق') == ['كتاب', 'ازرق']
+
+
+def build_index(rows):
+    index = SheetIndex('sheet', epoch=0, sheet_version=1, columns=[0, 1])
+    index.add_rows(rows)
+    return index
+
+
+def test_search_matches_prefixes_of_all_terms_newest_first():
+    index = build_index([
+        (2, ['الكتاب الأزرق', 'مكتبة النور', '15']),
+        (3, ['قلم أزرق', '', '3']),
+        (4, ['كتابة', 'النور', '7']),
+    ])
+    assert index.search(query_terms('كتاب')) == [4, 2]
+    assert index.search(query_terms('ازرق')) == [3, 2]
+    assert index.search(query_terms('الكتاب النور')) == [4, 2]
+    assert index.search(query_terms('قلم النور')) == []
+
+
+def test_non_indexed_columns_are_ignored():
+    index = build_index([(2, ['قلم', '', '15'])])
+    assert index.search(query_terms('15')) == []
+
+
+def test_incremental_rows_extend_vocabulary():
+    index = build_index([(2, ['قلم', ''])])
+    index.add_rows([(3, ['مسطرة', 'قلم رصاص'])])
+    assert index.last_row == 3
+    assert index.vocabulary == sorted(index.vocabulary)
+    assert index.search(query_terms('قلم')) == [3, 2]
+    assert index.search(query_terms('رصا')) == [3]
+
+
+def test_saved_results_are_bounded_and_per_user(monkeypatch):
+    monkeypatch.setattr(config, 'FIND_CACHE_SIZE', 2)
+    index = SearchIndex()
+    first = index.save_results('1', [('المشتريات', 2)])
+    second = index.save_results('2', [('المشتريات', 3)])
+    assert index.get_results('1', first) == [('المشتريات', 2)]
+    # لا يمكن لمستخدم آخر تصفح نتائج بحث لم يجره
+    assert index.get_results('2', first) is None
+
+    # الأقدم استخداماً يحذف عند تجاوز الحد
+    third = index.save_results('1', [('المشتريات', 4)])
+    assert index.get_results('2', second) is None
+    assert index.get_results('1', first) == [('المشتريات', 2)]
+    index.drop_results('1', third)
+    assert index.get_results('1', third) is None
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+import sheets_client
+from sheet_mirror import SheetMirror
+
+TARGET = {'sheet_name': 'المشتريات', 'worksheet_name': 'الورقة1', 'spreadsheet_id': 'sheet-id'}
+
+
+class SlowSheet:
+    """ورقة عمل وهمية ترد على القراءة بعد تأخير"""
+
+    def __init__(self, rows, delay):
+        self.rows = rows
+        self.delay = delay
+        self.reads = 0
+        self.error = None
+
+    async def run_on_worksheet(self, target, func, *args):
+        self.reads += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        first, last = (int(number) for number in args[0].split(':'))
+        return [list(row) for row in self.rows[first - 1:last]]
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    sheet = SlowSheet([['المنتج', 'السعر'], ['قلم', '15']], delay=0.2)
+    monkeypatch.setattr(sheets_client, 'run_on_worksheet', sheet.run_on_worksheet)
+    return sheet
+
+
+@pytest.fixture
+def local(tmp_path):
+    local = SheetMirror(str(tmp_path / 'mirror.db'))
+    yield local
+    local._executor.shutdown(wait=True)
+
+
+def test_slow_sync_continues_in_background(local, sheet):
+    async def scenario():
+        # استعلامان متزامنان ينتظران نفس المزامنة ثم يكملان بالنسخة المحلية
+        await asyncio.gather(
+            local.ensure_fresh('المشتريات', TARGET, timeout=0.01),
+            local.ensure_fresh('المشتريات', TARGET, timeout=0.01)
+        )
+        assert await local.rows('المشتريات') == []
+        await local.stop()
+        return await local.rows('المشتريات')
+
+    assert asyncio.run(scenario()) == [(1, ['المنتج', 'السعر']), (2, ['قلم', '15'])]
+    assert sheet.reads == 1
+    assert local.stats()['mirror_stale_reads'] == 2
+
+
+def test_sync_error_is_not_raised(local, sheet):
+    sheet.delay = 0
+    sheet.error = ConnectionError('down')
+
+    async def scenario():
+        await local.ensure_fresh('المشتريات', TARGET, timeout=1)
+        return await local.rows('المشتريات')
+
+    assert asyncio.run(scenario()) == []
+    assert sheet.reads == 1
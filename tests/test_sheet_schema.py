@@ -0,0 +1,103 @@
+from datetime import datetime
+
+import pytest
+
+from sheet_schema import normalize_digits, parse_date, parse_number, split_line
+
+
+def test_normalize_digits_arabic_indic_and_persian():
+    assert normalize_digits('١٢٣٫٥') == '123.5'
+    assert normalize_digits('۱۲۳') == '123'
+    # فواصل الآلاف العربية تحذف
+    assert normalize_digits('١٬٢٥٠') == '1250'
+
+
+def test_parse_number_accepts_arabic_digits_and_thousands():
+    assert parse_number(' ٢٥٠ ') == '250'
+    assert parse_number('1,250.5') == '1250.5'
+    with pytest.raises(ValueError):
+        parse_number('abc')
+
+
+def test_parse_date_formats_and_today():
+    assert parse_date('٢٠٢٤/٠٣/٠٥') == '2024-03-05'
+    assert parse_date('05-03-2024') == '2024-03-05'
+    assert parse_date('2024-03-05 14:30', {'include_time': True}) == '2024-03-05 14:30'
+    assert parse_date('اليوم') == datetime.now().strftime('%Y-%m-%d')
+    with pytest.raises(ValueError):
+        parse_date('أمس')
+
+
+def test_schema_prompt_order_skips_auto_columns(schema):
+    assert schema.auto_columns == ('التاريخ',)
+    assert schema.prompt_order == ('المنتج', 'السعر', 'ملاحظات')
+
+
+def test_schema_builds_row_in_column_order(schema):
+    data = schema.initial_data()
+    data['المنتج'] = schema.parse('المنتج', ' قلم ')
+    assert schema.missing_required(data) == ['السعر']
+    data['السعر'] = schema.parse('السعر', '١٥')
+    assert schema.build_row(data) == [datetime.now().strftime('%Y-%m-%d'), 'قلم', '15', '']
+
+
+def test_split_structured_pipe_values(schema):
+    assert schema.split_structured('قلم | ١٥ | أزرق') == {'المنتج': 'قلم', 'السعر': '١٥', 'ملاحظات': 'أزرق'}
+
+
+def test_split_structured_pipe_with_all_columns(schema):
+    raw = schema.split_structured('2024-01-02 | قلم | 15 | -')
+    assert raw == {'التاريخ': '2024-01-02', 'المنتج': 'قلم', 'السعر': '15', 'ملاحظات': '-'}
+
+
+def test_split_structured_key_value_lines(schema):
+    assert schema.split_structured('المنتج = قلم\nالسعر=١٥') == {'المنتج': 'قلم', 'السعر': '١٥'}
+
+
+def test_split_structured_rejects_unknown_columns(schema):
+    with pytest.raises(ValueError, match='الكمية'):
+        schema.split_structured('المنتج=قلم\nالكمية=3')
+
+
+def test_split_structured_other_value_counts_are_plain_text(schema):
+    # عدد قيم لا يطابق الأعمدة يعني أن | جزء من القيمة
+    assert schema.split_structured('قلم | أزرق') is None
+    assert schema.split_structured('a | b | c | d | e') is None
+
+
+def test_split_structured_plain_text_is_not_structured(schema):
+    assert schema.split_structured('قلم أزرق') is None
+    assert schema.split_structured('السعر 5 = مرتفع') is None
+
+
+def test_parse_values_optional_empty_is_skip(schema):
+    values, errors = schema.parse_values({'المنتج': 'قلم', 'السعر': 'خمسة', 'ملاحظات': ''})
+    assert values == {'المنتج': 'قلم'}
+    assert list(errors) == ['السعر']
+
+
+def test_split_line_delimiters():
+    assert split_line('قلم | 15') == ['قلم', '15']
+    assert split_line('قلم\t15\tأزرق') == ['قلم', '15', 'أزرق']
+    assert split_line('قلم، 15') == ['قلم', '15']
+    assert split_line('"قلم, أزرق",15') == ['قلم, أزرق', '15']
+
+
+def test_parse_bulk_rows_and_errors(schema):
+    today = datetime.now().strftime('%Y-%m-%d')
+    rows, errors = schema.parse_bulk('قلم | ١٥\n\nدفتر | abc\nممحاة, 3, صغيرة')
+    assert rows == [(1, [today, 'قلم', '15', '']), (4, [today, 'ممحاة', '3', 'صغيرة'])]
+    assert len(errors) == 1
+    assert errors[0][0] == 3 and 'السعر' in errors[0][1]
+
+
+def test_parse_bulk_missing_required(schema):
+    rows, errors = schema.parse_bulk('قلم')
+    assert rows == []
+    assert 'السعر' in errors[0][1]
+
+
+def test_parse_bulk_max_rows(schema):
+    rows, errors = schema.parse_bulk('a|1\nb|2\nc|3', max_rows=2)
+    assert [line for line, _ in rows] == [1, 2]
+    assert errors[0][0] == 3
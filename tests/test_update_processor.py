@@ -0,0 +1,71 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+from update_processor import OrderedUpdateProcessor, update_key
+
+
+def message_update(update_id: int, chat_id: int) -> Update:
+    user = User(id=chat_id, first_name='test', is_bot=False)
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(), chat=chat, from_user=user, text='x')
+    return Update(update_id=update_id, message=message)
+
+
+def test_update_key():
+    assert update_key(message_update(1, 42)) == ('chat', 42)
+    assert update_key(object()) is None
+
+
+def test_updates_of_one_chat_run_in_order_and_chats_in_parallel():
+    events = []
+
+    async def handler(name, delay):
+        events.append(('start', name))
+        await asyncio.sleep(delay)
+        events.append(('end', name))
+
+    async def scenario():
+        processor = OrderedUpdateProcessor(max_concurrent_updates=4)
+        await processor.initialize()
+        await asyncio.gather(
+            processor.do_process_update(message_update(1, 1), handler('a1', 0.05)),
+            processor.do_process_update(message_update(2, 1), handler('a2', 0)),
+            processor.do_process_update(message_update(3, 2), handler('b1', 0)),
+            processor.do_process_update(message_update(4, 1), handler('a3', 0)),
+        )
+        return processor.stats()
+
+    stats = asyncio.run(scenario())
+    starts = [name for kind, name in events if kind == 'start']
+    assert [name for name in starts if name.startswith('a')] == ['a1', 'a2', 'a3']
+    assert events.index(('end', 'a1')) < events.index(('start', 'a2'))
+    assert events.index(('end', 'b1')) < events.index(('end', 'a1'))
+    assert stats['updates_processed'] == 4
+    assert stats['update_keys'] == 0
+    assert stats['update_key_depth_max'] == 3
+
+
+def test_cancelled_waiting_update_keeps_chain_order():
+    events = []
+
+    async def handler(name, delay=0):
+        await asyncio.sleep(delay)
+        events.append(name)
+
+    async def scenario():
+        processor = OrderedUpdateProcessor(max_concurrent_updates=4)
+        await processor.initialize()
+        first = asyncio.ensure_future(processor.do_process_update(message_update(1, 1), handler('first', 0.05)))
+        second = asyncio.ensure_future(processor.do_process_update(message_update(2, 1), handler('second')))
+        third = asyncio.ensure_future(processor.do_process_update(message_update(3, 1), handler('third')))
+        await asyncio.sleep(0.01)
+        second.cancel()
+        await asyncio.gather(first, second, third, return_exceptions=True)
+        return first
+
+    first = asyncio.run(scenario())
+    # إلغاء التحديث المنتظر لا يلغي التحديث الجاري، والتحديث التالي ينتظر انتهاءه
+    assert not first.cancelled()
+    assert events == ['first', 'third']
@@ -0,0 +1,130 @@
+"""
+معالجة تحديثات Telegram بالتوازي بين المستخدمين مع الحفاظ على الترتيب لكل محادثة.
+
+ConversationHandler يفترض أن تحديثات المحادثة الواحدة تعالج واحداً تلو الآخر، لذلك
+يتم ربط تحديثات كل محادثة (أو كل مستخدم إذا لم تكن هناك محادثة) في سلسلة: لا يبدأ
+تحديث قبل انتهاء التحديث السابق لنفس المفتاح، بينما تعالج تحديثات المحادثات المختلفة
+بالتوازي حتى الحد UPDATE_CONCURRENCY. التحديثات المنتظرة لدورها لا تشغل أماكن التنفيذ،
+فلا يستطيع مستخدم يرسل رسائل كثيرة تعطيل الآخرين.
+"""
+import asyncio
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def update_key(update: object):
+    """مفتاح الترتيب للتحديث: المحادثة، أو المستخدم، أو None للتحديثات الأخرى"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return ('chat', update.effective_chat.id)
+    if update.effective_user is not None:
+        return ('user', update.effective_user.id)
+    return None
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """معالج تحديثات متوازٍ مع ترتيب صارم لكل محادثة"""
+
+    def __init__(self, max_concurrent_updates: int = None, max_pending_updates: int = None):
+        self.concurrency = max_concurrent_updates or config.UPDATE_CONCURRENCY
+        # الحد في الصنف الأساسي يشمل التحديثات المنتظرة لدورها، وحد التنفيذ الفعلي هو _running
+        super().__init__(max(max_pending_updates or config.UPDATE_MAX_PENDING, self.concurrency))
+        self._running = None
+        self._tails = {}  # المفتاح -> Future آخر تحديث في سلسلة هذا المفتاح
+        self._depths = {}  # المفتاح -> عدد التحديثات غير المنتهية
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.max_waiting = 0
+        self.max_key_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def initialize(self) -> None:
+        self._running = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _execute(self, coroutine):
+        async with self._running:
+            self.active += 1
+            try:
+                await coroutine
+            finally:
+                self.active -= 1
+
+    def _release(self, key, done: asyncio.Future):
+        """إنهاء دور التحديث في سلسلة المفتاح"""
+        if not done.done():
+            done.set_result(None)
+        if self._tails.get(key) is done:
+            del self._tails[key]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = update_key(update)
+        if key is None:
+            await self._execute(coroutine)
+            return
+
+        # التسجيل في السلسلة يتم قبل أي انتظار، فيحافظ على ترتيب وصول التحديثات
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        depth = self._depths.get(key, 0) + 1
+        self._depths[key] = depth
+        self.max_key_depth = max(self.max_key_depth, depth)
+        queued_at = time.perf_counter()
+        try:
+            if previous is not None:
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+                try:
+                    # shield: إلغاء هذا التحديث (عند الإيقاف مثلاً) لا يلغي Future التحديث السابق
+                    await asyncio.shield(previous)
+                finally:
+                    self.waiting -= 1
+            wait = time.perf_counter() - queued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            await self._execute(coroutine)
+            self.processed += 1
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        finally:
+            if previous is not None and not previous.done():
+                # ألغي التحديث أثناء انتظار دوره، فلا يبدأ التحديث التالي قبل انتهاء السابق
+                previous.add_done_callback(lambda _: self._release(key, done))
+            else:
+                self._release(key, done)
+            depth = self._depths[key] - 1
+            if depth:
+                self._depths[key] = depth
+            else:
+                del self._depths[key]
+
+    def stats(self) -> dict:
+        """إحصائيات المعالجة: عمق الانتظار وعدد التحديثات الجارية"""
+        avg = self.total_wait / self.processed if self.processed else 0.0
+        return {
+            'updates_active': self.active,
+            'updates_waiting': self.waiting,
+            'updates_waiting_max': self.max_waiting,
+            'update_keys': len(self._depths),
+            'update_key_depth_max': self.max_key_depth,
+            'updates_processed': self.processed,
+            'update_wait_avg_ms': round(avg * 1000, 2),
+            'update_wait_max_ms': round(self.max_wait * 1000, 2)
+        }
+
+
+update_processor = OrderedUpdateProcessor()
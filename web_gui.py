@@ -1,13 +1,20 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, g
 import json
 import os
+import time
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 from googleapiclient.errors import HttpError
 
+import metrics
+
 app = Flask(__name__)
 
+request_latency = metrics.registry.histogram(
+    'web_gui_request_duration_seconds', 'Web GUI request latency', ('endpoint', 'status')
+)
+
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SERVICE_ACCOUNT_FILE = 'credentials.json'
 
@@ -38,6 +45,20 @@ def get_sheets_service():
         print(f"Error getting sheets service: {e}")
         return None
 
+def execute(sheets_request):
+    """تنفيذ طلب Sheets API مع تسجيله في مقاييس طلبات Google Sheets المشتركة مع البوت"""
+    metrics.sheets_in_flight.inc()
+    started = time.perf_counter()
+    try:
+        return sheets_request.execute()
+    except Exception as e:
+        status = e.resp.status if isinstance(e, HttpError) else ''
+        metrics.sheets_errors.inc(kind='read', exception=type(e).__name__, status=status)
+        raise
+    finally:
+        metrics.sheets_latency.observe(time.perf_counter() - started, kind='read')
+        metrics.sheets_in_flight.dec()
+
 def get_spreadsheet_metadata(spreadsheet_id):
     try:
         print(f"\n=== بداية جلب معلومات الجدول ===")
@@ -50,7 +71,7 @@ def get_spreadsheet_metadata(spreadsheet_id):
 
         # جلب معلومات الجدول
         print("جلب معلومات الجدول...")
-        spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+        spreadsheet = execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id))
         
         # جلب قائمة أوراق العمل
         sheets = spreadsheet.get('sheets', [])
@@ -83,8 +104,8 @@ def get_sheet_columns(spreadsheet_id, worksheet_name):
             return None
 
         range_name = f"{worksheet_name}!1:1"
-        result = service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id, range=range_name).execute()
+        result = execute(service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id, range=range_name))
         values = result.get('values', [])
         
         columns = values[0] if values else []
@@ -97,6 +118,22 @@ def get_sheet_columns(spreadsheet_id, worksheet_name):
     finally:
         print("=== نهاية جلب الأعمدة ===\n")
 
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    if request.endpoint != 'metrics_endpoint' and hasattr(g, 'started'):
+        request_latency.observe(
+            time.perf_counter() - g.started, endpoint=request.endpoint or '', status=response.status_code
+        )
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/')
 def index():
     config = load_config()
@@ -243,7 +280,7 @@ def verify_sheet():
 
         try:
             # محاولة الوصول للجدول
-            spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+            spreadsheet = execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id))
             sheets = spreadsheet.get('sheets', [])
             sheet_names = [sheet['properties']['title'] for sheet in sheets]
             
@@ -256,8 +293,8 @@ def verify_sheet():
             # جلب أسماء الأعمدة من الورقة الأولى
             first_sheet = sheet_names[0]
             range_name = f"{first_sheet}!1:1"
-            result = service.spreadsheets().values().get(
-                spreadsheetId=spreadsheet_id, range=range_name).execute()
+            result = execute(service.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id, range=range_name))
             columns = result.get('values', [[]])[0]
 
             return jsonify({